@@ -0,0 +1,67 @@
+"""
+Minimal in-process ASGI client used by the benchmarks, so they run without a server or extra http packages.
+Author: vatsal1306
+"""
+import asyncio
+import json
+import os
+import tempfile
+from contextlib import asynccontextmanager
+
+from src.Utils import settings
+
+
+async def request(app, method: str, path: str, body=None, headers: dict = None, on_body=None):
+    """
+    Send one http request to the ASGI `app`. Returns (status, headers, body bytes).
+    `on_body` is called with every body chunk as it is sent, for streamed responses.
+    """
+    payload = json.dumps(body).encode() if body is not None else b""
+    raw_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]
+    raw_headers += [(k.lower().encode(), str(v).encode()) for k, v in (headers or {}).items()]
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+             "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+             "headers": raw_headers, "client": ("127.0.0.1", 0), "server": ("testserver", 80)}
+    sent = False
+    finished = asyncio.Event()
+    response = {"status": None, "headers": {}, "body": b""}
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        # the client stays connected until the whole response is sent, streamed responses listen for this
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode(): v.decode() for k, v in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+            if on_body is not None and message.get("body"):
+                on_body(message["body"])
+            if not message.get("more_body", False):
+                finished.set()
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], response["body"]
+
+
+@asynccontextmanager
+async def running(app, plans: bool = False):
+    """
+    Run the FastAPI lifespan (startup/shutdown) around the benchmark, isolated from the production state: no job
+    workers, the job store, the caches and with `plans` the plan store (disabled otherwise) are files in a temporary
+    directory.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {"job_store": "jobs.sqlite3", "plan_store": "plans.sqlite3",
+                 "response_cache_sqlite": "responses.sqlite3", "image_cache_index": "image_index.json"}
+        with settings.overridden(job_workers="0", plan_store_enabled=str(plans).lower(),
+                                 **{key: os.path.join(tmp, name) for key, name in paths.items()}):
+            async with app.router.lifespan_context(app):
+                yield app
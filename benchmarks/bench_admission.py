@@ -0,0 +1,80 @@
+"""
+Overload: open loop arrivals of `/meal` and `/water` above what the stubbed Bedrock can serve, with and without
+admission control. Reports latency of the admitted requests, rejections and meals degraded to no images.
+Run: python -m benchmarks.bench_admission [seconds] [meals_per_second] [water_per_second]
+Author: vatsal1306
+"""
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.admission import AdmissionController
+from src.Logging import logger
+from src.app import app
+from benchmarks.asgi import request, running
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+    PERSON = json.load(f)
+
+
+async def _call(path: str, results: list, headers: dict = None):
+    start = perf_counter()
+    status, response_headers, _ = await request(app, "POST", path, PERSON, headers=headers)
+    results.append((path, status, response_headers.get("x-degraded"), perf_counter() - start))
+
+
+async def _load(seconds: float, rates: dict, headers: dict = None) -> list:
+    results, tasks = [], []
+    start = perf_counter()
+    sent = {path: 0 for path in rates}
+    while (elapsed := perf_counter() - start) < seconds:
+        for path, rate in rates.items():
+            while sent[path] < elapsed * rate:
+                sent[path] += 1
+                tasks.append(asyncio.create_task(_call(path, results, headers)))
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*tasks)
+    return results
+
+
+def _report(name: str, results: list):
+    print(name)
+    for path in ("/water", "/meal"):
+        rows = [row for row in results if row[0] == path]
+        ok = sorted(row[3] for row in rows if row[1] == 200)
+        rejected = {status: sum(1 for row in rows if row[1] == status) for status in (429, 503)}
+        degraded = sum(1 for row in rows if row[1] == 200 and row[2])
+        p99 = ok[min(len(ok) - 1, int(len(ok) * 0.99))] if ok else 0.0
+        print(f"  {path:<7} sent={len(rows):>4}  ok={len(ok):>4}  degraded={degraded:>4}  429={rejected[429]:>4}  "
+              f"503={rejected[503]:>4}  p50={statistics.median(ok) if ok else 0:6.2f} s  p99={p99:6.2f} s")
+
+
+async def main(seconds: float = 10, meals_per_second: float = 6, water_per_second: float = 12):
+    logger.setLevel(logging.CRITICAL)
+    rates = {"/meal": meals_per_second, "/water": water_per_second}
+    async with running(app):
+        install_stubs(app.state.model, StubBedrock(text_latency=1.0, image_latency=0.3, answers="recorded"),
+                     StubS3())
+        app.state.plans = None
+        controller = app.state.admission
+
+        app.state.admission = None
+        _report("no admission control", await _load(seconds, rates))
+
+        app.state.admission = controller
+        _report("admission control", await _load(seconds, rates))
+
+        app.state.admission = AdmissionController.from_settings()
+        _report("admission control, X-Deadline-Ms: 3000", await _load(seconds, rates, {"X-Deadline-Ms": 3000}))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(float(arg) for arg in sys.argv[1:])))
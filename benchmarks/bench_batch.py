@@ -0,0 +1,45 @@
+"""
+Throughput of `/batch/<event>` as the batch grows, against a stubbed Bedrock client. Profiles are drawn from a fixed
+pool, so larger batches contain more duplicates that share one generation.
+Run: python -m benchmarks.bench_batch [event] [unique_profiles]
+Author: vatsal1306
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.app import app
+from benchmarks.asgi import request, running
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+    PERSON = json.load(f)
+
+
+def _profiles(size: int, unique: int) -> list:
+    return [{**PERSON, "id": i, "age": 20 + i % unique} for i in range(size)]
+
+
+async def main(event: str = "water", unique: int = 50):
+    logger.setLevel(logging.WARNING)
+    async with running(app):
+        for size in (10, 50, 200, 1000):
+            stub = StubBedrock(text_latency=0.2, image_latency=0.05)
+            install_stubs(app.state.model, stub, StubS3())
+            start = perf_counter()
+            status, _, body = await request(app, "POST", f"/batch/{event}", _profiles(size, unique))
+            elapsed = perf_counter() - start
+            summary = json.loads(body.splitlines()[-1])["summary"]
+            print(f"batch={size:>5}  unique={summary['unique_profiles']:>4}  bedrock calls={stub.calls:>5}  "
+                  f"{elapsed:6.2f} s  {summary['plans_per_minute']:>10.1f} plans/min")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "water", int(sys.argv[2]) if len(sys.argv) > 2 else 50))
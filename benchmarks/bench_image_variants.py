@@ -0,0 +1,69 @@
+"""
+Meal image variants: bytes a client downloads per meal view with the 512x512 PNG (test.png) against the encoded
+variants, and the cost of encoding them for a week of meals on the image threads against the process pool.
+`tick lag` is the worst delay of a 5 ms timer on another thread while encoding, i.e. how much the encoding holds
+the GIL that request handling needs.
+Run: python -m benchmarks.bench_image_variants [meals]
+Author: vatsal1306
+"""
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+from src import ROOT_DIR
+from src.image_variants import ImageEncoder, encode_variants, parse_variants
+from src.Utils import settings
+
+# meals listed in a week overview and opened in a detail view
+LIST_MEALS = 28
+
+
+def _ticker(stop: threading.Event, lags: list):
+    while not stop.is_set():
+        start = perf_counter()
+        sleep(0.005)
+        lags.append(perf_counter() - start - 0.005)
+
+
+def encode_run(encoder: ImageEncoder, image: bytes, meals: int) -> tuple:
+    stop, lags = threading.Event(), []
+    ticker = threading.Thread(target=_ticker, args=(stop, lags))
+    ticker.start()
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=int(settings.image_concurrency)) as pool:
+        list(pool.map(lambda _: encoder.encode(image), range(meals)))
+    seconds = perf_counter() - start
+    stop.set()
+    ticker.join()
+    return seconds, max(lags)
+
+
+def main(meals: int = 28):
+    with open(os.path.join(ROOT_DIR, "test.png"), "rb") as f:
+        image = f.read()
+    variants = parse_variants(settings.image_variants)
+    encoded = encode_variants(image, variants)
+    smallest = min(variants, key=lambda v: v.size).name
+    largest = max(variants, key=lambda v: v.size).name
+
+    print(f"png            {len(image) / 1024:8.1f} KiB")
+    for variant in variants:
+        print(f"{variant.name:<8} {variant.format:<5} {variant.size:>4}px q{variant.quality:<3} "
+              f"{len(encoded[variant.name]) / 1024:8.1f} KiB  {len(image) / len(encoded[variant.name]):6.1f}x smaller")
+    print(f"list view of {LIST_MEALS} meals: png {LIST_MEALS * len(image) / 1024:9.1f} KiB  "
+          f"{smallest} {LIST_MEALS * len(encoded[smallest]) / 1024:8.1f} KiB")
+    print(f"detail view:            png {len(image) / 1024:9.1f} KiB  {largest} {len(encoded[largest]) / 1024:8.1f} KiB")
+
+    for name, workers in (("threads", 0), ("process pool", int(settings.image_encode_workers) or 2)):
+        encoder = ImageEncoder(variants, workers)
+        encoder.encode(image)  # start the pool outside the measurement
+        seconds, lag = encode_run(encoder, image, meals)
+        encoder.shutdown()
+        print(f"{name:<13} {meals} meals encoded in {seconds:6.2f} s  ({seconds / meals * 1000:6.1f} ms/meal)  "
+              f"tick lag max {lag * 1000:6.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
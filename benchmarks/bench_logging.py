@@ -0,0 +1,102 @@
+"""
+Per-request logging overhead of the previous synchronous handlers against the queue based pipeline in src/Logging.
+Simulates the records of one /meal request: the formatted prompt, the full model response, 28 image prompts and
+a few status lines. Output goes to a temp directory and /dev/null instead of the terminal.
+Both paths run at the same payload sampling rate (the configured one, or `sample_rate`), so they write the same
+records. `all payloads` is the legacy handlers at the old rate of 1, the difference to `legacy` is what sampling alone
+saves. The listener thread
+formats and writes concurrently with the requests and competes with them for the GIL and, on few cores, the cpu,
+which shows in the tail: the p99 ratio is reported next to the mean.
+Run: python -m benchmarks.bench_logging [requests] [sample_rate]
+Author: vatsal1306
+"""
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+from logging.handlers import RotatingFileHandler
+from time import perf_counter
+
+from src import ROOT_DIR
+from src.Logging import PayloadFilter, create_pipeline
+from src.Utils import settings
+
+with open(os.path.join(ROOT_DIR, "sample_meal_plan.json")) as f:
+    PROMPT = "Consider a fictional character with this details(...).\n" + str(json.load(f))
+with open(os.path.join(ROOT_DIR, "output", "sample_diet_output.json")) as f:
+    RESPONSE = json.dumps(json.load(f)["success"], indent=4)
+
+
+def simulate_meal_request(logger: logging.Logger):
+    logger.info("Executing /meal for - id=1 age=25 gender='male' height='170 cm' weight='84 kg'")
+    logger.info(f"Meal prompt - {PROMPT}", extra={"payload": True})
+    logger.info("Response fetched successfully - {'inputTokens': 1200, 'outputTokens': 2000}")
+    logger.info(f"Response: {RESPONSE}", extra={"payload": True})
+    for i in range(28):
+        logger.info(f"Image prompt - Generate an image of meal(Meal {i}) ingredients(oats, milk, banana).",
+                    extra={"payload": True})
+    logger.info("/meal done in 12.3 seconds.")
+
+
+def _legacy_logger(name: str, path: str, devnull, sample_rate: float) -> logging.Logger:
+    logger = logging.getLogger(f"bench.{name}")
+    logger.addFilter(PayloadFilter(int(settings.max_message_chars), sample_rate))
+    formatter = logging.Formatter('%(filename)s | %(lineno)s | %(asctime)s | %(levelname)s | %(message)s')
+    for handler in (RotatingFileHandler(path), logging.StreamHandler(devnull)):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+
+def _measure(logger: logging.Logger, requests: int) -> list:
+    timings = []
+    for _ in range(requests):
+        start = perf_counter()
+        simulate_meal_request(logger)
+        timings.append(perf_counter() - start)
+    return timings
+
+
+def _percentile(timings: list, q: float) -> float:
+    return sorted(timings)[int(len(timings) * q) - 1]
+
+
+def main(requests: int = 500, sample_rate: float = None):
+    settings.load()
+    if sample_rate is not None:
+        settings.payload_sample_rate = str(sample_rate)
+    sample_rate = float(settings.payload_sample_rate)
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        unsampled = _measure(_legacy_logger("unsampled", os.path.join(tmp, "unsampled.log"), devnull, 1.0), requests)
+        legacy = _measure(_legacy_logger("legacy", os.path.join(tmp, "legacy.log"), devnull, sample_rate), requests)
+
+        logger = logging.getLogger("bench.pipeline")
+        handler, listener = create_pipeline(os.path.join(tmp, "pipeline.log"), devnull)
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        pipeline = _measure(logger, requests)
+        drain_start = perf_counter()
+        listener.stop()
+        drain = perf_counter() - drain_start
+
+        sizes = {name: os.path.getsize(os.path.join(tmp, f"{name}.log"))
+                 for name in ("unsampled", "legacy", "pipeline")}
+
+    print(f"payload sample rate {sample_rate}, {os.cpu_count()} cpus")
+    for name, timings, log in (("all payloads", unsampled, "unsampled"), ("legacy", legacy, "legacy"),
+                               ("pipeline", pipeline, "pipeline")):
+        print(f"{name:<12} mean={statistics.mean(timings) * 1e6:9.1f} us/request  "
+              f"p50={statistics.median(timings) * 1e6:9.1f} us  p99={_percentile(timings, 0.99) * 1e6:9.1f} us  "
+              f"file={sizes[log] / 1024:9.1f} KiB")
+    print(f"pipeline vs legacy at the same sampling: mean x{statistics.mean(pipeline) / statistics.mean(legacy):.2f}, "
+          f"p99 x{_percentile(pipeline, 0.99) / _percentile(legacy, 0.99):.2f}")
+    print(f"pipeline drain after the run {drain * 1000:.1f} ms, dropped {handler.dropped} records")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500, float(sys.argv[2]) if len(sys.argv) > 2 else None)
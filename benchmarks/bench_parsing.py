@@ -0,0 +1,64 @@
+"""
+Micro-benchmark of the model output parsing stage over the recorded responses in benchmarks/corpus, against the
+previous replace + literal_eval + json.loads path. Reports time and peak memory per parse and whether it decoded the
+plan object, which the new parser must do for every recorded response.
+Run: python -m benchmarks.bench_parsing [repeat]
+Author: vatsal1306
+"""
+import glob
+import json
+import logging
+import os
+import sys
+import tracemalloc
+from ast import literal_eval
+from timeit import timeit
+
+from src.Logging import logger
+from src.parsing import parse_model_output
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+def legacy_parse(text: str) -> dict:
+    """ The parsing previously done in `get_text_response` and `_data_validation`. """
+    text = text.replace("```", "")
+    text = text.replace("json", "", 1)
+    try:
+        return {"success": literal_eval(text)}
+    except SyntaxError:
+        try:
+            return {"success": json.loads(text)}
+        except (SyntaxError, json.JSONDecodeError) as e:
+            return {"error": str(e)}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def _peak(func, text: str) -> int:
+    tracemalloc.start()
+    func(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main(repeat: int = 200):
+    logger.setLevel(logging.ERROR)
+    print(f"{'response':<28} {'legacy us':>10} {'new us':>9} {'legacy KiB':>11} {'new KiB':>8}  legacy/new ok")
+    for path in sorted(glob.glob(os.path.join(CORPUS, "*.txt"))):
+        name = os.path.basename(path)
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        event = name.split("_")[0]
+        parsers = {"legacy": legacy_parse, "new": lambda t: parse_model_output(t, event)}
+        times = {key: timeit(lambda: func(text), number=repeat) / repeat * 1e6 for key, func in parsers.items()}
+        peaks = {key: _peak(func, text) / 1024 for key, func in parsers.items()}
+        ok = {key: isinstance(func(text).get("success"), dict) for key, func in parsers.items()}
+        print(f"{name:<28} {times['legacy']:>10.1f} {times['new']:>9.1f} {peaks['legacy']:>11.1f} "
+              f"{peaks['new']:>8.1f}  {ok['legacy']}/{ok['new']}")
+        assert ok["new"], f"{name} was not parsed into a plan object"
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
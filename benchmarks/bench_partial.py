@@ -0,0 +1,49 @@
+"""
+Editing a stored plan: Bedrock calls and latency of regenerating the whole 7-day plan (`POST /meal`, `/workout`)
+against regenerating one meal day, one meal or one workout day of it (`POST /plans/{id}/...`).
+Stubbed latencies are per call, so the scoped calls are not credited for their shorter output.
+Run: python -m benchmarks.bench_partial [text_latency] [image_latency]
+Author: vatsal1306
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.app import app
+from benchmarks.asgi import request, running
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+    PERSON = json.load(f)
+
+
+async def timed(client: StubBedrock, path: str) -> tuple:
+    text_calls, image_calls = sum(client.model_calls.values()), client.image_calls
+    start = perf_counter()
+    status, _, body = await request(app, "POST", path, PERSON)
+    seconds = perf_counter() - start
+    assert status == 200 and "success" in json.loads(body), body[:200]
+    return seconds, sum(client.model_calls.values()) - text_calls, client.image_calls - image_calls
+
+
+async def main(text_latency: float = 1.0, image_latency: float = 0.5):
+    logger.setLevel(logging.ERROR)
+    person_id = PERSON["id"]
+    async with running(app, plans=True):
+        client = StubBedrock(text_latency=text_latency, image_latency=image_latency, answers="recorded")
+        install_stubs(app.state.model, client, StubS3())
+        for path in ("/meal", f"/plans/{person_id}/meal/wednesday", f"/plans/{person_id}/meal/wednesday/dinner",
+                     "/workout", f"/plans/{person_id}/workout/wednesday"):
+            seconds, text_calls, image_calls = await timed(client, path)
+            print(f"{path:<38} {seconds:6.2f} s  text calls={text_calls}  image calls={image_calls:>2}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(float(arg) for arg in sys.argv[1:])))
@@ -0,0 +1,44 @@
+"""
+End-to-end latency of `/plan` against calling `/workout`, `/meal` and `/water` one after another, with stubbed
+Bedrock latencies. `/plan` should land close to its longest path (workout -> days) instead of the sum.
+Run: python -m benchmarks.bench_plan
+Author: vatsal1306
+"""
+import asyncio
+import json
+import logging
+import os
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.app import app
+from benchmarks.asgi import request, running
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+    PERSON = json.load(f)
+
+
+async def main():
+    logger.setLevel(logging.WARNING)
+    async with running(app):
+        install_stubs(app.state.model, StubBedrock(text_latency=1.0, image_latency=0.2), StubS3())
+
+        start = perf_counter()
+        for path in ("/workout", "/meal", "/water"):
+            await request(app, "POST", path, PERSON)
+        print(f"sequential endpoints  {perf_counter() - start:6.2f} s")
+
+        start = perf_counter()
+        _, _, body = await request(app, "POST", "/plan", PERSON)
+        print(f"/plan                 {perf_counter() - start:6.2f} s")
+        for name, timing in json.loads(body)["timings"].items():
+            print(f"  {name:<12} start={timing['start']:5.2f} s  duration={timing['duration']:5.2f} s  "
+                  f"{timing['status']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
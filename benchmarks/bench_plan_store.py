@@ -0,0 +1,54 @@
+"""
+Reopening the app: latency of regenerating a meal plan (`POST /meal`, stubbed Bedrock latencies) against reading
+the stored plan back (`GET /plans/{id}/meal`) from a temporary plan store filled with `people` other profiles.
+Run: python -m benchmarks.bench_plan_store [people] [reads]
+Author: vatsal1306
+"""
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.app import app
+from benchmarks.asgi import request, running
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+    PERSON = json.load(f)
+
+
+async def main(people: int = 10000, reads: int = 500):
+    logger.setLevel(logging.WARNING)
+    async with running(app, plans=True):
+        install_stubs(app.state.model, StubBedrock(text_latency=1.0, image_latency=0.2), StubS3())
+        start = perf_counter()
+        status, _, body = await request(app, "POST", "/meal", PERSON)
+        generated = perf_counter() - start
+        assert status == 200 and "success" in json.loads(body), body[:200]
+
+        plan = json.loads(body)["success"]
+        store = app.state.plans
+        for person_id in range(people):
+            store.save(PERSON["id"] + 1 + person_id, "meal", plan)
+
+        timings = []
+        for _ in range(reads):
+            start = perf_counter()
+            status, _, stored = await request(app, "GET", f"/plans/{PERSON['id']}/meal")
+            timings.append(perf_counter() - start)
+            assert status == 200 and json.loads(stored)["success"] == plan
+        timings.sort()
+        print(f"POST /meal (generate)      {generated * 1000:9.1f} ms")
+        print(f"GET /plans/{{id}}/meal       median={statistics.median(timings) * 1000:6.2f} ms  "
+              f"p99={timings[int(len(timings) * 0.99) - 1] * 1000:6.2f} ms  ({store.stats()['plans']} stored)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(int(arg) for arg in sys.argv[1:])))
@@ -0,0 +1,64 @@
+"""
+Prompt size per event, the previous `str.format` prompts with the sample plans inserted as python reprs against the
+compiled prompts, as estimated tokens (characters / 4) of system + user prompt, plus render time per call. The
+scoped events of the plan edits had no previous prompts and are rendered with sample context only.
+Run: python -m benchmarks.bench_prompts
+Author: vatsal1306
+"""
+import json
+import logging
+import os
+from timeit import timeit
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.prompts import EVENTS, PromptCompiler, estimate_tokens, workout_summary
+from src.Utils.utils import Person
+
+
+def _load(filename: str):
+    with open(os.path.join(ROOT_DIR, filename), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# events that existed before the prompts were compiled
+LEGACY_EVENTS = ("workout", "meal", "water", "days")
+
+
+def legacy_prompt(compiler: PromptCompiler, event: str, usr_data: str, workout_details) -> str:
+    """ The user prompt as previously built by `get_text_response`. """
+    _, user_file, sample_file, sample_field, _ = EVENTS[event]
+    args = [usr_data, workout_details] if event == "days" else [usr_data]
+    args.insert(sample_field, _load(sample_file))
+    return compiler._read(os.path.join(compiler.prompts_dir, user_file)).format(*args)
+
+
+def main():
+    logger.setLevel(logging.WARNING)
+    compiler = PromptCompiler()
+    data = Person(**_load("sample_person.json"))
+    usr_data = f"Age={data.age}, Gender={data.gender}, Height={data.height}, Weight={data.weight}, current bodytype={data.current_body_type}, target bodytype={data.target_body_type}, diet preference={data.diet_preference}, Allergy={data.allergens}"
+    workout_details = _load("sample_workout_plan.json")["workoutplan"]
+    meals = _load("sample_meal_day.json")
+    meal_names = ", ".join(meal["name"] for meal in meals.values())
+    context = {"days": (workout_summary(workout_details),),
+               "meal_day": ("wednesday", meal_names),
+               "meal_slot": ("dinner", meals["dinner"]["name"], meal_names),
+               "workout_day": (2, workout_summary(workout_details[:1]), workout_summary(workout_details[1:2]))}
+
+    print(f"{'event':<12} {'legacy tok':>10} {'compiled tok':>12} {'saved':>7} {'render us':>10} {'maxTokens':>9}")
+    for event, prompt in compiler.prompts.items():
+        args = (usr_data, *context.get(event, ()))
+        compiled = estimate_tokens(prompt.system) + estimate_tokens(prompt.template.render(*args))
+        render_us = timeit(lambda: prompt.template.render(*args), number=2000) / 2000 * 1e6
+        if event in LEGACY_EVENTS:
+            legacy = estimate_tokens(prompt.system) + estimate_tokens(legacy_prompt(compiler, event, usr_data,
+                                                                                     workout_details))
+            legacy, saved = f"{legacy:>10}", f"{1 - compiled / legacy:>7.1%}"
+        else:
+            legacy, saved = f"{'-':>10}", f"{'-':>7}"
+        print(f"{event:<12} {legacy} {compiled:>12} {saved} {render_us:>10.1f} {prompt.max_tokens:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Tail latency of text calls through the model router against a stub Bedrock with a long-tailed primary model and a
+faster small model, in four scenarios:
+`single` every event on text_model without hedging (the previous behaviour), `routed` water and days on the small
+model, `hedged` routed plus hedging to the small model, `degraded` the primary fails 60% of calls, failed calls are
+retried on the small model and the breaker sheds to it.
+Run: python -m benchmarks.bench_routing [requests]
+Author: vatsal1306
+"""
+import json
+import logging
+import os
+import statistics
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.model import LLM
+from src.routing import ModelRouter
+from src.Utils import settings
+from src.Utils.utils import Person
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+PRIMARY = "meta.llama3-1-8b-instruct-v1:0"
+SMALL = "meta.llama3-2-3b-instruct-v1:0"
+# median 200 ms with a heavy tail (p99 around 1.3 s) against a steady 80 ms small model
+LATENCY = {PRIMARY: "lognormal:0.2:0.8", SMALL: "lognormal:0.08:0.2"}
+EVENTS = ("water", "workout", "water", "meal")
+
+SCENARIOS = {
+    "single": ({"hedge_enabled": "false"}, {}, {}),
+    "routed": ({"hedge_enabled": "false"}, {"water": SMALL, "days": SMALL}, {}),
+    "hedged": ({"hedge_enabled": "true", "hedge_percentile": "90", "hedge_min_delay": "0.05",
+                "hedge_min_samples": "20"}, {"water": SMALL, "days": SMALL}, {}),
+    "degraded": ({"hedge_enabled": "false", "breaker_cooldown": "1"}, {"water": SMALL, "days": SMALL},
+                 {PRIMARY: 0.6}),
+}
+
+
+def _pct(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+
+
+def run(model: LLM, person: Person, scenario: str, requests: int) -> dict:
+    overrides, routes, failures = SCENARIOS[scenario]
+    for key, value in overrides.items():
+        setattr(settings, key, value)
+    model.router.shutdown()
+    model.router = ModelRouter(primary=PRIMARY, fallback=SMALL, routes=routes)
+    client = StubBedrock(model_latency=LATENCY, model_failure_rate=failures, seed=7)
+    install_stubs(model, client, StubS3())
+
+    def call(i: int):
+        event = EVENTS[i % len(EVENTS)]
+        start = perf_counter()
+        response = model.get_text_response(person, event)
+        return event, perf_counter() - start, "success" in response
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(call, range(requests)))
+    timings = {}
+    for event, seconds, _ in results:
+        timings.setdefault(event, []).append(seconds)
+    return {"timings": timings, "errors": sum(not ok for _, _, ok in results), "calls": dict(client.model_calls),
+            "breakers": {m: b["state"] for m, b in model.router.stats()["breakers"].items()}}
+
+
+def main(requests: int = 400):
+    logger.setLevel(logging.ERROR)
+    with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+        person = Person(**json.load(f))
+    model = LLM(client=StubBedrock(), s3=StubS3())
+    defaults = {key: getattr(settings, key) for overrides, _, _ in SCENARIOS.values() for key in overrides}
+    try:
+        for scenario in SCENARIOS:
+            result = run(model, person, scenario, requests)
+            for key, value in defaults.items():
+                setattr(settings, key, value)
+            for event, timings in sorted(result["timings"].items()):
+                print(f"{scenario:<9} {event:<8} p50={statistics.median(timings) * 1000:7.1f} ms  "
+                      f"p95={_pct(timings, 95):7.1f} ms  p99={_pct(timings, 99):7.1f} ms")
+            print(f"{scenario:<9} errors={result['errors']}  calls={result['calls']}  breakers={result['breakers']}")
+    finally:
+        model.close()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,84 @@
+"""
+Compares per-request latency of the old per-request engine construction against the shared engine. The old `LLM()`
+read the eight prompt files and built a boto3 session and client for Bedrock and S3 on every request, that work is
+reproduced in front of the shared engine's call (today's `LLM()` also builds the caches, router and pools, which the
+old one never had). Bedrock is stubbed and the response and image caches are disabled, every request renders the
+prompt and calls the stub.
+Run: python -m benchmarks.bench_shared_engine [requests]
+Author: vatsal1306
+"""
+import json
+import logging
+import os
+import statistics
+import sys
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.Utils.utils import Person
+from src.model import LLM
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+# prompt files the old `FileReader` read on every `LLM()`
+PROMPT_FILES = ("workout_usr_prompt.txt", "workout_system_prompt.txt", "diet_usr_prompt.txt", "diet_system_prompt.txt",
+                "water_system_prompt.txt", "water_usr_prompt.txt", "days_system_prompt.txt", "days_usr_prompt.txt")
+
+
+def _person() -> Person:
+    with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+        return Person(**json.load(f))
+
+
+def _old_engine() -> tuple:
+    """ What the old `LLM.__init__` built per request: the prompt files and one boto3 session and client each. """
+    import boto3
+
+    prompts = []
+    for name in PROMPT_FILES:
+        with open(os.path.join(ROOT_DIR, "prompts", name), encoding="utf-8") as f:
+            prompts.append(f.read())
+    clients = [boto3.Session(aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                             aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'))
+               .client(service, region_name=os.getenv('AWS_REGION')) for service in ("bedrock-runtime", "s3")]
+    return prompts, clients
+
+
+def _report(name: str, timings: list):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:<10} mean={statistics.mean(timings) * 1000:8.3f} ms  p50={statistics.median(timings) * 1000:8.3f} ms"
+          f"  p95={p95 * 1000:8.3f} ms")
+
+
+def run(requests: int = 200):
+    logger.setLevel(logging.WARNING)
+    person = _person()
+    stub = StubBedrock()
+    shared = LLM(client=stub, s3=StubS3())
+    install_stubs(shared, stub, shared.s3)
+
+    before = []
+    for _ in range(requests):
+        start = perf_counter()
+        _old_engine()
+        shared.get_text_response(person, "water")
+        before.append(perf_counter() - start)
+
+    after = []
+    for _ in range(requests):
+        start = perf_counter()
+        shared.get_text_response(person, "water")
+        after.append(perf_counter() - start)
+    shared.close()
+
+    _report("per-request", before)
+    _report("shared", after)
+    print(f"old engine construction {(statistics.mean(before) - statistics.mean(after)) * 1000:.1f} ms per request, "
+          f"x{statistics.mean(before) / statistics.mean(after):.1f} the shared engine's latency")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,89 @@
+"""
+Similarity index: lookup latency with a few hundred thousand indexed profiles, the share of generations a stream
+of synthetic profiles would reuse (exact cache keys against the similarity threshold) and the cost of adding
+profiles to a full index, which evicts the oldest ones.
+Run: python -m benchmarks.bench_similarity [profiles] [lookups]
+Author: vatsal1306
+"""
+import logging
+import random
+import statistics
+import sys
+from time import perf_counter
+
+from src.Logging import logger
+from src.response_cache import normalize_profile
+from src.similarity import SimilarityIndex
+from src.Utils import settings
+from src.Utils.utils import Person
+
+INFERENCE = {"temperature": 0.3, "topP": 0.5, "maxTokens": 2048}
+BODY_TYPES = ("fat", "skinny", "average", "athletic")
+TARGETS = ("cutting", "bulking", "lean", "maintain")
+
+
+def random_person(rng: random.Random, person_id: int) -> Person:
+    gender = rng.choice(("male", "female"))
+    height = rng.gauss(176 if gender == "male" else 163, 7)
+    height = f"{height:.0f} cm" if rng.random() < 0.8 else f"{int(height / 30.48)}'{round(height / 2.54 % 12)}\""
+    weight = rng.gauss(80 if gender == "male" else 65, 12)
+    weight = f"{weight:.0f} kg" if rng.random() < 0.8 else f"{weight / 0.45359237:.0f} lbs"
+    return Person(id=person_id, age=rng.randint(18, 60), gender=gender, height=height, weight=weight,
+                  current_body_type=rng.choice(BODY_TYPES), target_body_type=rng.choice(TARGETS),
+                  diet_preference=rng.choice(("veg", "non-veg", "vegan")), allergens=rng.choice(("none", "nuts")),
+                  sport="gym", target_date="2025-01-01")
+
+
+def main(profiles: int = 300000, lookups: int = 20000):
+    settings.load()
+    logger.setLevel(logging.ERROR)
+    rng = random.Random(7)
+    index = SimilarityIndex.from_settings()
+    index.capacity = profiles + lookups
+    people = [random_person(rng, i) for i in range(profiles + lookups)]
+
+    start = perf_counter()
+    for i, person in enumerate(people[:profiles]):
+        index.add("meal", person, "model", INFERENCE, str(i))
+    print(f"indexed {index.size} profiles in {len(index.partitions)} partitions in {perf_counter() - start:.1f} s")
+
+    timings = []
+    for person in people[profiles:]:
+        start = perf_counter()
+        index.lookup("meal", person, "model", INFERENCE)
+        timings.append(perf_counter() - start)
+    timings.sort()
+    print(f"lookup median={statistics.median(timings) * 1e6:6.1f} us  "
+          f"p99={timings[int(len(timings) * 0.99)] * 1e6:6.1f} us")
+
+    # reuse on a cold start: every miss is generated and indexed, as in `LLM.get_text_response`
+    for size in (1000, 10000, 100000):
+        index = SimilarityIndex.from_settings()
+        keys = set()
+        exact = 0
+        for i, person in enumerate(people[:size]):
+            key = str(sorted(normalize_profile(person).items()))
+            exact += key in keys
+            keys.add(key)
+            if index.lookup("meal", person, "model", INFERENCE) is None:
+                index.add("meal", person, "model", INFERENCE, str(i))
+        stats = index.stats()
+        generated = size - stats["reused"] - stats["exact"]
+        print(f"{size:>7} profiles: exact key reuse {exact / size:6.1%}, similarity reuse "
+              f"{(stats['reused'] + stats['exact']) / size:6.1%}, generations {size - exact} -> {generated}")
+
+    # a full index stays at its capacity: every add past it compacts down to 90%
+    index = SimilarityIndex.from_settings()
+    index.capacity = profiles // 2
+    timings = []
+    for i, person in enumerate(people[:profiles]):
+        start = perf_counter()
+        index.add("meal", person, "model", INFERENCE, str(i))
+        timings.append(perf_counter() - start)
+    stats = index.stats()
+    print(f"capacity {index.capacity}: {profiles} adds, {stats['profiles']} kept, {stats['evicted']} evicted, "
+          f"add mean={statistics.mean(timings) * 1e6:6.1f} us  max={max(timings) * 1e3:6.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,70 @@
+"""
+Cold start of one worker process: time to import `src.app`, time of the startup phase (lifespan: config, logging,
+prompt compilation, boto3 clients, job runner) and latency of the first and second request.
+Every run is a fresh interpreter, Bedrock calls are stubbed after startup so only local work is measured.
+Run: python -m benchmarks.bench_startup [runs]
+Author: vatsal1306
+"""
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+from src import ROOT_DIR
+
+HEAVY_MODULES = ("boto3", "botocore", "dotenv", "PIL", "numpy")
+
+
+async def _child() -> dict:
+    start = perf_counter()
+    from src.app import app
+    imported = perf_counter()
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    import logging
+    from src.Logging import logger
+    from benchmarks.asgi import request, running
+    from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+    logger.setLevel(logging.CRITICAL)
+    with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+        person = json.load(f)
+
+    begin = perf_counter()
+    async with running(app):
+        started = perf_counter()
+        status, _, _ = await request(app, "GET", "/ready")
+        assert status == 200, f"/ready returned {status}"
+        install_stubs(app.state.model, StubBedrock(), StubS3())
+        timings = []
+        for _ in range(2):
+            first = perf_counter()
+            status, _, _ = await request(app, "POST", "/water", person)
+            assert status == 200, f"/water returned {status}"
+            timings.append(perf_counter() - first)
+    return {"import": imported - start, "startup": started - begin, "first_request": timings[0],
+            "second_request": timings[1], "heavy_on_import": heavy}
+
+
+def main(runs: int = 5):
+    env = {**os.environ, "AWS_REGION": os.getenv("AWS_REGION", "us-east-1")}
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-m", "benchmarks.bench_startup", "--child"], cwd=ROOT_DIR, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    for key in ("import", "startup", "first_request", "second_request"):
+        values = [result[key] * 1000 for result in results]
+        print(f"{key:<15} median={statistics.median(values):8.1f} ms  min={min(values):8.1f} ms  "
+              f"max={max(values):8.1f} ms")
+    print(f"heavy modules imported by `import src.app`: {results[0]['heavy_on_import'] or 'none'}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--child"]:
+        print(json.dumps(asyncio.run(_child())))
+    else:
+        main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,49 @@
+"""
+Time-to-first-byte and total time of the buffered endpoints against their streaming variants.
+Bedrock is stubbed with a fixed generation time spread over the streamed chunks.
+Run: python -m benchmarks.bench_streaming [text_latency_seconds]
+Author: vatsal1306
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.app import app
+from benchmarks.asgi import request, running
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+    PERSON = json.load(f)
+
+
+async def _measure(path: str) -> tuple:
+    start = perf_counter()
+    first = []
+
+    def on_body(chunk):
+        if not first:
+            first.append(perf_counter() - start)
+
+    status, _, body = await request(app, "POST", path, PERSON, on_body=on_body)
+    assert status == 200, f"{path} returned {status}"
+    return first[0], perf_counter() - start, body
+
+
+async def main(text_latency: float = 2.0):
+    logger.setLevel(logging.WARNING)
+    async with running(app):
+        install_stubs(app.state.model, StubBedrock(text_latency=text_latency, image_latency=0.1), StubS3())
+        for path in ("/meal", "/meal/stream", "/workout", "/workout/stream"):
+            ttfb, total, body = await _measure(path)
+            print(f"{path:<16} ttfb={ttfb * 1000:8.1f} ms  total={total * 1000:8.1f} ms  {len(body)} bytes")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 2.0))
@@ -0,0 +1,69 @@
+"""
+Meal image generation against a stub Titan that throttles calls beyond an account quota of in-flight images.
+Compares the previous behaviour (no retries, fixed concurrency) with retries only and with retries plus the AIMD
+limit: failed meal images, throttled calls, wall time and the concurrency limit the controller settled on.
+Run: python -m benchmarks.bench_throttling [plans] [quota]
+Author: vatsal1306
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src.executor import ModelExecutor
+from src.Logging import logger
+from src.model import LLM
+from src.rate_control import RateController
+from src.Utils import settings
+from benchmarks.stubs import StubBedrock, StubS3, canned_answers, install_stubs
+
+SCENARIOS = {
+    "no_retry": {"retry_max_attempts": "1", "aimd_decrease": "1"},
+    "retry": {"retry_max_attempts": "6", "retry_base_delay": "0.05", "aimd_decrease": "1"},
+    "retry_aimd": {"retry_max_attempts": "6", "retry_base_delay": "0.05", "aimd_decrease": "0.5",
+                   "aimd_cooldown": "0.1"},
+}
+
+
+async def run(model: LLM, scenario: str, plans: int, quota: int) -> dict:
+    defaults = {key: getattr(settings, key) for key in SCENARIOS[scenario]}
+    for key, value in SCENARIOS[scenario].items():
+        setattr(settings, key, value)
+    model.image_rate = RateController("image", int(settings.image_concurrency))
+    for key, value in defaults.items():
+        setattr(settings, key, value)
+    client = StubBedrock(image_latency=0.1, image_quota=quota)
+    install_stubs(model, client, StubS3())
+    executor = ModelExecutor()
+    meal = json.loads(canned_answers("recorded")["meal"])
+
+    start = perf_counter()
+    results = await asyncio.gather(*[executor.generate_image(model, {"success": json.loads(json.dumps(meal))}, i)
+                                     for i in range(plans)])
+    seconds = perf_counter() - start
+    executor.shutdown()
+    failed = sum(1 for result in results for meals in result["success"].values() for value in meals.values()
+                 if value.get("image_error"))
+    images = sum(len(meals) for meals in meal.values()) * plans
+    return {"seconds": seconds, "failed": failed, "images": images, "throttled": client.throttled,
+            "limit": model.image_rate.stats()["limit"]}
+
+
+def main(plans: int = 2, quota: int = 4):
+    logger.setLevel(logging.CRITICAL)
+    model = LLM(client=StubBedrock(), s3=StubS3())
+    try:
+        for scenario in SCENARIOS:
+            result = asyncio.run(run(model, scenario, plans, quota))
+            print(f"{scenario:<11} failed={result['failed']:>3}/{result['images']}  "
+                  f"throttled={result['throttled']:>4}  wall={result['seconds']:6.2f} s  final limit={result['limit']}")
+    finally:
+        model.close()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
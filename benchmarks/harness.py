@@ -0,0 +1,163 @@
+"""
+Offline load-testing harness. Starts the FastAPI app in-process with stubbed `bedrock-runtime` and `s3` clients,
+drives each endpoint at a fixed concurrency and reports p50/p95/p99 latency, throughput, errors and memory.
+Admission control is off, so `/meal` is always measured with its images (see bench_admission for overload).
+Results are written as json so runs can be compared across changes.
+
+Run: python -m benchmarks.harness --endpoints water,workout,meal --concurrency 8 --requests 64 \\
+        --text-latency lognormal:1.5:0.4 --image-latency lognormal:0.4:0.3 --failure-rate 0.01
+     python -m benchmarks.harness ... --baseline benchmarks/results/<previous run>.json
+Author: vatsal1306
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import subprocess
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.app import app
+from benchmarks.asgi import request, running
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+RESULTS_DIR = os.path.join(ROOT_DIR, "benchmarks", "results")
+
+with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+    PERSON = json.load(f)
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = (len(values) - 1) * q
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def _failed(status: int, body: bytes) -> bool:
+    if status != 200:
+        return True
+    return any(b'"error"' in line[:20] for line in body.splitlines()[:1])
+
+
+async def run_endpoint(path: str, requests: int, concurrency: int, vary_profiles: bool,
+                       trace_memory: bool = False) -> dict:
+    latencies, errors = [], 0
+    issued = 0
+
+    async def worker():
+        nonlocal issued, errors
+        while issued < requests:
+            index = issued
+            issued += 1
+            person = {**PERSON, "id": index, "age": 18 + index % 50} if vary_profiles else PERSON
+            start = perf_counter()
+            status, headers, body = await request(app, "POST", path, person)
+            latencies.append(perf_counter() - start)
+            assert "x-degraded" not in headers, f"{path} was degraded"
+            errors += _failed(status, body)
+
+    if trace_memory:
+        tracemalloc.start()
+    start = perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        tracemalloc.stop()
+    return {"requests": requests, "concurrency": concurrency, "errors": errors, "seconds": round(elapsed, 4),
+            "throughput_rps": round(requests / elapsed, 3),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(max(latencies) * 1000, 2), "peak_traced_kib": peak,
+            "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def _print(results: dict, baseline: dict = None):
+    print(f"{'endpoint':<16} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'rss KiB':>9} "
+          f"{'peak KiB':>9}")
+    for path, stats in results["endpoints"].items():
+        print(f"{path:<16} {stats['throughput_rps']:>8.2f} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} "
+              f"{stats['p99_ms']:>9.1f} {stats['errors']:>7} {stats['max_rss_kib']:>9} "
+              f"{stats['peak_traced_kib'] if stats['peak_traced_kib'] is not None else '-':>9}")
+        old = (baseline or {}).get("endpoints", {}).get(path)
+        if old:
+            deltas = "  ".join(f"{key} {(stats[key] - old[key]) / old[key] * 100:+.1f}%"
+                               for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms") if old[key])
+            print(f"{'  vs baseline':<16} {deltas}")
+
+
+async def main(args):
+    logger.setLevel(logging.WARNING)
+    results = {"label": args.label, "commit": _git_commit(), "time": datetime.now().isoformat(timespec="seconds"),
+               "config": {key: str(value) for key, value in vars(args).items()}, "endpoints": {}}
+    async with running(app):
+        client = StubBedrock(args.text_latency, args.image_latency, args.failure_rate, args.failure_code,
+                             args.answers, args.seed)
+        install_stubs(app.state.model, client, StubS3(args.s3_latency, seed=args.seed), caches=args.caches)
+        app.state.admission = None
+        for endpoint in args.endpoints.split(","):
+            path = "/" + endpoint.strip("/")
+            results["endpoints"][path] = await run_endpoint(path, args.requests, args.concurrency,
+                                                            args.vary_profiles, args.trace_memory)
+        results["bedrock_calls"] = client.calls
+        results["bedrock_failures"] = client.faults.failures
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    _print(results, baseline)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{args.label}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {output}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoints", default="water,workout,meal", help="comma separated endpoint paths")
+    parser.add_argument("--requests", type=int, default=64, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--text-latency", default="lognormal:1.5:0.4", help="converse latency distribution")
+    parser.add_argument("--image-latency", default="lognormal:0.4:0.3", help="invoke_model latency distribution")
+    parser.add_argument("--s3-latency", default="uniform:0.01:0.05")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of Bedrock calls that fail")
+    parser.add_argument("--failure-code", default="ThrottlingException")
+    parser.add_argument("--answers", choices=("samples", "recorded"), default="recorded")
+    parser.add_argument("--caches", action="store_true", help="keep the response and image caches enabled")
+    parser.add_argument("--vary-profiles", action="store_true", help="give every request a different age")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="report the tracemalloc peak per endpoint, slows the run down")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--output", help="results file, defaults to benchmarks/results/<time>-<label>.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
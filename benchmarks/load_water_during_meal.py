@@ -0,0 +1,72 @@
+"""
+Load test: latency of the cheap `/test/water` route while `/meal` requests are in flight, and wall time of a burst
+of concurrent `/water` requests. Bedrock and S3 are stubbed with fixed latencies.
+With blocking model calls in the handlers `/test/water` waits for the whole meal generation, with the executor it
+stays flat. Admission control is off, every meal is generated with its images.
+Run: python -m benchmarks.load_water_during_meal [meal_requests]
+Author: vatsal1306
+"""
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+from time import perf_counter
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.app import app
+from benchmarks.asgi import request, running
+from benchmarks.stubs import StubBedrock, StubS3, install_stubs
+
+with open(os.path.join(ROOT_DIR, "sample_person.json")) as f:
+    PERSON = json.load(f)
+
+
+async def _timed(path: str) -> float:
+    start = perf_counter()
+    status, headers, _ = await request(app, "POST", path, PERSON)
+    assert status == 200, f"{path} returned {status}"
+    assert "x-degraded" not in headers, f"{path} was degraded"
+    return perf_counter() - start
+
+
+async def _probe(samples: int, interval: float) -> list:
+    timings = []
+    for _ in range(samples):
+        timings.append(await _timed("/test/water"))
+        await asyncio.sleep(interval)
+    return timings
+
+
+def _fmt(timings: list) -> str:
+    return f"p50={statistics.median(timings) * 1000:7.2f} ms  max={max(timings) * 1000:7.2f} ms"
+
+
+async def main(meal_requests: int = 8):
+    logger.setLevel(logging.WARNING)
+    async with running(app):
+        install_stubs(app.state.model, StubBedrock(text_latency=1.0, image_latency=0.02), StubS3())
+        # measures the executor, not admission control: no meal may be degraded to text only
+        app.state.admission = None
+
+        idle = await _probe(20, 0.01)
+        print(f"/test/water idle            {_fmt(idle)}")
+
+        meals = [asyncio.create_task(_timed("/meal")) for _ in range(meal_requests)]
+        await asyncio.sleep(0.05)
+        loaded = await _probe(100, 0.01)
+        meal_timings = await asyncio.gather(*meals)
+        print(f"/test/water with {meal_requests:>2} /meal  {_fmt(loaded)}")
+        print(f"/meal                       {_fmt(meal_timings)}")
+
+        start = perf_counter()
+        await asyncio.gather(*[_timed("/water") for _ in range(16)])
+        print(f"16 concurrent /water (1 s each) finished in {perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8))
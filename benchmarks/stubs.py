@@ -0,0 +1,260 @@
+"""
+Stand-ins for the boto3 `bedrock-runtime` and `s3` clients so the service can be benchmarked without AWS.
+Latencies follow configurable distributions, calls can fail at a configurable rate with Bedrock error codes and
+canned answers come from the sample json files (`samples`, 2-day plans) or the recorded outputs in `output/`
+(`recorded`, full 7-day plans).
+Author: vatsal1306
+"""
+import base64
+import io
+import json
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from src import ROOT_DIR
+
+
+def _load(filename: str):
+    with open(os.path.join(ROOT_DIR, filename)) as f:
+        return json.load(f)
+
+
+def _recorded_meal() -> dict:
+    meal = _load(os.path.join("output", "sample_diet_output.json"))["success"]
+    for meals in meal.values():
+        for value in meals.values():
+            value.pop("s3_location", None)
+    return meal
+
+
+def canned_answers(source: str = "samples") -> dict:
+    """ Bedrock text answers by event. """
+    scoped = {"meal_day": json.dumps(_load("sample_meal_day.json")),
+              "meal_slot": json.dumps(_load("sample_meal_slot.json")),
+              "workout_day": json.dumps(_load("sample_workout_day.json"))}
+    if source == "recorded":
+        workout = _load(os.path.join("output", "sample_workout_output.json"))["success"]
+        days = {"days": str(workout.pop("days", "30"))}
+        return {"days": json.dumps(days), "meal": json.dumps(_recorded_meal()), "workout": json.dumps(workout),
+                "water": json.dumps(_load("sample_water_intake.json")), **scoped}
+    return {"days": json.dumps(_load("sample_days.json")), "meal": json.dumps(_load("sample_meal_plan.json")),
+            "workout": json.dumps(_load("sample_workout_plan.json")),
+            "water": json.dumps(_load("sample_water_intake.json")), **scoped}
+
+
+# smallest valid png (1x1 transparent pixel)
+TINY_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII=")
+
+
+class Latency:
+    """
+    Latency distribution in seconds, built from a number or a spec string:
+    `0.5`, `const:0.5`, `uniform:0.2:1.0`, `normal:<mean>:<sd>`, `lognormal:<median>:<sigma>`, `exp:<mean>`.
+    """
+
+    def __init__(self, spec=0.0, seed: int = None):
+        self.spec = str(spec)
+        self.random = random.Random(seed)
+        name, *args = self.spec.split(":") if ":" in self.spec else ("const", self.spec)
+        self.name, self.args = name, [float(arg) for arg in args]
+        if self.name not in ("const", "uniform", "normal", "lognormal", "exp"):
+            raise ValueError(f"unknown latency distribution {self.name}")
+
+    @classmethod
+    def of(cls, value) -> "Latency":
+        return value if isinstance(value, Latency) else cls(value)
+
+    def sample(self) -> float:
+        match self.name:
+            case "const":
+                return self.args[0]
+            case "uniform":
+                return self.random.uniform(*self.args)
+            case "normal":
+                return max(0.0, self.random.gauss(*self.args))
+            case "lognormal":
+                median, sigma = self.args
+                return median * self.random.lognormvariate(0, sigma)
+            case "exp":
+                return self.random.expovariate(1 / self.args[0])
+
+    def __str__(self):
+        return self.spec
+
+
+class _Faults:
+    def __init__(self, failure_rate: float, failure_code: str, seed: int = None):
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+
+    def call(self, operation: str):
+        with self.lock:
+            self.calls += 1
+            failed = self.random.random() < self.failure_rate
+            self.failures += failed
+        if failed:
+            raise ClientError({"Error": {"Code": self.failure_code, "Message": "injected failure"}}, operation)
+
+
+class StubBedrock:
+    """
+    Mimics `converse`, `converse_stream` and `invoke_model` of the bedrock-runtime client. A streamed answer spreads
+    the sampled text latency evenly over its chunks. `model_latency` and `model_failure_rate` override the text
+    latency and failure rate per model id. `image_quota` throttles `invoke_model` calls beyond that many in flight,
+    like an account quota. `image` replaces the 1x1 png returned by `invoke_model`, e.g. with a real 512x512 image.
+    Answers longer than `maxTokens` (about 4 characters per token) are cut off with stop reason `max_tokens`.
+    """
+
+    def __init__(self, text_latency=0.0, image_latency=0.0, failure_rate: float = 0.0,
+                 failure_code: str = "ThrottlingException", answers: str = "samples", seed: int = None,
+                 model_latency: dict = None, model_failure_rate: dict = None, image_quota: int = None,
+                 image: bytes = TINY_PNG):
+        self.text_latency = Latency.of(text_latency)
+        self.image_latency = Latency.of(image_latency)
+        self.faults = _Faults(failure_rate, failure_code, seed)
+        self.model_latency = {model_id: Latency(spec, seed) for model_id, spec in (model_latency or {}).items()}
+        self.model_faults = {model_id: _Faults(rate, failure_code, seed)
+                             for model_id, rate in (model_failure_rate or {}).items()}
+        self.model_calls = {}
+        self.image_calls = 0
+        self.image_quota = image_quota
+        self.image = base64.b64encode(image).decode("ascii")
+        self.images_in_flight = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.answers = canned_answers(answers)
+
+    @property
+    def calls(self) -> int:
+        return self.faults.calls + sum(faults.calls for faults in self.model_faults.values())
+
+    def _text_call(self, modelId: str, operation: str) -> float:
+        """ Count the call, raise an injected failure and return the latency to simulate. """
+        with self.lock:
+            self.model_calls[modelId] = self.model_calls.get(modelId, 0) + 1
+        self.model_faults.get(modelId, self.faults).call(operation)
+        return self.model_latency.get(modelId, self.text_latency).sample()
+
+    @staticmethod
+    def _event(prompt: str) -> str:
+        if "number of days" in prompt:
+            return "days"
+        if "meals of one day" in prompt:
+            return "meal_day"
+        if "generate a single" in prompt:
+            return "meal_slot"
+        if "workout of one day" in prompt:
+            return "workout_day"
+        if "meal plan" in prompt:
+            return "meal"
+        if "workout plan" in prompt:
+            return "workout"
+        return "water"
+
+    def _answer(self, prompt: str, inference_config: dict = None) -> tuple:
+        """ :return: (text, stop reason) of the canned answer for the event of `prompt` """
+        text = self.answers[self._event(prompt)]
+        limit = (inference_config or {}).get("maxTokens")
+        if limit and len(text) > limit * 4:
+            return text[:limit * 4], "max_tokens"
+        return text, "end_turn"
+
+    @staticmethod
+    def _usage(prompt: str, text: str) -> dict:
+        return {"inputTokens": len(prompt) // 4, "outputTokens": len(text) // 4,
+                "totalTokens": (len(prompt) + len(text)) // 4}
+
+    def converse(self, modelId, messages, system, inferenceConfig=None, **kwargs):
+        time.sleep(self._text_call(modelId, "Converse"))
+        prompt = messages[0]["content"][0]["text"]
+        text, stop_reason = self._answer(prompt, inferenceConfig)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}, "usage": self._usage(prompt, text),
+                "stopReason": stop_reason, "output": {"message": {"role": "assistant", "content": [{"text": text}]}}}
+
+    def converse_stream(self, modelId, messages, system, inferenceConfig=None, chunk_size: int = 64, **kwargs):
+        latency = self._text_call(modelId, "ConverseStream")
+        prompt = messages[0]["content"][0]["text"]
+        text, stop_reason = self._answer(prompt, inferenceConfig)
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+        def stream():
+            yield {"messageStart": {"role": "assistant"}}
+            for chunk in chunks:
+                time.sleep(latency / len(chunks))
+                yield {"contentBlockDelta": {"delta": {"text": chunk}, "contentBlockIndex": 0}}
+            yield {"messageStop": {"stopReason": stop_reason}}
+            yield {"metadata": {"usage": self._usage(prompt, text)}}
+
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}, "stream": stream()}
+
+    def invoke_model(self, body, modelId, accept=None, contentType=None, **kwargs):
+        self.faults.call("InvokeModel")
+        with self.lock:
+            self.image_calls += 1
+            if self.image_quota is not None and self.images_in_flight >= self.image_quota:
+                self.throttled += 1
+                raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "quota exceeded"}},
+                                  "InvokeModel")
+            self.images_in_flight += 1
+        try:
+            time.sleep(self.image_latency.sample())
+        finally:
+            with self.lock:
+                self.images_in_flight -= 1
+        payload = json.dumps({"images": [self.image], "error": None})
+        return {"body": io.BytesIO(payload.encode())}
+
+
+class StubS3:
+    """ Remembers uploaded keys and their sizes and drops the bytes. """
+
+    def __init__(self, latency=0.0, failure_rate: float = 0.0, seed: int = None):
+        self.latency = Latency.of(latency)
+        self.faults = _Faults(failure_rate, "SlowDown", seed)
+        self.keys = set()
+        self.sizes = {}
+
+    @property
+    def uploads(self) -> int:
+        return len(self.keys)
+
+    def upload_file(self, filename, bucket, key, **kwargs):
+        self.faults.call("PutObject")
+        time.sleep(self.latency.sample())
+        self.keys.add(key)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.faults.call("PutObject")
+        time.sleep(self.latency.sample())
+        self.keys.add(Key)
+        self.sizes[Key] = len(Body)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency.sample())
+        if Key not in self.keys:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+
+def install_stubs(model, client, s3, caches: bool = False):
+    """ Swap the clients of a started `LLM`. Caches are dropped unless `caches`, so every request hits the stubs. """
+    model.client = client
+    model.s3 = s3
+    if model.image_cache is not None:
+        model.image_cache.s3 = s3
+    if not caches:
+        if model.response_cache is not None:
+            model.response_cache.close()
+        model.image_cache = None
+        model.response_cache = None
+        model.similarity = None
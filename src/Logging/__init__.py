@@ -1,28 +1,221 @@
+import atexit
+import copy
+import itertools
+import json
 import logging
-from logging.handlers import RotatingFileHandler
 import os
+import queue
+import random
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from time import time
+
 from src.Utils import settings
 from src.Utils.utils import Path
 
+# id of the request being served, set by RequestIdMiddleware and attached to every record
+request_id_var: ContextVar = ContextVar("request_id", default=None)
+# renders tracebacks on the request path, before the record is queued
+_exception_formatter = logging.Formatter()
+
+
+class SizeAndTimeRotatingFileHandler(RotatingFileHandler):
+    """ Rotates when the file exceeds `maxBytes` or when `interval` seconds passed since the last rollover. """
+
+    def __init__(self, filename: str, maxBytes: int, backupCount: int, interval: float):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, encoding="utf-8")
+        self.interval = interval
+        self.rollover_at = time() + interval
+
+    def shouldRollover(self, record) -> bool:
+        if self.interval and time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time() + self.interval
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        entry = {"time": self.formatTime(record), "level": record.levelname, "file": record.filename,
+                 "line": record.lineno, "request_id": getattr(record, "request_id", None),
+                 "message": record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class PayloadFilter(logging.Filter):
+    """
+    Runs on the request path before a record is queued: attaches the request id, samples records marked with
+    `extra={"payload": True}` (prompts, model responses) and truncates long messages and tracebacks. A traceback
+    keeps its end, where the exception is.
+    """
+
+    def __init__(self, max_chars: int, sample_rate: float):
+        super().__init__()
+        self.max_chars = max_chars
+        self.sample_rate = sample_rate
+
+    def filter(self, record) -> bool:
+        record.request_id = request_id_var.get()
+        if getattr(record, "payload", False) and random.random() >= self.sample_rate:
+            return False
+        message = record.getMessage()
+        if len(message) > self.max_chars:
+            record.msg = f"{message[:self.max_chars]}... [truncated {len(message) - self.max_chars} chars]"
+            record.args = None
+        if record.exc_info and not record.exc_text:
+            text = _exception_formatter.formatException(record.exc_info)
+            if len(text) > self.max_chars:
+                text = f"[truncated {len(text) - self.max_chars} chars] ...{text[-self.max_chars:]}"
+            record.exc_text = text
+        return True
+
+
+class BoundedQueueHandler(QueueHandler):
+    """ Hands records to the background writer. Records are dropped, not blocked on, when the queue is full. """
+
+    def __init__(self, maxsize: int):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Unlike `QueueHandler.prepare` the traceback is not folded into the message: it is passed as `exc_text` for
+        the listener's formatter (the `exception` field of json logs). The traceback objects are not queued.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DrainingQueueListener(QueueListener):
+    """ `stop` waits for room in a full queue instead of raising `queue.Full`, the listener is still draining it. """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class RequestIdMiddleware:
+    """ ASGI middleware: takes `X-Request-ID` from the request or generates one, and echoes it in the response. """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers", []))
+        request_id = headers.get(b"x-request-id", b"").decode() or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", []).append((b"x-request-id", request_id.encode()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
+
+
+def create_pipeline(log_filepath: str, stream=None) -> tuple:
+    """
+    Queue based logging: the returned handler only filters and enqueues, the listener thread formats and writes
+    to the rotating file and the stream.
+    :return: (queue handler, started listener)
+    """
+    if settings.log_format == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(filename)s | %(lineno)s | %(asctime)s | %(levelname)s | %(request_id)s | '
+                                      '%(message)s')
+
+    file_handler = SizeAndTimeRotatingFileHandler(log_filepath, int(settings.max_bytes), int(settings.backup_count),
+                                                  float(settings.rotate_interval))
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.INFO)
+
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(logging.INFO)
+
+    queue_handler = BoundedQueueHandler(int(settings.queue_size))
+    queue_handler.addFilter(PayloadFilter(int(settings.max_message_chars), float(settings.payload_sample_rate)))
+    listener = DrainingQueueListener(queue_handler.queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    return queue_handler, listener
+
+
 logger = logging.getLogger(__name__)
-logger.setLevel(settings.level)
+listener = None
+# lock file of the worker slot held by this process, open until it exits
+_slot_lock = None
 
-log_dirname = "Logs"
-log_filename = settings.file
-log_filepath = os.path.join(os.getcwd(), log_dirname, log_filename)
 
-Path.create_dir_if_not_exists(log_dirname)
-Path.create_file_if_not_exists(log_filepath)
+def _worker_slot(log_dirname: str, stem: str) -> int:
+    """
+    Lowest worker slot no other live process holds, claimed with an exclusive lock on `<stem>.<slot>.lock`. The lock
+    is released when the process exits, so a restarted worker takes over the slot, and the log files, of the one it
+    replaces. Falls back to the pid where `fcntl` is not available.
+    """
+    global _slot_lock
+    try:
+        import fcntl
+    except ImportError:
+        return os.getpid()
+    for slot in itertools.count():
+        lock = open(os.path.join(log_dirname, f"{stem}.{slot}.lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        _slot_lock = lock
+        return slot
 
-formatter = logging.Formatter('%(filename)s | %(lineno)s | %(asctime)s | %(levelname)s | %(message)s')
 
-file_handler = RotatingFileHandler(log_filepath)
-file_handler.setFormatter(formatter)
-file_handler.setLevel(logging.INFO)
+def configure(log_filepath: str = None):
+    """
+    Attach the logging pipeline to `logger`, called once in the startup phase. Creates the Logs directory and
+    starts the listener thread. With several server workers (WEB_CONCURRENCY > 1) each process writes its own
+    file, `app.<slot>.log` with a slot per live worker (see `_worker_slot`), rotation is not safe across processes.
+    """
+    global listener
+    if listener is not None:
+        return
+    if logger.level == logging.NOTSET:
+        logger.setLevel(settings.level)
+    if log_filepath is None:
+        log_dirname = "Logs"
+        log_filename = settings.file
+        log_dirname = os.path.join(os.getcwd(), log_dirname)
+        if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+            Path.create_dir_if_not_exists(log_dirname)
+            stem, ext = os.path.splitext(log_filename)
+            log_filename = f"{stem}.{_worker_slot(log_dirname, stem)}{ext}"
+        log_filepath = os.path.join(log_dirname, log_filename)
 
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-stream_handler.setLevel(logging.INFO)
+    Path.create_dir_if_not_exists(os.path.dirname(log_filepath))
+    Path.create_file_if_not_exists(log_filepath)
 
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+    queue_handler, listener = create_pipeline(log_filepath)
+    logger.addHandler(queue_handler)
+    atexit.register(listener.stop)
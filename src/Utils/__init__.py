@@ -2,19 +2,60 @@
 
 import configparser
 import os
+from contextlib import contextmanager
 from src import ROOT_DIR
 
-config = configparser.ConfigParser()
 config_file = os.path.join(ROOT_DIR, 'config.ini')
-config.read(config_file)
 
 
 class Settings:
+    """
+    Keys of every section of config.ini as attributes. The file is read by `load` during startup, or on the first
+    attribute access when a script uses the modules directly.
+    """
+
     def __init__(self):
-        sections = config.sections()
-        for section in sections:
+        self.loaded = False
+        self.overrides = {}
+
+    def load(self):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        for section in config.sections():
             for key, value in config.items(section):
                 setattr(self, key, value)
+        for key, value in self.overrides.items():
+            setattr(self, key, value)
+        self.loaded = True
+
+    @contextmanager
+    def overridden(self, **values: str):
+        """
+        Replace config.ini keys for the duration of the block, also across `load` (the app lifespan reloads the
+        file), e.g. to run the app in a benchmark without its production stores. Values are strings like those read
+        from the file.
+        """
+        previous = self.overrides
+        self.overrides = {**previous, **values}
+        self.load()
+        try:
+            yield self
+        finally:
+            self.overrides = previous
+            self.load()
+
+    def __getattr__(self, name: str):
+        if self.__dict__.get("loaded", True):
+            raise AttributeError(name)
+        self.load()
+        return getattr(self, name)
+
+
+def load_env() -> bool:
+    """ Load AWS settings from .env into the environment, existing variables win. """
+    from dotenv import load_dotenv
+
+    return load_dotenv(dotenv_path=os.path.join(ROOT_DIR, '.env'), verbose=True)
 
 
 settings = Settings()
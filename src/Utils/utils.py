@@ -1,12 +1,30 @@
 import inspect
 import os
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional, Literal, Union, TypedDict
 
 
 class Response(TypedDict, total=False):
     success: str
     error: str
+    # plan repaired from an answer cut off at maxTokens
+    truncated: bool
+    # meal plan sent without its images, under load or close to the client deadline
+    degraded: bool
+
+
+# keys next to `success` marking an incomplete plan: it is served but neither cached nor stored
+INCOMPLETE_MARKERS = ("truncated", "degraded")
+
+
+def is_complete(resp) -> bool:
+    return "success" in resp and not any(resp.get(marker) for marker in INCOMPLETE_MARKERS)
+
+
+def carry_markers(source, target):
+    """ Copy the incomplete markers of `source` (a truncated answer, skipped images) to the response built from it. """
+    target.update((marker, source[marker]) for marker in INCOMPLETE_MARKERS if marker in source)
+    return target
 
 
 class Workout(BaseModel):
@@ -17,6 +35,12 @@ class Workout(BaseModel):
     description: Optional[str] = Field("None",
                                        description="Workout description and extra information to take care for this workout.")
 
+    @field_validator("sets", "reps", "weight", mode="before")
+    @classmethod
+    def none_string(cls, value):
+        # the prompt sample uses the string "None" for workouts without sets/reps/weight
+        return None if value == "None" else value
+
 
 class DailyWorkout(BaseModel):
     day: int = Field(..., description="Day number.")
@@ -127,7 +151,7 @@ def adjust_format(resp):
         new_value['day'] = key
         new_resp.append({"data": new_value})
 
-    return {"success": new_resp}
+    return carry_markers(resp, {"success": new_resp})
 
 def adjust_workout(resp):
     success_response = resp['success']['workoutplan']
@@ -0,0 +1,341 @@
+"""
+Admission control in front of the handlers. Every route has a cost in Bedrock calls (water 1, meal 29) and a worker
+admits requests while their summed in-flight cost fits its budget. Requests over the budget wait briefly, cheapest
+first, meals that still do not fit are degraded to plans without images, and what can not be served in time is
+rejected right away with 429 (over budget) or 503 (client deadline can not be met) instead of slowing down every
+admitted request. Batches are admitted per profile group, at the cost of a request of their event.
+Author: vatsal1306
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import math
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from time import monotonic
+from typing import Optional
+
+from starlette.routing import Match
+
+from src import metrics
+from src.Logging import logger
+from src.Utils import settings
+
+# relative deadline of the client in milliseconds, e.g. `X-Deadline-Ms: 5000`
+DEADLINE_HEADER = b"x-deadline-ms"
+
+_ticket: ContextVar[Optional["Ticket"]] = ContextVar("admission_ticket", default=None)
+
+
+def parse_costs(spec: str) -> dict:
+    """ Parse `route template:cost, ...` from config.ini. """
+    costs = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        route, cost = item.rsplit(":", 1)
+        costs[route.strip()] = float(cost)
+    return costs
+
+
+class Rejected(Exception):
+    def __init__(self, status: int, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """ Admission of one request: its cost, whether it is degraded and its absolute deadline (monotonic). """
+
+    def __init__(self, route: str, cost: float, degraded: bool, deadline: Optional[float], image_seconds: float):
+        self.route = route
+        self.cost = cost
+        self.degraded = degraded
+        self.deadline = deadline
+        self.image_seconds = image_seconds
+        self.started = monotonic()
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - monotonic()
+
+
+def images_allowed() -> bool:
+    """ False for a degraded request, or when the client deadline leaves no time for the meal images. """
+    ticket = _ticket.get()
+    if ticket is None:
+        return True
+    if ticket.degraded:
+        return False
+    remaining = ticket.remaining()
+    if remaining is not None and remaining <= ticket.image_seconds:
+        # answered like a degraded request, latency is tracked as such and the client sees `X-Degraded`
+        ticket.degraded = True
+        return False
+    return True
+
+
+class _Waiter:
+    def __init__(self, cost: float, seq: int):
+        self.cost = cost
+        self.seq = seq
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.cost, self.seq) < (other.cost, other.seq)
+
+
+class AdmissionController:
+    """
+    Cost budget of one worker process, used from its event loop only. Requests costing more than `cheap_cost` may
+    use `1 - reserved` of the budget, so cheap endpoints keep capacity while meals pile up. Waiting requests are
+    admitted cheapest first. Latencies are tracked per route (EWMA) to tell whether a deadline can still be met.
+    """
+
+    def __init__(self, budget: float, costs: dict, degraded_costs: dict, reserved: float, cheap_cost: float,
+                 max_wait: float, max_queue: int, image_seconds: float):
+        self.budget = budget
+        self.costs = costs
+        self.degraded_costs = degraded_costs
+        self.reserved = reserved
+        self.cheap_cost = cheap_cost
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.image_seconds = image_seconds
+        self.in_flight = 0.0
+        self.waiters = []
+        self.seq = itertools.count()
+        self.latency = {}
+        self.counts = {}
+        logger.info(f"Admission control: budget {budget}, {len(costs)} priced routes, max wait {max_wait} s")
+
+    @classmethod
+    def from_settings(cls) -> "AdmissionController":
+        costs, reserved = parse_costs(settings.admission_costs), float(settings.admission_reserved)
+        budget = float(settings.admission_budget)
+        if budget <= 0:
+            # room for admission_meals of the most expensive route next to the share reserved for cheap routes
+            budget = math.ceil(int(settings.admission_meals) * max(costs.values(), default=1.0) / (1 - reserved))
+        return cls(budget, costs, parse_costs(settings.admission_degraded_costs), reserved,
+                   float(settings.admission_cheap_cost), float(settings.admission_max_wait),
+                   int(settings.admission_max_queue), float(settings.admission_image_seconds))
+
+    def cost_of(self, route: str) -> float:
+        return self.costs.get(route, 0.0)
+
+    def capacity(self, route: str) -> Optional[int]:
+        """ Requests to `route` the budget admits at once, at least 1, None for routes that are not priced. """
+        cost = self.cost_of(route)
+        if not cost:
+            return None
+        limit = self.budget if cost <= self.cheap_cost else self.budget * (1 - self.reserved)
+        return max(1, int(limit // cost))
+
+    def expected(self, route: str, degraded: bool) -> Optional[float]:
+        return self.latency.get((route, degraded))
+
+    def _fits(self, cost: float) -> bool:
+        limit = self.budget if cost <= self.cheap_cost else self.budget * (1 - self.reserved)
+        return self.in_flight + cost <= limit
+
+    def _count(self, route: str, result: str):
+        self.counts[result] = self.counts.get(result, 0) + 1
+        metrics.admission_total.inc(route=route, result=result)
+
+    def _reject(self, route: str, status: int, message: str, retry_after: float = None) -> Rejected:
+        self._count(route, "rejected_deadline" if status == 503 else "rejected_budget")
+        logger.warning(f"Rejected {route} with {status} - {message}")
+        return Rejected(status, message, retry_after)
+
+    async def admit(self, route: str, deadline: Optional[float] = None, max_wait: float = None,
+                    degrade: bool = True) -> Ticket:
+        """
+        Admit a request to `route` with `deadline` seconds left, waiting at most `max_wait` (default the configured
+        one) for budget. A request with a cheaper degraded variant waits for its full cost first and is degraded
+        when that does not fit within the wait (or the deadline), never with `degrade=False`.
+        Raises `Rejected` with the status to answer.
+        """
+        cost = self.cost_of(route)
+        degraded_cost = self.degraded_costs.get(route) if degrade else None
+        degraded = False
+        expires = None if deadline is None else monotonic() + deadline
+        max_wait = self.max_wait if max_wait is None else max_wait
+        if deadline is not None:
+            if deadline <= 0:
+                raise self._reject(route, 503, "request deadline already passed.")
+            expected = self.expected(route, False)
+            if expected is not None and expected > deadline:
+                if degraded_cost is None or (self.expected(route, True) or 0) > deadline:
+                    raise self._reject(route, 503, f"{route} takes ~{expected:.1f} s, deadline is {deadline:.1f} s.")
+                degraded = True
+        if degraded:
+            cost = degraded_cost
+
+        start = monotonic()
+        if degraded_cost is None or degraded:
+            await self._acquire(route, cost, expires, self.expected(route, degraded) or 0.0, max_wait)
+        # waiting for the full cost leaves time for the images, or the request would be degraded anyway
+        elif not await self._acquire(route, cost, expires, self.expected(route, False) or self.image_seconds,
+                                     max_wait, final=False):
+            cost, degraded = degraded_cost, True
+            await self._acquire(route, cost, expires, self.expected(route, True) or 0.0,
+                                max(0.0, max_wait - (monotonic() - start)))
+        self._count(route, "degraded" if degraded else "admitted")
+        metrics.admission_in_flight_cost.set(self.in_flight)
+        full, light = self.expected(route, False), self.expected(route, True)
+        image_seconds = full - light if full is not None and light is not None else self.image_seconds
+        return Ticket(route, cost, degraded, expires, image_seconds)
+
+    async def _acquire(self, route: str, cost: float, expires: Optional[float], expected: float, max_wait: float,
+                       final: bool = True) -> bool:
+        """
+        Take `cost` from the budget, waiting up to `max_wait` behind cheaper waiters and no longer than the deadline
+        leaves after `expected` seconds of work. :return: False when it did not fit in time and this is not the
+        `final` attempt, a final attempt raises `Rejected` instead.
+        """
+        if self._fits(cost) and (not self.waiters or cost < self.waiters[0].cost):
+            self.in_flight += cost
+            return True
+        wait = max_wait
+        if expires is not None:
+            wait = min(wait, expires - monotonic() - expected)
+            if wait <= 0 < max_wait:
+                if not final:
+                    return False
+                raise self._reject(route, 503, "over capacity and the deadline leaves no time to wait.")
+        if wait <= 0 or len(self.waiters) >= self.max_queue:
+            if not final:
+                return False
+            raise self._reject(route, 429, f"over capacity ({self.in_flight:.0f}/{self.budget:.0f} in flight).",
+                               retry_after=max_wait)
+        waiter = _Waiter(cost, next(self.seq))
+        heapq.heappush(self.waiters, waiter)
+        start = monotonic()
+        try:
+            await asyncio.wait_for(waiter.future, wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # admitted while the client went away, hand the budget back
+                self.in_flight -= cost
+                self._wake()
+            raise
+        finally:
+            metrics.admission_wait_seconds.observe(monotonic() - start, route=route)
+        if not waiter.future.done() or waiter.future.cancelled():
+            if not final:
+                return False
+            raise self._reject(route, 429, f"over capacity, no budget within {wait:.1f} s.", retry_after=max_wait)
+        return True
+
+    def _wake(self):
+        while self.waiters:
+            head = self.waiters[0]
+            if head.future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if not self._fits(head.cost):
+                break
+            heapq.heappop(self.waiters)
+            self.in_flight += head.cost
+            head.future.set_result(None)
+        metrics.admission_in_flight_cost.set(self.in_flight)
+
+    def release(self, ticket: Ticket, ok: bool):
+        self.in_flight -= ticket.cost
+        if ok:
+            key = (ticket.route, ticket.degraded)
+            seconds = monotonic() - ticket.started
+            previous = self.latency.get(key)
+            self.latency[key] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+        self._wake()
+
+    def stats(self) -> dict:
+        return {"budget": self.budget, "in_flight_cost": self.in_flight, "waiting": len(self.waiters),
+                "results": dict(self.counts),
+                "expected_seconds": {f"{route}{' (degraded)' if degraded else ''}": round(seconds, 3)
+                                     for (route, degraded), seconds in self.latency.items()}}
+
+
+@asynccontextmanager
+async def admitted(controller: Optional[AdmissionController], route: str, max_wait: float = None):
+    """
+    Admission of work started by a handler rather than a request, e.g. every profile group of a batch priced like
+    a request to `route`. Never degraded, raises `Rejected`. Without a controller nothing is admitted.
+    """
+    if controller is None:
+        yield None
+        return
+    ticket = await controller.admit(route, max_wait=max_wait, degrade=False)
+    ok = False
+    try:
+        yield ticket
+        ok = True
+    finally:
+        controller.release(ticket, ok)
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware admitting priced routes through `app.state.admission`. Rejections are answered with
+    `{"error": ...}` and `Retry-After`, degraded responses carry `X-Degraded: images`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        controller = getattr(scope["app"].state, "admission", None) if scope["type"] == "http" else None
+        route = self._route(scope) if controller is not None else None
+        if route is None or not controller.cost_of(route.path):
+            return await self.app(scope, receive, send)
+        # set before routing so rejected requests are counted under their route template
+        scope["route"] = route
+
+        try:
+            deadline = self._deadline(scope)
+            ticket = await controller.admit(route.path, deadline)
+        except Rejected as e:
+            return await self._respond(send, e.status, str(e), e.retry_after)
+        except ValueError as e:
+            return await self._respond(send, 400, str(e))
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and ticket.degraded:
+                message.setdefault("headers", []).append((b"x-degraded", b"images"))
+            await send(message)
+
+        token = _ticket.set(ticket)
+        ok = False
+        try:
+            await self.app(scope, receive, send_wrapper)
+            ok = True
+        finally:
+            _ticket.reset(token)
+            controller.release(ticket, ok)
+
+    @staticmethod
+    def _route(scope):
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route
+        return None
+
+    @staticmethod
+    def _deadline(scope) -> Optional[float]:
+        value = dict(scope.get("headers", [])).get(DEADLINE_HEADER)
+        if value is None:
+            return None
+        try:
+            return float(value) / 1000
+        except ValueError:
+            raise ValueError(f"invalid {DEADLINE_HEADER.decode()} header {value.decode()!r}, expected milliseconds.")
+
+    @staticmethod
+    async def _respond(send, status: int, message: str, retry_after: float = None):
+        headers = [(b"content-type", b"application/json")]
+        if retry_after is not None:
+            headers.append((b"retry-after", str(max(1, round(retry_after))).encode()))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": json.dumps({"error": message}).encode()})
@@ -2,27 +2,109 @@
 File for application code for fastapi. execute run command in Makefile to start the uvicorn server.
 Author: vatsal1306
 """
+import asyncio
 import json
 import os
+from contextlib import asynccontextmanager
 from time import time
+from typing import List, Literal
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response as RawResponse, StreamingResponse
 
-from src import ROOT_DIR
-from src.Logging import logger
-from src.Utils.utils import Person, Response, adjust_format, adjust_workout
+from src import ROOT_DIR, metrics
+from src.admission import AdmissionController, AdmissionMiddleware
+from src.Logging import RequestIdMiddleware, configure as configure_logging, logger
+from src.Utils import load_env, settings
+from src.Utils.utils import Person, Response, adjust_format, adjust_workout, carry_markers
+from src.batch import run_batch
+from src.executor import ModelExecutor
+from src.jobs import JobRunner, JobStore, QueueFullError, wait_for_job
 from src.model import LLM
+from src.pipelines import (MEAL_SLOTS, WEEKDAYS, PlanPartNotFoundError, meal_day_edit, meal_plan, meal_slot_edit,
+                           water_plan, workout_day_edit, workout_plan)
+from src.plan_store import PlanStore, create_plan_store, save_plan
+from src.scheduler import Stage, StageScheduler
+from src.streaming import stream_meal_plan, stream_workout_plan
 
-app = FastAPI()
-logger.info("Application started")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup phase: config, .env, log files, prompt templates and boto3 clients are loaded here and not at import,
+    # so importing the app (e.g. in the multi-worker launcher) stays cheap.
+    app.state.ready = False
+    settings.load()
+    configure_logging()
+    if not load_env():
+        logger.warning(".env not found, AWS settings are taken from the environment")
+    app.state.test_outputs = _load_test_outputs()
+    # One engine per process: prompt templates are parsed and boto3 clients are pooled once, not per request.
+    app.state.model = LLM()
+    app.state.executor = ModelExecutor()
+    app.state.jobs = JobStore()
+    app.state.plans = create_plan_store()
+    app.state.admission = AdmissionController.from_settings() if settings.admission_enabled.lower() == "true" \
+        else None
+    app.state.job_runner = JobRunner(app.state.jobs, app.state.model, app.state.executor, plans=app.state.plans)
+    app.state.job_runner.start()
+    _register_cache_metrics(app.state.model)
+    app.state.ready = True
+    logger.info(f"Application started, worker pid {os.getpid()}")
+    yield
+    app.state.ready = False
+    await app.state.job_runner.stop()
+    app.state.jobs.close()
+    if app.state.plans is not None:
+        app.state.plans.close()
+    app.state.executor.shutdown()
+    app.state.model.close()
 
-# model = LLM()
+
+def _load_test_outputs() -> dict:
+    """ Canned responses of the /test endpoints, read once at startup. """
+    with open(os.path.join(ROOT_DIR, 'output', 'sample_workout_output.json')) as f:
+        workout = json.load(f)
+    with open(os.path.join(ROOT_DIR, 'output', 'sample_diet_output.json')) as f:
+        meal = adjust_format(json.load(f))
+    return {"workout": workout, "meal": meal}
+
+
+def _register_cache_metrics(model: LLM):
+    def cache_lookups():
+        samples = {}
+        for cache, stats in (("image", model.image_cache), ("response", model.response_cache)):
+            if stats is None:
+                continue
+            for result, value in stats.stats().items():
+                if result in ("hits", "remote_hits", "misses", "coalesced"):
+                    samples[(cache, result)] = value
+        return samples
+
+    metrics.registry.callback("fitness_cache_lookups_total", "Cache lookups by result.", "counter",
+                              ("cache", "result"), cache_lookups)
+
+
+app = FastAPI(lifespan=lifespan)
+# innermost, so rejected requests still get a request id and are counted by the metrics middleware
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(RequestIdMiddleware)
 
 
-# @app.on_event("startup")
-# def init_model():
-#     LLM()
+async def get_model(request: Request) -> LLM:
+    return request.app.state.model
+
+
+async def get_executor(request: Request) -> ModelExecutor:
+    return request.app.state.executor
+
+
+async def get_jobs(request: Request) -> JobStore:
+    return request.app.state.jobs
+
+
+async def get_plans(request: Request) -> PlanStore:
+    return request.app.state.plans
 
 
 @app.get("/")
@@ -30,38 +112,62 @@ async def root():
     return {"msg": "Home page"}
 
 
+@app.get("/ready")
+async def ready(request: Request):
+    """ Readiness probe, 503 until the prompt templates are compiled and the clients are built, and while stopping. """
+    state = request.app.state
+    model = getattr(state, "model", None)
+    checks = {"templates": model is not None and all(event in model.prompts for event in
+                                                     ("workout", "meal", "water", "days")),
+              "clients": model is not None and model.client is not None and model.s3 is not None,
+              # started, not its tasks: with job_workers = 0 this worker only enqueues
+              "job_runner": bool(getattr(state, "job_runner", None) and state.job_runner.started),
+              "started": getattr(state, "ready", False)}
+    body = {"ready": all(checks.values()), "checks": checks, "pid": os.getpid()}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+
+@app.get("/stats")
+async def stats(request: Request, model: LLM = Depends(get_model), plans: PlanStore = Depends(get_plans)):
+    admission = request.app.state.admission
+    return {"image_cache": model.image_cache.stats() if model.image_cache is not None else None,
+            "response_cache": model.response_cache.stats() if model.response_cache is not None else None,
+            "prompts": model.prompts.stats(), "routing": model.router.stats(),
+            "rate_control": {"text": model.text_rate.stats(), "image": model.image_rate.stats()},
+            "similarity": model.similarity.stats() if model.similarity is not None else None,
+            "admission": admission.stats() if admission is not None else None,
+            "plan_store": plans.stats() if plans is not None else None}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/test/water")
 async def test_water(item: Person):
     return {"success": {"liters": 2.8}}
 
 
 @app.post("/test/workout")
-async def test_workout(item: Person):
-    resp = {}
-    with open(os.path.join(ROOT_DIR, 'output', 'sample_workout_output.json')) as f:
-        resp = json.load(f)
-
+async def test_workout(item: Person, request: Request):
     # resp = adjust_workout(resp)
-    return resp
+    return request.app.state.test_outputs["workout"]
 
 
 @app.post("/test/meal")
-async def test_meal(item: Person):
-    resp = {}
-    with open(os.path.join(ROOT_DIR, 'output', 'sample_diet_output.json')) as f:
-        resp = json.load(f)
-
-    resp = adjust_format(resp)
-    return resp
+async def test_meal(item: Person, request: Request):
+    return request.app.state.test_outputs["meal"]
 
 
 @app.post('/water')
-async def water(item: Person):
+async def water(item: Person, model: LLM = Depends(get_model),
+               executor: ModelExecutor = Depends(get_executor), plans: PlanStore = Depends(get_plans)):
     try:
         water_start = time()
         logger.info(f"Executing {item}")
-        model = LLM()
-        response: Response = model.get_text_response(item, "water")
+        response: Response = await water_plan(item, model, executor)
+        await save_plan(plans, item.id, "water", response)
         logger.info(f"/water done in {time() - water_start} seconds.")
         return response
     except Exception as e:
@@ -70,15 +176,13 @@ async def water(item: Person):
 
 
 @app.post('/workout')
-async def workout(item: Person):
+async def workout(item: Person, model: LLM = Depends(get_model),
+                 executor: ModelExecutor = Depends(get_executor), plans: PlanStore = Depends(get_plans)):
     try:
         workout_start = time()
         logger.info(f"Executing /workout for - {item}")
-        model = LLM()
-        response: Response = model.get_text_response(item, "workout")
-        response: Response = adjust_workout(response)
-        days_resp = model.get_text_response(item, "days", workout_details=response['success']['workoutplan'])
-        response['success']['days'] = days_resp['success']['days']
+        response: Response = await workout_plan(item, model, executor)
+        await save_plan(plans, item.id, "workout", response)
         logger.info(f"/workout done in {time() - workout_start} seconds.")
         return response
     except Exception as e:
@@ -87,16 +191,183 @@ async def workout(item: Person):
 
 
 @app.post('/meal')
-async def meal(item: Person):
+async def meal(item: Person, model: LLM = Depends(get_model),
+              executor: ModelExecutor = Depends(get_executor), plans: PlanStore = Depends(get_plans)):
     try:
         meal_start = time()
         logger.info(f"Executing /meal for - {item}")
-        model = LLM()
-        response: Response = model.get_text_response(item, "meal")
-        response: Response = model.generate_image(response, item.id)
-        response: Response = adjust_format(response)
+        response: Response = await meal_plan(item, model, executor)
+        await save_plan(plans, item.id, "meal", response)
         logger.info(f"/meal done in {time() - meal_start} seconds.")
         return response
     except Exception as e:
         logger.exception(e)
         return {"error": str(e)}
+
+
+@app.post('/plan')
+async def plan(item: Person, model: LLM = Depends(get_model), executor: ModelExecutor = Depends(get_executor),
+               plans: PlanStore = Depends(get_plans)):
+    """ Workout, meal and water in one request. Independent calls overlap, per stage timings are reported. """
+    plan_start = time()
+    logger.info(f"Executing /plan for - {item}")
+
+    async def workout_stage():
+        response = await executor.text(model.get_text_response, item, "workout")
+        return adjust_workout(response) if "success" in response else response
+
+    async def days_stage(workout):
+        return await executor.text(model.get_text_response, item, "days",
+                                   workout_details=workout['success']['workoutplan'])
+
+    async def meal_stage():
+        return await executor.text(model.get_text_response, item, "meal")
+
+    async def meal_images_stage(meal):
+        response = await executor.generate_image(model, meal, item.id)
+        return adjust_format(response) if "success" in response else response
+
+    async def water_stage():
+        return await executor.text(model.get_text_response, item, "water")
+
+    scheduler = StageScheduler([Stage("workout", workout_stage), Stage("days", days_stage, deps=("workout",)),
+                                Stage("meal", meal_stage), Stage("meal_images", meal_images_stage, deps=("meal",)),
+                                Stage("water", water_stage)])
+    results, timings = await scheduler.run()
+
+    workout = results["workout"]
+    if "success" in workout:
+        days_resp = results["days"]
+        workout['success']['days'] = days_resp['success']['days'] if "success" in days_resp else None
+        carry_markers(days_resp, workout)
+    meal = results["meal_images"] if "success" in results["meal"] else results["meal"]
+    for plan_type, response in (("workout", workout), ("meal", meal), ("water", results["water"])):
+        await save_plan(plans, item.id, plan_type, response)
+    logger.info(f"/plan done in {time() - plan_start} seconds.")
+    return {"workout": workout, "meal": meal, "water": results["water"], "timings": timings}
+
+
+@app.post('/batch/{event}')
+async def batch(event: Literal["water", "workout", "meal"], items: List[Person], request: Request,
+                order: Literal["input", "completed"] = "input", model: LLM = Depends(get_model),
+                executor: ModelExecutor = Depends(get_executor), plans: PlanStore = Depends(get_plans)):
+    """
+    Plans for many profiles, streamed as NDJSON. Identical normalized profiles call Bedrock once, each group is
+    admitted like a single request of its event.
+    """
+    if len(items) > int(settings.batch_max_size):
+        err_msg = f"batch of {len(items)} profiles exceeds batch_max_size {settings.batch_max_size}."
+        return JSONResponse(status_code=413, content={"error": err_msg})
+    logger.info(f"Executing /batch/{event} for {len(items)} profiles")
+    return StreamingResponse(run_batch(items, event, model, executor, order, plans=plans,
+                                       admission=request.app.state.admission), media_type="application/x-ndjson")
+
+
+@app.post('/jobs/meal')
+async def meal_job(item: Person, jobs: JobStore = Depends(get_jobs)):
+    """ Queue a /meal generation and return its job id right away. Poll GET /jobs/{job_id} for the result. """
+    try:
+        job_id = await asyncio.to_thread(jobs.enqueue, "meal", item.model_dump())
+    except QueueFullError as e:
+        logger.error(str(e))
+        return JSONResponse(status_code=429, content={"error": str(e)})
+    logger.info(f"Queued meal job {job_id} for - {item}")
+    return {"success": {"job_id": job_id, "status": "queued"}}
+
+
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str, wait: float = 0, jobs: JobStore = Depends(get_jobs)):
+    """ Job status, progress and (partial) result. `wait` long polls up to that many seconds for a change. """
+    job = await wait_for_job(jobs, job_id, min(wait, 60))
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": f"job {job_id} not found."})
+    job.pop("payload")
+    return {"success": job}
+
+
+@app.post('/workout/stream')
+async def workout_stream(item: Person, model: LLM = Depends(get_model),
+                         executor: ModelExecutor = Depends(get_executor), plans: PlanStore = Depends(get_plans)):
+    logger.info(f"Executing /workout/stream for - {item}")
+    return StreamingResponse(stream_workout_plan(item, model, executor, plans), media_type="application/x-ndjson")
+
+
+@app.post('/meal/stream')
+async def meal_stream(item: Person, model: LLM = Depends(get_model),
+                      executor: ModelExecutor = Depends(get_executor), plans: PlanStore = Depends(get_plans)):
+    logger.info(f"Executing /meal/stream for - {item}")
+    return StreamingResponse(stream_meal_plan(item, model, executor, plans), media_type="application/x-ndjson")
+
+
+@app.get('/plans/{person_id}/{plan_type}')
+async def get_plan(person_id: int, plan_type: Literal["workout", "meal", "water"],
+                   plans: PlanStore = Depends(get_plans)):
+    """ Latest stored plan of a person, `{"success": plan, "plan_id", "created"}`. Nothing is generated. """
+    if plans is None:
+        return JSONResponse(status_code=404, content={"error": "plan store is disabled."})
+    stored = await asyncio.to_thread(plans.latest, person_id, plan_type)
+    if stored is None:
+        return JSONResponse(status_code=404, content={"error": f"no {plan_type} plan stored for {person_id}."})
+    # the stored json is sent as is, decoding and re-encoding a meal plan would cost more than the lookup
+    body = f'{{"success": {stored.plan}, "plan_id": {stored.plan_id}, "created": {stored.created}}}'
+    return RawResponse(body, media_type="application/json")
+
+
+@app.get('/plans/{person_id}/{plan_type}/history')
+async def plan_history(person_id: int, plan_type: Literal["workout", "meal", "water"], limit: int = 10,
+                       plans: PlanStore = Depends(get_plans)):
+    """ Ids and creation times of the stored plans of a person, newest first. """
+    if plans is None:
+        return JSONResponse(status_code=404, content={"error": "plan store is disabled."})
+    history = await asyncio.to_thread(plans.history, person_id, plan_type, min(limit, 100))
+    return {"success": [{"plan_id": plan_id, "created": created} for plan_id, created in history]}
+
+
+async def _edit_plan(person_id: int, plan_type: str, item: Person, plans: PlanStore, edit):
+    """ Run `edit(stored plan)` on the latest stored plan of the person and store the merged result. """
+    if plans is None:
+        return JSONResponse(status_code=404, content={"error": "plan store is disabled."})
+    if item.id != person_id:
+        return JSONResponse(status_code=400, content={"error": f"person id {item.id} does not match {person_id}."})
+    stored = await asyncio.to_thread(plans.latest, person_id, plan_type)
+    if stored is None:
+        return JSONResponse(status_code=404, content={"error": f"no {plan_type} plan stored for {person_id}."})
+    try:
+        edit_start = time()
+        response: Response = await edit(stored.decode())
+        logger.info(f"{plan_type} plan {stored.plan_id} of {person_id} edited in {time() - edit_start} seconds.")
+    except PlanPartNotFoundError as e:
+        return JSONResponse(status_code=404, content={"error": str(e)})
+    except Exception as e:
+        logger.exception(e)
+        return {"error": str(e)}
+    await save_plan(plans, person_id, plan_type, response)
+    return response
+
+
+@app.post('/plans/{person_id}/meal/{day}')
+async def edit_meal_day(person_id: int, day: Literal[WEEKDAYS], item: Person, model: LLM = Depends(get_model),
+                        executor: ModelExecutor = Depends(get_executor), plans: PlanStore = Depends(get_plans)):
+    """ Regenerate the meals of one day of the stored meal plan, returns the whole plan in the /meal shape. """
+    logger.info(f"Executing meal edit of {day} for - {item}")
+    return await _edit_plan(person_id, "meal", item, plans,
+                            lambda plan: meal_day_edit(item, model, executor, plan, day))
+
+
+@app.post('/plans/{person_id}/meal/{day}/{slot}')
+async def edit_meal_slot(person_id: int, day: Literal[WEEKDAYS], slot: Literal[MEAL_SLOTS], item: Person,
+                         model: LLM = Depends(get_model), executor: ModelExecutor = Depends(get_executor),
+                         plans: PlanStore = Depends(get_plans)):
+    """ Regenerate one meal of the stored meal plan and its image only. """
+    logger.info(f"Executing meal edit of {day}/{slot} for - {item}")
+    return await _edit_plan(person_id, "meal", item, plans,
+                            lambda plan: meal_slot_edit(item, model, executor, plan, day, slot))
+
+
+@app.post('/plans/{person_id}/workout/{day}')
+async def edit_workout_day(person_id: int, day: Literal[WEEKDAYS], item: Person, model: LLM = Depends(get_model),
+                           executor: ModelExecutor = Depends(get_executor), plans: PlanStore = Depends(get_plans)):
+    """ Regenerate one day of the stored workout plan. """
+    logger.info(f"Executing workout edit of {day} for - {item}")
+    return await _edit_plan(person_id, "workout", item, plans,
+                            lambda plan: workout_day_edit(item, model, executor, plan, day))
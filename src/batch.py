@@ -0,0 +1,92 @@
+"""
+Batch generation for backfills. Profiles that normalize to the same prompt are grouped, every unique profile calls
+Bedrock once and its result is shared by the whole group.
+Author: vatsal1306
+"""
+import asyncio
+import json
+from time import perf_counter
+
+from src.admission import Rejected, admitted
+from src.Logging import logger
+from src.Utils import settings
+from src.pipelines import PIPELINES
+from src.plan_store import save_plans
+from src.response_cache import normalize_profile
+
+
+def group_profiles(items: list) -> dict:
+    """ :return: {normalized profile key: [indices of items with that profile]} in first seen order. """
+    groups = {}
+    for index, item in enumerate(items):
+        groups.setdefault(json.dumps(normalize_profile(item), sort_keys=True), []).append(index)
+    return groups
+
+
+def _line(data: dict) -> bytes:
+    return (json.dumps(data) + "\n").encode("utf-8")
+
+
+async def run_batch(items: list, event: str, model, executor, order: str = "input", concurrency: int = None,
+                    plans=None, admission=None):
+    """
+    Yield one NDJSON line per item, `{"index", "id", "success" | "error"}`, in input order or as groups complete,
+    followed by a `summary` line with the throughput. For meals the images of a group are generated for the
+    first person of the group. With a plan store the result of a group is stored for every person of the group.
+    With admission control every group is admitted like a request to `/<event>`, waiting up to
+    `admission_batch_max_wait` seconds for budget, and no more groups run at once than the budget admits.
+    """
+    start = perf_counter()
+    pipeline = PIPELINES[event]
+    groups = group_profiles(items)
+    concurrency = concurrency or int(settings.batch_concurrency)
+    capacity = admission.capacity(f"/{event}") if admission is not None else None
+    if capacity is not None and capacity < concurrency:
+        logger.info(f"Batch of {event} runs {capacity} groups at once, what the admission budget admits")
+        concurrency = capacity
+    limit = asyncio.Semaphore(concurrency)
+    max_wait = float(settings.admission_batch_max_wait)
+
+    async def run_group(indices: list):
+        async with limit:
+            try:
+                async with admitted(admission, f"/{event}", max_wait):
+                    response = await pipeline(items[indices[0]], model, executor)
+            except Rejected as e:
+                response = {"error": str(e)}
+            except Exception as e:
+                logger.exception(e)
+                response = {"error": str(e)}
+        await save_plans(plans, [items[index].id for index in indices], event, response)
+        return indices, response
+
+    def line(index: int, response: dict) -> bytes:
+        return _line({"index": index, "id": items[index].id, **response})
+
+    tasks = [asyncio.create_task(run_group(indices)) for indices in groups.values()]
+    results = [None] * len(items)
+    next_index = 0
+    failed = 0
+    try:
+        for task in asyncio.as_completed(tasks):
+            indices, response = await task
+            failed += 0 if "success" in response else len(indices)
+            if order == "completed":
+                for index in indices:
+                    yield line(index, response)
+                continue
+            for index in indices:
+                results[index] = response
+            while next_index < len(items) and results[next_index] is not None:
+                yield line(next_index, results[next_index])
+                results[next_index] = None
+                next_index += 1
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    elapsed = perf_counter() - start
+    summary = {"plans": len(items), "unique_profiles": len(groups), "failed": failed, "seconds": round(elapsed, 3),
+               "plans_per_minute": round(len(items) / elapsed * 60, 1) if elapsed else None}
+    logger.info(f"Batch {event} done - {summary}")
+    yield _line({"summary": summary})
@@ -0,0 +1,111 @@
+"""
+Async execution layer for the blocking boto3 model calls. Handlers await these instead of calling the model
+directly, so a slow Bedrock call no longer freezes the event loop of the uvicorn worker.
+Author: vatsal1306
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from src import admission
+from src.Logging import logger
+from src.Utils import settings
+
+
+class ModelExecutor:
+    """
+    Runs model calls on a dedicated, bounded thread pool. Text and image calls get separate concurrency limits so
+    a burst of image generation can not starve the cheap text endpoints of pool threads.
+    """
+
+    def __init__(self, text_concurrency: int = None, image_concurrency: int = None, max_workers: int = None):
+        self.text_concurrency = text_concurrency or int(settings.text_concurrency)
+        self.image_concurrency = image_concurrency or int(settings.image_concurrency)
+        max_workers = max_workers or int(settings.executor_workers) or self.text_concurrency + self.image_concurrency
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bedrock")
+        self.text_limit = asyncio.Semaphore(self.text_concurrency)
+        self.image_limit = asyncio.Semaphore(self.image_concurrency)
+        logger.info(f"ModelExecutor initialized with {max_workers} workers, text limit {self.text_concurrency}, "
+                    f"image limit {self.image_concurrency}")
+
+    async def _run(self, limit: asyncio.Semaphore, func, *args, **kwargs):
+        async with limit:
+            loop = asyncio.get_running_loop()
+            # run in a copy of the caller's context so the request id reaches log records written by the call
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self.pool, partial(context.run, func, *args, **kwargs))
+
+    async def text(self, func, *args, **kwargs):
+        """ Run a blocking text generation call, e.g. `LLM.get_text_response`. """
+        return await self._run(self.text_limit, func, *args, **kwargs)
+
+    async def image(self, func, *args, **kwargs):
+        """ Run a blocking image generation call, e.g. `LLM.generate_meal_image`. """
+        return await self._run(self.image_limit, func, *args, **kwargs)
+
+    async def text_stream(self, func, *args, **kwargs):
+        """
+        Iterate a blocking generator, e.g. `LLM.stream_text_response`, on the pool under the text limit and yield
+        its items on the event loop as they arrive.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+
+        def pump():
+            try:
+                for item in func(*args, **kwargs):
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        async with self.text_limit:
+            future = loop.run_in_executor(self.pool, contextvars.copy_context().run, pump)
+            while (item := await queue.get()) is not done:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            await future
+
+    async def generate_image(self, model, data: dict, id: int, on_image=None) -> dict:
+        """
+        Fan the meal images of `data` out over the image limit and merge the results into the plan.
+        Each meal is its own job, so one failed image does not discard the others.
+        `on_image(done, total)` is awaited after every finished image, for progress reporting.
+        """
+        if "success" not in data:
+            return data
+        try:
+            meal_data, jobs = model.image_jobs(data)
+        except Exception as e:
+            logger.exception(f"unknown error while generating image - {e}")
+            return {"error": str(e)}
+        if not admission.images_allowed():
+            # degraded under load or too close to the client deadline: the plan is sent without images
+            logger.warning(f"Skipping {len(jobs)} meal images of {id}")
+            for _, _, meal in jobs:
+                meal['s3_location'] = None
+                meal['image_variants'] = {}
+            data["success"] = meal_data
+            data["degraded"] = True
+            return data
+
+        done = 0
+
+        async def run(day, slot, meal):
+            nonlocal done
+            try:
+                return await self.image(model.generate_meal_image, meal, id, day, slot)
+            finally:
+                done += 1
+                if on_image is not None:
+                    await on_image(done, len(jobs))
+
+        results = await asyncio.gather(*[run(day, slot, meal) for day, slot, meal in jobs], return_exceptions=True)
+        return model.apply_image_results(data, meal_data, jobs, results)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,123 @@
+"""
+Content-addressed cache of generated meal images. The image prompt only depends on the meal name and ingredients
+and the generation config is constant, so identical meals across users can share one set of S3 objects
+(the Titan PNG and its encoded variants).
+Author: vatsal1306
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.Utils import settings
+from src.Utils.utils import Path
+
+
+class ImageCache:
+    """
+    Local LRU index (digest -> {"s3_location", "image_variants"}) in front of a shared S3 prefix. A local miss falls
+    back to `head_object` calls on the shared prefix, so images generated by other workers or hosts are reused as
+    well. An entry only hits when it has every configured variant. The index is persisted to disk so it survives
+    restarts.
+    """
+
+    def __init__(self, s3, bucket: str = None, prefix: str = None, capacity: int = None, index_path: str = None):
+        self.s3 = s3
+        self.bucket = bucket or os.getenv('S3_BUCKET')
+        self.prefix = (prefix or settings.image_cache_prefix).strip("/")
+        self.capacity = capacity or int(settings.image_cache_size)
+        self.index_path = index_path or os.path.join(ROOT_DIR, settings.image_cache_index)
+        self.index = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+        self._load()
+
+    @staticmethod
+    def digest(prompt: str, model_id: str, generation_config: dict) -> str:
+        """ Hash of the normalized prompt, model and generation config. """
+        normalized = re.sub(r"\s+", " ", prompt.strip().lower())
+        payload = json.dumps({"prompt": normalized, "model": model_id, "config": generation_config}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def object_key(self, digest: str) -> str:
+        return f"{self.prefix}/{digest}.png"
+
+    def variant_key(self, digest: str, variant) -> str:
+        return f"{self.prefix}/{digest}/{variant.tag}.{variant.extension}"
+
+    def location(self, key: str) -> str:
+        return f"s3://{self.bucket}/{key}"
+
+    def get(self, digest: str, variants: tuple = ()) -> Optional[dict]:
+        """ :return: {"s3_location", "image_variants"} of the cached image or None on a miss. """
+        with self.lock:
+            entry = self.index.get(digest)
+            if entry is not None and all(v.name in entry["image_variants"] for v in variants):
+                self.index.move_to_end(digest)
+                self.hits += 1
+                return entry
+
+        from botocore.exceptions import ClientError
+
+        keys = {v.name: self.variant_key(digest, v) for v in variants}
+        try:
+            for key in (self.object_key(digest), *keys.values()):
+                self.s3.head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        entry = {"s3_location": self.location(self.object_key(digest)),
+                 "image_variants": {name: self.location(key) for name, key in keys.items()}}
+        with self.lock:
+            self.remote_hits += 1
+        self.put(digest, entry)
+        return entry
+
+    def put(self, digest: str, entry: dict):
+        with self.lock:
+            self.index[digest] = entry
+            self.index.move_to_end(digest)
+            while len(self.index) > self.capacity:
+                self.index.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.remote_hits + self.misses
+            return {"hits": self.hits, "remote_hits": self.remote_hits, "misses": self.misses,
+                    "hit_rate": round((self.hits + self.remote_hits) / lookups, 4) if lookups else 0.0,
+                    "size": len(self.index), "capacity": self.capacity}
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Could not load image cache index {self.index_path} - {e}")
+            return
+        for digest, entry in entries[-self.capacity:]:
+            # indexes written before image variants hold the bare png location
+            self.index[digest] = entry if isinstance(entry, dict) else {"s3_location": entry, "image_variants": {}}
+        logger.info(f"Loaded {len(self.index)} image cache entries")
+
+    def save(self):
+        """ Persist the index, oldest entry first so the LRU order is kept on reload. """
+        Path.create_dir_if_not_exists(os.path.dirname(self.index_path))
+        with self.lock:
+            entries = list(self.index.items())
+        # one temp file per process, the workers of a server all save the shared index on shutdown
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.index_path)
+        logger.info(f"Saved {len(entries)} image cache entries")
@@ -0,0 +1,117 @@
+"""
+Meal image variants. The 512x512 Titan PNG is resized and re-encoded (WebP by default) into the sizes the app shows,
+list thumbnails and detail views, on a process pool so the CPU bound encoding neither holds the GIL of the
+request threads nor blocks the event loop.
+Author: vatsal1306
+"""
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple
+
+from src.Logging import logger
+from src.Utils import settings
+
+# PIL format name and file extension per configurable format
+FORMATS = {"webp": ("WEBP", "webp"), "jpeg": ("JPEG", "jpg"), "png": ("PNG", "png")}
+
+
+class Variant(NamedTuple):
+    name: str
+    format: str
+    size: int
+    quality: int
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.format][1]
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.format}"
+
+    @property
+    def tag(self) -> str:
+        """ Part of the object key, so a changed size or quality never reuses an old object. """
+        return f"{self.name}-{self.size}-q{self.quality}"
+
+
+def parse_variants(spec: str) -> tuple:
+    """ Parse `name:format:size:quality, ...` from config.ini. Raises ValueError on an unknown format. """
+    variants = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, fmt, size, quality = (part.strip() for part in item.split(":"))
+        if fmt.lower() not in FORMATS:
+            raise ValueError(f"unsupported image variant format {fmt}, expected one of {sorted(FORMATS)}")
+        variants.append(Variant(name, fmt.lower(), int(size), int(quality)))
+    return tuple(variants)
+
+
+def encode_variants(image_bytes: bytes, variants: tuple) -> dict:
+    """
+    Resize and encode `image_bytes` into every variant. Runs in the pool processes, so it only takes picklable
+    arguments and imports PIL lazily.
+    :return: {variant name: encoded bytes}
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = image.convert("RGB")
+        encoded = {}
+        # largest first, each smaller variant is resized from the previous one instead of the full image
+        for variant in sorted(variants, key=lambda v: v.size, reverse=True):
+            width, height = image.size
+            if max(width, height) > variant.size:
+                scale = variant.size / max(width, height)
+                image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))),
+                                     Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            options = {"optimize": True} if variant.format == "png" else {"quality": variant.quality}
+            if variant.format == "webp":
+                options["method"] = 4
+            image.save(buffer, FORMATS[variant.format][0], **options)
+            encoded[variant.name] = buffer.getvalue()
+    return encoded
+
+
+class ImageEncoder:
+    """
+    Encodes variants on a pool of `workers` processes, created on first use. `workers = 0` encodes in the calling
+    thread. `encode` blocks the calling image worker thread until its variants are done.
+    """
+
+    def __init__(self, variants: tuple = None, workers: int = None):
+        self.variants = parse_variants(settings.image_variants) if variants is None else variants
+        self.workers = int(settings.image_encode_workers) if workers is None else workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is not None:
+                return self.pool
+            # spawn, forking a process that runs boto3 and event loop threads is not safe
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            logger.info(f"Image encoder started with {self.workers} processes for {len(self.variants)} variants")
+            return self.pool
+
+    def encode(self, image_bytes: bytes) -> dict:
+        if not self.variants:
+            return {}
+        if self.workers <= 0:
+            return encode_variants(image_bytes, self.variants)
+        pool = self._pool()
+        try:
+            return pool.submit(encode_variants, image_bytes, self.variants).result()
+        except BrokenProcessPool:
+            # a crashed worker breaks the whole pool, the next call starts a new one
+            with self.lock:
+                if self.pool is pool:
+                    self.pool = None
+            raise
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,204 @@
+"""
+Background job mode for the long running `/meal` pipeline. Jobs are stored in a local SQLite file, so they survive a
+restart and can be claimed by the workers of several uvicorn processes on the same host.
+Author: vatsal1306
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from time import time
+from typing import Optional
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.plan_store import save_plan
+from src.Utils import settings
+from src.Utils.utils import Path, Person, adjust_format
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobStore:
+    """
+    Durable job queue. A job is claimed with a lease, a worker that dies leaves its job to be claimed again once
+    the lease expires. Claiming runs in an immediate transaction so concurrent processes never share a job.
+    """
+
+    def __init__(self, path: str = None, max_depth: int = None, lease: float = None):
+        self.path = path or os.path.join(ROOT_DIR, settings.job_store)
+        self.max_depth = max_depth or int(settings.job_queue_depth)
+        self.lease = lease or float(settings.job_lease)
+        Path.create_dir_if_not_exists(os.path.dirname(self.path))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, payload TEXT, "
+                          "status TEXT, progress TEXT, result TEXT, error TEXT, attempts INTEGER DEFAULT 0, "
+                          "worker TEXT, lease_until REAL, created REAL, updated REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created)")
+
+    def enqueue(self, kind: str, payload: dict) -> str:
+        job_id = uuid.uuid4().hex
+        now = time()
+        with self.lock:
+            queued = self.conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_depth:
+                raise QueueFullError(f"Job queue is full ({queued} queued).")
+            self.conn.execute("INSERT INTO jobs (id, kind, payload, status, progress, created, updated) "
+                              "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                              (job_id, kind, json.dumps(payload), json.dumps({"stage": "queued"}), now, now))
+        return job_id
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """ Claim the oldest queued job, or a running job whose lease expired. `attempts` counts this claim. """
+        now = time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT * FROM jobs WHERE status = 'queued' OR "
+                                        "(status = 'running' AND lease_until < ?) ORDER BY created LIMIT 1",
+                                        (now,)).fetchone()
+                if row is not None:
+                    self.conn.execute("UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, "
+                                      "attempts = attempts + 1, updated = ? WHERE id = ?",
+                                      (worker, now + self.lease, now, row["id"]))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = self._to_dict(row)
+        job["attempts"] += 1
+        return job
+
+    def update(self, job_id: str, progress: dict, result: dict = None):
+        """ Record progress and a partial result, renewing the lease. """
+        now = time()
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET progress = ?, result = COALESCE(?, result), lease_until = ?, "
+                              "updated = ? WHERE id = ?",
+                              (json.dumps(progress), json.dumps(result) if result is not None else None,
+                               now + self.lease, now, job_id))
+
+    def finish(self, job_id: str, result: dict):
+        status = "done" if "success" in result else "failed"
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET status = ?, result = ?, error = ?, lease_until = NULL, updated = ? "
+                              "WHERE id = ?", (status, json.dumps(result), result.get("error"), time(), job_id))
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        return {"id": row["id"], "kind": row["kind"], "payload": json.loads(row["payload"]), "status": row["status"],
+                "progress": json.loads(row["progress"]) if row["progress"] else None,
+                "result": json.loads(row["result"]) if row["result"] else None, "error": row["error"],
+                "attempts": row["attempts"], "created": row["created"], "updated": row["updated"]}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class JobRunner:
+    """ Pool of asyncio workers pulling jobs from the store and running them through the model executor. """
+
+    def __init__(self, store: JobStore, model, executor, workers: int = None, poll_interval: float = None,
+                 plans=None):
+        self.store = store
+        self.model = model
+        self.executor = executor
+        self.plans = plans
+        self.workers = workers if workers is not None else int(settings.job_workers)
+        self.poll_interval = poll_interval or float(settings.job_poll_interval)
+        self.max_attempts = int(settings.job_max_attempts)
+        self.tasks = []
+        self.started = False
+
+    def start(self):
+        prefix = f"{os.getpid()}-"
+        self.tasks = [asyncio.create_task(self._work(f"{prefix}{i}")) for i in range(self.workers)]
+        self.started = True
+        logger.info(f"Started {self.workers} job workers")
+
+    async def stop(self):
+        self.started = False
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _work(self, worker: str):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.store.claim, worker)
+            except Exception as e:
+                logger.exception(f"Job worker {worker} could not claim a job - {e}")
+                job = None
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            if job["attempts"] > self.max_attempts:
+                attempts = job["attempts"] - 1
+                logger.error(f"Job {job['id']} abandoned after {attempts} attempts")
+                await asyncio.to_thread(self.store.finish, job["id"],
+                                        {"error": f"job abandoned after {attempts} attempts."})
+                continue
+
+            logger.info(f"Job worker {worker} running {job['kind']} job {job['id']}")
+            try:
+                result = await self._run_meal(job)
+            except Exception as e:
+                logger.exception(e)
+                result = {"error": str(e)}
+            await asyncio.to_thread(self.store.finish, job["id"], result)
+
+    async def _run_meal(self, job: dict) -> dict:
+        item = Person(**job["payload"])
+        job_id = job["id"]
+        await asyncio.to_thread(self.store.update, job_id, {"stage": "text"})
+        response = await self.executor.text(self.model.get_text_response, item, "meal")
+        if "success" not in response:
+            return response
+
+        total = sum(len(meals) for meals in response["success"].values())
+        await asyncio.to_thread(self.store.update, job_id, {"stage": "images", "images_done": 0,
+                                                            "images_total": total}, response)
+
+        async def on_image(done: int, total: int):
+            await asyncio.to_thread(self.store.update, job_id, {"stage": "images", "images_done": done,
+                                                                "images_total": total})
+
+        response = await self.executor.generate_image(self.model, response, item.id, on_image=on_image)
+        if "success" not in response:
+            return response
+        response = adjust_format(response)
+        await save_plan(self.plans, item.id, "meal", response)
+        return response
+
+
+async def wait_for_job(store: JobStore, job_id: str, wait: float) -> Optional[dict]:
+    """ Long poll: return as soon as the job changes or finishes, at the latest after `wait` seconds. """
+    job = await asyncio.to_thread(store.get, job_id)
+    deadline = time() + wait
+    while job is not None and job["status"] in ("queued", "running") and time() < deadline:
+        await asyncio.sleep(min(0.25, max(deadline - time(), 0)))
+        latest = await asyncio.to_thread(store.get, job_id)
+        if latest["updated"] != job["updated"]:
+            return latest
+        job = latest
+    return job
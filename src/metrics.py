@@ -0,0 +1,227 @@
+"""
+In-process metrics in the Prometheus text format, served at `/metrics`. Recording is a dict lookup and an increment
+under a per-metric lock, cheap enough to stay on in production.
+Author: vatsal1306
+"""
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            items = [(key, (list(series[0]), series[1], series[2])) for key, series in self.values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class _Callback(_Metric):
+    """ Metric whose samples are read at scrape time, e.g. the cache counters kept by the caches themselves. """
+
+    def __init__(self, name: str, help: str, type: str, labelnames: tuple, func: Callable[[], dict]):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.func = func
+
+    def render(self) -> list:
+        self.values = self.func()
+        return super().render()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric: _Metric) -> _Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: tuple = ()) -> Gauge:
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name: str, help: str, type: str, labelnames: tuple, func: Callable[[], dict]):
+        """ `func` returns {label values tuple: value}. Registering the same name again replaces it. """
+        return self._add(_Callback(name, help, type, labelnames, func))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram("fitness_stage_seconds", "Duration of a pipeline stage in seconds.",
+                                   ("stage", "event", "model"))
+tokens_total = registry.counter("fitness_tokens_total", "Bedrock tokens by direction.", ("event", "model", "direction"))
+errors_total = registry.counter("fitness_errors_total", "Failed pipeline stages.", ("stage", "event"))
+requests_in_flight = registry.gauge("fitness_http_requests_in_flight", "HTTP requests currently being served.")
+requests_total = registry.counter("fitness_http_requests_total", "Served HTTP requests.", ("path", "status"))
+prompt_tokens = registry.histogram("fitness_prompt_tokens_estimated", "Estimated input tokens of a rendered prompt.",
+                                   ("event",), TOKEN_BUCKETS)
+truncated_total = registry.counter("fitness_truncated_responses_total", "Responses cut off at maxTokens.", ("event",))
+similarity_lookups_total = registry.counter("fitness_similarity_lookups_total",
+                                            "Similarity index lookups by result (exact, similar, miss, unparsed).",
+                                            ("event", "result"))
+routed_total = registry.counter("fitness_routed_calls_total", "Text model calls by routed model.",
+                                ("event", "model", "reason"))
+hedges_total = registry.counter("fitness_hedged_calls_total", "Hedged text model calls by outcome.", ("event", "outcome"))
+breaker_state = registry.gauge("fitness_breaker_state", "Circuit breaker state, 0 closed, 1 half open, 2 open.",
+                               ("model",))
+breaker_transitions_total = registry.counter("fitness_breaker_transitions_total", "Circuit breaker state changes.",
+                                             ("model", "state"))
+concurrency_limit = registry.gauge("fitness_concurrency_limit", "Adaptive Bedrock concurrency limit.", ("kind",))
+rate_in_flight = registry.gauge("fitness_rate_controlled_in_flight", "Bedrock calls holding a concurrency slot.",
+                                ("kind",))
+throttles_total = registry.counter("fitness_throttles_total", "Throttled Bedrock calls.", ("kind", "code"))
+retries_total = registry.counter("fitness_retries_total", "Retried Bedrock calls.", ("kind", "code"))
+rate_wait_seconds = registry.counter("fitness_rate_wait_seconds_total", "Seconds spent waiting for the token bucket.",
+                                     ("kind",))
+request_seconds = registry.histogram("fitness_http_request_seconds", "HTTP request duration in seconds.", ("path",))
+admission_total = registry.counter("fitness_admission_total", "Admission decisions by route and result.",
+                                   ("route", "result"))
+admission_in_flight_cost = registry.gauge("fitness_admission_in_flight_cost",
+                                          "Cost of the admitted requests in flight.")
+admission_wait_seconds = registry.histogram("fitness_admission_wait_seconds", "Time requests waited for budget.",
+                                            ("route",))
+
+
+def record_usage(usage: dict, event: str, model: str):
+    if not usage:
+        return
+    tokens_total.inc(usage.get("inputTokens", 0), event=event, model=model, direction="input")
+    tokens_total.inc(usage.get("outputTokens", 0), event=event, model=model, direction="output")
+
+
+class MetricsMiddleware:
+    """ ASGI middleware counting in-flight requests, status codes and latency per route template. """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        requests_in_flight.inc()
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            requests_in_flight.dec()
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            request_seconds.observe(perf_counter() - start, path=path)
+            requests_total.inc(path=path, status=status)
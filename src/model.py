@@ -3,214 +3,353 @@ This file creates boto3 session for bedrock and makes model calls as per prompts
 Author: vatsal1306
 """
 import base64
-import io
 import json
 import os
-import sys
-from ast import literal_eval
+from time import perf_counter
 
-import boto3
-from PIL import Image
-from botocore.exceptions import ClientError
-from dotenv import load_dotenv
-
-from src import ROOT_DIR
+from src import ROOT_DIR, metrics, parsing
 from src.Logging import logger
+from src.image_cache import ImageCache
+from src.image_variants import ImageEncoder
+from src.prompts import PromptCompiler, estimate_tokens, workout_summary
+from src.response_cache import ResponseCache, cache_key
+from src.rate_control import RateController, error_code
+from src.routing import ModelRouter
 from src.Utils import settings
-from src.Utils.utils import Person, Response
-
-env = load_dotenv(dotenv_path=os.path.join(ROOT_DIR, '.env'), verbose=True)
-assert env == True
-
-workout_plan = {}
-with open(os.path.join(ROOT_DIR, 'sample_workout_plan.json')) as f:
-    workout_plan = json.load(f)
-logger.info("Loaded sample workout plan")
-
-mealplan = {}
-with open(os.path.join(ROOT_DIR, "sample_meal_plan.json"), 'r') as f:
-    mealplan = json.load(f)
-logger.info("Loaded sample meal plan")
-
-water_plan = {}
-with open(os.path.join(ROOT_DIR, "sample_water_intake.json"), 'r') as f:
-    water_plan = json.load(f)
-logger.info("Loaded sample water intake")
-
-days = {}
-with open(os.path.join(ROOT_DIR, "sample_days.json"), 'r') as f:
-    days = json.load(f)
-logger.info("Loaded sample days")
-
-
-class FileReader:
-    def __init__(self):
-        self.workout_up = self._read_file(os.path.join(ROOT_DIR, "prompts", "workout_usr_prompt.txt"))
-        self.workout_sp = self._read_file(os.path.join(ROOT_DIR, "prompts", "workout_system_prompt.txt"))
-        self.diet_up = self._read_file(os.path.join(ROOT_DIR, "prompts", "diet_usr_prompt.txt"))
-        self.diet_sp = self._read_file(os.path.join(ROOT_DIR, "prompts", "diet_system_prompt.txt"))
-        self.water_sp = self._read_file(os.path.join(ROOT_DIR, "prompts", "water_system_prompt.txt"))
-        self.water_up = self._read_file(os.path.join(ROOT_DIR, "prompts", "water_usr_prompt.txt"))
-        self.days_sp = self._read_file(os.path.join(ROOT_DIR, "prompts", "days_system_prompt.txt"))
-        self.days_up = self._read_file(os.path.join(ROOT_DIR, "prompts", "days_usr_prompt.txt"))
-
-    def _read_file(self, filepath: str) -> str:
-        if os.path.exists(filepath):
-            with open(filepath, "r", encoding="utf-8") as f:
-                return f.read()
-        else:
-            logger.error(f"File {filepath} not found.")
-            sys.exit(1)
+from src.Utils.utils import Person, Response, is_complete
+
 
+class LLM:
+    """
+    Class for interacting with Bedrock. A single instance is created in the FastAPI lifespan and shared by all
+    requests, so it must not hold per-request state. Clients can be injected for benchmarks.
+    """
 
-# @Wrappers.singleton
-class LLM(FileReader):
-    """ Class for interacting with Bedrock."""
+    def __init__(self, client=None, s3=None):
+        self.prompts = PromptCompiler()
+        self.text_rate = RateController("text", int(settings.text_concurrency))
+        self.image_rate = RateController("image", int(settings.image_concurrency))
+        self.router = ModelRouter(rate=self.text_rate)
+        if client is None or s3 is None:
+            from botocore.config import Config
 
-    def __init__(self):
-        FileReader.__init__(self)
-        self.client = self._get_bedrock_client()
-        self.s3 = self._get_s3_client()
+            session = self._get_boto3_session()
+            client_config = Config(max_pool_connections=int(settings.max_pool_connections))
+        self.client = client if client is not None else self._get_bedrock_client(session, client_config)
+        self.s3 = s3 if s3 is not None else self._get_s3_client(session, client_config)
         self.text_model = settings.text_model
         self.image_model = settings.image_model
         self.temperature = float(settings.temperature)
         self.top_p = float(settings.top_p)
-        self.max_tokens = int(settings.max_tokens)
+        self.image_config = {"numberOfImages": 1, "height": 512, "width": 512, "cfgScale": 8.0, "seed": 0}
+        self.encoder = ImageEncoder()
+        self.image_cache = ImageCache(self.s3) if settings.image_cache_enabled.lower() == "true" else None
+        self.response_cache = ResponseCache.from_settings() if settings.response_cache_enabled.lower() == "true" \
+            else None
+        self.similarity = None
+        if self.response_cache is not None and settings.similarity_enabled.lower() == "true":
+            # numpy is only imported with the index, at startup and not on `import src.app`
+            from src.similarity import SimilarityIndex
+
+            self.similarity = SimilarityIndex.from_settings()
         logger.info("LLM class initialized")
 
+    def close(self):
+        self.router.shutdown()
+        self.encoder.shutdown()
+        if self.image_cache is not None:
+            self.image_cache.save()
+        if self.response_cache is not None:
+            self.response_cache.close()
+
+    @staticmethod
+    def _get_boto3_session():
+        # boto3 takes longer to import than the rest of the app, it is only needed once the clients are built
+        import boto3
+
+        return boto3.Session(aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                             aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'), )
+
     @staticmethod
-    def _get_s3_client():
-        boto3_session = boto3.Session(aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                                      aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'), )
-        return boto3_session.client('s3', region_name=os.getenv('AWS_REGION'))
+    def _get_s3_client(boto3_session, client_config):
+        return boto3_session.client('s3', region_name=os.getenv('AWS_REGION'), config=client_config)
 
     @staticmethod
-    def _get_bedrock_client():
+    def _get_bedrock_client(boto3_session, client_config):
         """
-        Initialize Bedrock client using boto3. AWS keys are fetched from .env file
+        Initialize Bedrock client using boto3. AWS keys are fetched from .env file.
+        boto3 clients are thread-safe, so one pooled client serves every request.
+        botocore retries are disabled, `RateController` retries throttled calls and adapts the concurrency instead.
         :return: botocore.client.BedrockRuntime
         """
-        boto3_session = boto3.Session(aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                                      aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'), )
-        return boto3_session.client('bedrock-runtime', region_name=os.getenv('AWS_REGION'))
+        from botocore.config import Config
+
+        client_config = client_config.merge(Config(retries={"total_max_attempts": 1}))
+        return boto3_session.client('bedrock-runtime', region_name=os.getenv('AWS_REGION'), config=client_config)
 
-    def generate_image(self, data: Response, id: int) -> Response:
+    @staticmethod
+    def image_jobs(data: Response) -> tuple:
+        """
+        Split a meal plan response into one image job per meal.
+        :return: (meal_data, [(day, slot, meal), ...])
+        """
         meal_data = data.get("success")
         if isinstance(meal_data, str):
-            try:
-                meal_data = json.loads(meal_data)
-            except SyntaxError:
-                meal_data = literal_eval(meal_data)
+            meal_data = parsing.loads(meal_data)
+        jobs = [(day, slot, meal) for day, meals in meal_data.items() for slot, meal in meals.items()]
+        return meal_data, jobs
 
+    def generate_meal_image(self, meal: dict, id: int, day: str, slot: str) -> dict:
+        """
+        Generate the image of a single meal with Titan, encode its variants and upload the PNG and every variant.
+        With the image cache enabled, identical meals resolve to one shared set of objects and skip Titan entirely.
+        Raises on failure, the caller decides how a failed image affects the plan. A failed variant encoding only
+        leaves the variants out.
+        :return: {"s3_location": png location, "image_variants": {variant name: location}}
+        """
+        img_prompt = f"Generate an image of meal({meal['name']}) ingredients({', '.join(meal['ingredients'])})."
+        variants = self.encoder.variants
+        digest = None
+        if self.image_cache is not None:
+            digest = self.image_cache.digest(img_prompt, self.image_model, self.image_config)
+            entry = self.image_cache.get(digest, variants)
+            if entry is not None:
+                return entry
+
+        logger.info(f"Image prompt - {img_prompt}", extra={"payload": True})
+        img_body = json.dumps({"taskType": "TEXT_IMAGE", "textToImageParams": {"text": img_prompt},
+                               "imageGenerationConfig": self.image_config})
+        content_type = "application/json"
         try:
-            for key, val in meal_data.items():
-                for k, v in val.items():
-                    img_prompt = f"Generate an image of meal({v['name']}) ingredients({', '.join(v['ingredients'])})."
-                    logger.info(f"Image prompt - {img_prompt}")
-                    img_body = json.dumps({"taskType": "TEXT_IMAGE", "textToImageParams": {"text": img_prompt},
-                                           "imageGenerationConfig": {"numberOfImages": 1, "height": 512, "width": 512,
-                                                                     "cfgScale": 8.0, "seed": 0}})
-                    content_type = "application/json"
-                    try:
-                        response = self.client.invoke_model(body=img_body, modelId=self.image_model,
-                                                            accept=content_type,
-                                                            contentType=content_type)
-                    except ClientError as e:
-                        logger.error(f"Error while invoke model for image - {e}")
-                        return {"error": str(e)}
-                    except Exception as e:
-                        logger.error(f"unknown error while invoke model for image - {e}")
-                        return {"error": str(e)}
-
-                    response = json.loads(response.get("body").read())
-                    base64_image = response.get("images")[0]
-                    base64_bytes = base64_image.encode('ascii')
-                    image_bytes = base64.b64decode(base64_bytes)
-                    finish_reason = response.get("error")
-                    img_buffer = io.BytesIO(image_bytes)
-                    img = Image.open(img_buffer)
-                    img.save('test.png')
-                    self.s3.upload_file('test.png', os.getenv('S3_BUCKET'), f"{id}/{key}/{k}.png")
-                    # s3: // forge - meal - image / test.png
-                    v['s3_location'] = f"s3://{os.getenv('S3_BUCKET')}/{id}/{key}/{k}.png"
+            with metrics.stage_seconds.time(stage="titan", event="image", model=self.image_model):
+                response = self.image_rate.call(self.client.invoke_model, body=img_body, modelId=self.image_model,
+                                                accept=content_type, contentType=content_type)
+                response = json.loads(response.get("body").read())
+            if response.get("error"):
+                raise RuntimeError(f"Titan could not generate image - {response['error']}")
+        except Exception:
+            metrics.errors_total.inc(stage="titan", event="image")
+            raise
+
+        image_bytes = base64.b64decode(response.get("images")[0])
+        encoded = {}
+        try:
+            with metrics.stage_seconds.time(stage="encode", event="image", model=self.image_model):
+                encoded = self.encoder.encode(image_bytes)
         except Exception as e:
-            logger.exception(f"unknown error while generating image - {e}")
-            return {"error": str(e)}
+            metrics.errors_total.inc(stage="encode", event="image")
+            logger.exception(f"Could not encode image variants for {day}/{slot} - {e}")
+
+        bucket = os.getenv('S3_BUCKET')
+        key = self.image_cache.object_key(digest) if digest else f"{id}/{day}/{slot}.png"
+        uploads = [(key, image_bytes, "image/png", None)]
+        for variant in variants:
+            if variant.name in encoded:
+                variant_key = self.image_cache.variant_key(digest, variant) if digest \
+                    else f"{id}/{day}/{slot}/{variant.tag}.{variant.extension}"
+                uploads.append((variant_key, encoded[variant.name], variant.content_type, variant.name))
+        entry = {"s3_location": None, "image_variants": {}}
+        try:
+            with metrics.stage_seconds.time(stage="s3_upload", event="image", model=self.image_model):
+                for upload_key, body, upload_type, name in uploads:
+                    self.s3.put_object(Bucket=bucket, Key=upload_key, Body=body, ContentType=upload_type)
+                    if name is None:
+                        entry["s3_location"] = f"s3://{bucket}/{upload_key}"
+                    else:
+                        entry["image_variants"][name] = f"s3://{bucket}/{upload_key}"
+        except Exception:
+            metrics.errors_total.inc(stage="s3_upload", event="image")
+            raise
+        if digest and len(encoded) == len(variants):
+            self.image_cache.put(digest, entry)
+        return entry
+
+    @staticmethod
+    def apply_image_results(data: Response, meal_data: dict, jobs: list, results: list) -> Response:
+        """
+        Record the outcome of every image job on its meal: `s3_location` of the PNG and `image_variants` with the
+        location of every encoded variant. A failed image leaves both empty and stores `image_error` on that meal
+        only, unless `image_error_policy = fail` in config.ini.
+        """
+        failed = 0
+        for (day, slot, meal), result in zip(jobs, results):
+            if isinstance(result, BaseException):
+                failed += 1
+                logger.error(f"Image generation failed for {day}/{slot} - {result}")
+                meal['s3_location'] = None
+                meal['image_variants'] = {}
+                meal['image_error'] = str(result)
+            else:
+                meal['s3_location'] = result["s3_location"]
+                meal['image_variants'] = result["image_variants"]
+
+        if failed and settings.image_error_policy == "fail":
+            return {"error": f"Image generation failed for {failed} of {len(jobs)} meals."}
 
         data["success"] = meal_data
         return data
 
-    def _data_validation(self, resp: str) -> Response:
-        try:
-            resp_dict = literal_eval(resp)
-            resp_dict = {"success": resp_dict}
-        except SyntaxError:
-            try:
-                resp_dict = json.loads(resp)
-                resp_dict = {"success": resp_dict}
-            except SyntaxError as e:
-                err_msg = f"Bedrock response is not in json, got - {e}"
-                logger.error(err_msg)
-                resp_dict = {"error": err_msg}
-        except Exception as e:
-            logger.exception(str(e))
-            resp_dict = {"error": str(e)}
+    def _build_messages(self, data: Person, event: str, workout_details: str = None, context: tuple = ()) -> tuple:
+        usr_data = f"Age={data.age}, Gender={data.gender}, Height={data.height}, Weight={data.weight}, current bodytype={data.current_body_type}, target bodytype={data.target_body_type}, diet preference={data.diet_preference}, Allergy={data.allergens}"
+        prompt = self.prompts[event]
+        if event == "days":
+            usr_prompt = prompt.template.render(usr_data, workout_summary(workout_details))
+        else:
+            usr_prompt = prompt.template.render(usr_data, *context)
+        system_msg = [{"text": prompt.system}]
+        usr_message = [{"role": "user", "content": [{"text": usr_prompt}]}]
+        metrics.prompt_tokens.observe(estimate_tokens(prompt.system) + estimate_tokens(usr_prompt), event=event)
+        logger.info(f"{event.capitalize()} prompt - {usr_prompt}", extra={"payload": True})
+        return system_msg, usr_message
 
-        return resp_dict
+    def _inference_config(self, event: str) -> dict:
+        return {"temperature": self.temperature, "topP": self.top_p, "maxTokens": self.prompts[event].max_tokens}
 
-    def get_text_response(self, data: Person, event: str, workout_details: str = None) -> Response:
-        usr_data = f"Age={data.age}, Gender={data.gender}, Height={data.height}, Weight={data.weight}, current bodytype={data.current_body_type}, target bodytype={data.target_body_type}, diet preference={data.diet_preference}, Allergy={data.allergens}"
-        match event:
-            case "workout":
-                system_msg = [{"text": self.workout_sp}]
-                self.workout_up = self.workout_up.format(usr_data, workout_plan)
-                usr_message = [{"role": "user", "content": [{"text": self.workout_up}]}]
-                logger.info(f"Workout prompt - {self.workout_up}")
-            case "meal":
-                system_msg = [{"text": self.diet_sp}]
-                self.diet_up = self.diet_up.format(usr_data, mealplan)
-                usr_message = [{"role": "user", "content": [{"text": self.diet_up}]}]
-                logger.info(f"Meal prompt - {self.diet_up}")
-            case "water":
-                system_msg = [{"text": self.water_sp}]
-                self.water_up = self.water_up.format(usr_data, water_plan)
-                usr_message = [{"role": "user", "content": [{"text": self.water_up}]}]
-                logger.info(f"Water prompt - {self.water_up}")
-            case "days":
-                system_msg = [{"text": self.days_sp}]
-                self.days_up = self.days_up.format(usr_data, workout_details, days)
-                usr_message = [{"role": "user", "content": [{"text": self.days_up}]}]
-                logger.info(f"Days prompt - {self.days_up}")
-            case _:
-                logger.exception(f"{event} is not a valid case.")
-                return {"error": f"TypeError: got invalid case [{event}]. Expected [workout, meal]."}
+    def get_text_response(self, data: Person, event: str, workout_details: str = None,
+                          context: tuple = ()) -> Response:
+        """ `context` fills the remaining fields of the scoped prompts (meal_day, meal_slot, workout_day). """
+        if event not in self.prompts:
+            logger.exception(f"{event} is not a valid case.")
+            return {"error": f"TypeError: got invalid case [{event}]. Expected [{', '.join(self.prompts.prompts)}]."}
+
+        with metrics.stage_seconds.time(stage="prompt_build", event=event, model=self.router.model_for(event)):
+            system_msg, usr_message = self._build_messages(data, event, workout_details, context)
+        inference_config = self._inference_config(event)
+
+        if self.response_cache is None:
+            return self._converse(event, usr_message, system_msg, inference_config)[0]
+        extra = workout_details or list(context) or None
+        if extra is None:
+            similar = self._similar(event, data, inference_config)
+            if similar is not None:
+                return similar
+        model_id = self.router.model_for(event)
+        key = cache_key(event, data, model_id, inference_config, extra)
+        answered = []
+
+        def compute() -> Response:
+            response, answered_by = self._converse(event, usr_message, system_msg, inference_config)
+            answered.append(answered_by)
+            return response
+
+        # an answer of the fallback model (hedge won, breaker open) is served but not cached under `model_id`
+        response = self.response_cache.get_or_compute(
+            key, compute, lambda response: is_complete(response) and answered == [model_id])
+        if extra is None and self.similarity is not None and is_complete(response) and answered in ([], [model_id]):
+            self.similarity.add(event, data, model_id, inference_config, key)
+        return response
+
+    def _similar(self, event: str, data: Person, inference_config: dict):
+        """ Cached response of the nearest indexed profile within the similarity threshold, None on a miss. """
+        if self.similarity is None:
+            return None
+        model_id = self.router.model_for(event)
+        key = self.similarity.lookup(event, data, model_id, inference_config)
+        if key is None:
+            return None
+        cached = self.response_cache.get(key)
+        if cached is None:
+            self.similarity.discard(event, data, model_id, inference_config, key)
+        return cached
 
+    def stream_text_response(self, data: Person, event: str):
+        """
+        Generator of the text deltas of `converse_stream`, for the streaming endpoints. A cached response is
+        replayed as a single chunk. Raises on Bedrock errors, there is no partial response to return them in.
+        Streams are routed and feed the circuit breaker but are not hedged.
+        """
+        if event not in self.prompts:
+            raise ValueError(f"got invalid case [{event}]. Expected [workout, meal, water].")
+
+        with metrics.stage_seconds.time(stage="prompt_build", event=event, model=self.router.model_for(event)):
+            system_msg, usr_message = self._build_messages(data, event)
+        inference_config = self._inference_config(event)
+        key = None
+        if self.response_cache is not None:
+            key = cache_key(event, data, self.router.model_for(event), inference_config, None)
+            cached = self._similar(event, data, inference_config) or self.response_cache.get(key)
+            if cached is not None:
+                yield json.dumps(cached["success"])
+                return
+
+        model_id = self.router.choose(event)
+        start = perf_counter()
+        ok = False
+        truncated = False
         try:
-            response = self.client.converse(modelId=self.text_model, messages=usr_message, system=system_msg,
-                                            inferenceConfig={"temperature": self.temperature,
-                                                             "topP": self.top_p})
-        except ClientError as e:
-            logger.exception(e)
-            return {"error": str(e)}
+            # only opening the stream is rate controlled and retried, chunks are not resent
+            response = self.text_rate.call(self.client.converse_stream, modelId=model_id, messages=usr_message,
+                                           system=system_msg, inferenceConfig=inference_config)
+            chunks = []
+            for stream_event in response["stream"]:
+                if "contentBlockDelta" in stream_event:
+                    text = stream_event["contentBlockDelta"]["delta"].get("text", "")
+                    chunks.append(text)
+                    yield text
+                elif "messageStop" in stream_event:
+                    truncated = self._check_stop_reason(stream_event["messageStop"].get("stopReason"), event)
+                elif "metadata" in stream_event:
+                    usage = stream_event['metadata'].get('usage')
+                    metrics.record_usage(usage, event, model_id)
+                    logger.info(f"Response streamed successfully - {usage}")
+            ok = True
+        except Exception:
+            metrics.errors_total.inc(stage="converse_stream", event=event)
+            raise
+        finally:
+            seconds = perf_counter() - start
+            self.router.record(model_id, event, ok, seconds)
+            metrics.stage_seconds.observe(seconds, stage="converse_stream", event=event, model=model_id)
+
+        # like `get_text_response`, a stream of the fallback model is not cached under the routed model
+        if key is not None and not truncated and model_id == self.router.model_for(event):
+            text = "".join(chunks)
+            logger.info(f"Response: {text}", extra={"payload": True})
+            with metrics.stage_seconds.time(stage="parse", event=event, model=model_id):
+                parsed = parsing.parse_model_output(text, event)
+            if "success" in parsed:
+                self.response_cache.put(key, parsed)
+                if self.similarity is not None:
+                    self.similarity.add(event, data, model_id, inference_config, key)
 
+    @staticmethod
+    def _check_stop_reason(stop_reason: str, event: str) -> bool:
+        """ :return: True when the answer was cut off at maxTokens """
+        if stop_reason == "max_tokens":
+            metrics.truncated_total.inc(event=event)
+            logger.warning(f"{event} response was cut off at maxTokens, raise max_tokens_{event} in config.ini")
+            return True
+        return False
+
+    def _converse(self, event: str, usr_message: list, system_msg: list, inference_config: dict) -> tuple:
+        """ :return: (response, id of the model that answered, None when no call succeeded) """
+        try:
+            response, model_id = self.router.converse(self.client, event, messages=usr_message, system=system_msg,
+                                                      inferenceConfig=inference_config)
         except Exception as err:
-            logger.exception(f"unknown exception occurred: {err}")
-            return {"error": str(err)}
+            metrics.errors_total.inc(stage="converse", event=event)
+            logger.exception(err if error_code(err) else f"unknown exception occurred: {err}")
+            return {"error": str(err)}, None
 
         if response["ResponseMetadata"]['HTTPStatusCode'] != 200:
+            metrics.errors_total.inc(stage="converse", event=event)
             err_msg = f"Bedrock HTTP response is not success - {response}"
             logger.error(err_msg)
-            return {"error": err_msg}
+            return {"error": err_msg}, model_id
 
-        logger.info(f"Response fetched successfully - {response['usage']}")
+        metrics.record_usage(response.get('usage'), event, model_id)
+        logger.info(f"Response fetched successfully from {model_id} - {response['usage']}")
+        truncated = self._check_stop_reason(response.get("stopReason"), event)
         response = response["output"]["message"]["content"][0]["text"]
-        response = response.replace("```", "")
-        response = response.replace("json", "", 1)
-        logger.info(f"Response: {response}")
-
-        response = self._data_validation(response)
-
-        return response
+        logger.info(f"Response: {response}", extra={"payload": True})
+        with metrics.stage_seconds.time(stage="parse", event=event, model=model_id):
+            response = parsing.parse_model_output(response, event)
+        if "success" not in response:
+            metrics.errors_total.inc(stage="parse", event=event)
+        elif truncated:
+            # the repaired plan is served, but not cached or stored
+            response["truncated"] = True
+        return response, model_id
 
 # obj = LLM()
 # data = Test(age=25, gender="male", height=170, weight=84, current_body_type="fat", target_body_type="cutting",
@@ -0,0 +1,192 @@
+"""
+Parsing stage for model output: find the json span in the model text, decode it with the json module, repair
+common truncation and trailing comma errors and optionally validate it against the pydantic plan models.
+Author: vatsal1306
+"""
+import json
+from ast import literal_eval
+from typing import Optional
+
+from pydantic import BaseModel, ValidationError
+
+from src.Logging import logger
+from src.Utils import settings
+from src.Utils.utils import DailyMeal, DailyWorkout, Meal, Response, WeeklyMeal, WorkoutPlan
+
+SCHEMAS = {"meal": WeeklyMeal, "workout": WorkoutPlan, "meal_day": DailyMeal, "meal_slot": Meal,
+           "workout_day": DailyWorkout}
+
+_CLOSERS = {"{": "}", "[": "]"}
+_decoder = json.JSONDecoder()
+
+
+def _span_end(text: str, start: int) -> Optional[int]:
+    """ :return: the position after the closer matching the `{`/`[` at `start`, None when the value is truncated. """
+    depth, in_string, escape = 0, False, False
+    for pos in range(start, len(text)):
+        char = text[pos]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+    return None
+
+
+def _json_start(text: str, pos: int = 0) -> int:
+    """ :return: position of the first `{`/`[` at or after `pos`, -1 when there is none. """
+    return min((i for i in (text.find("{", pos), text.find("[", pos)) if i != -1), default=-1)
+
+
+def extract_json(text: str) -> str:
+    """
+    :return: the text from the first `{`/`[` up to its matching closer, or to the end when the value is
+        truncated. Code fences, a "json" tag and any prose around the value are dropped.
+    """
+    start = _json_start(text)
+    if start == -1:
+        raise ValueError("no json object found in model output.")
+    return text[start:_span_end(text, start)]
+
+
+def repair_json(text: str) -> str:
+    """
+    Lightweight repair of an extracted json span: drops trailing commas and, for a truncated value, cuts back to
+    the last complete member and closes the open containers.
+    """
+    out = []
+    stack = []
+    in_string, escape = False, False
+    safe_len, safe_stack = None, None
+    for char in text:
+        if in_string:
+            out.append(char)
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append(char)
+        elif char in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if not stack:
+                break
+            stack.pop()
+            out.append(char)
+            safe_len, safe_stack = len(out), list(stack)
+            if not stack:
+                break
+            continue
+        elif char == ",":
+            safe_len, safe_stack = len(out), list(stack)
+        out.append(char)
+
+    if stack or in_string:
+        if safe_len is None:
+            raise ValueError("model output is truncated before the first complete member.")
+        out, stack = out[:safe_len], safe_stack
+        while out and (out[-1].isspace() or out[-1] == ","):
+            out.pop()
+        out.extend(_CLOSERS[opener] for opener in reversed(stack))
+    return "".join(out)
+
+
+def loads(text: str) -> dict:
+    """
+    Decode model output into a dict, every event answers with a json object. The fast path decodes straight from
+    each candidate `{`/`[` and ignores whatever follows the value, the candidate objects are only repaired when none
+    of them decodes.
+    """
+    spans = []
+    start = _json_start(text)
+    # candidates are the top level spans, so brackets in prose before the value ("a plan for [7] days") are
+    # skipped. A span is only scanned once decoding from its start failed, nothing follows a truncated object.
+    while start != -1:
+        is_object = text[start] == "{"
+        if is_object:
+            try:
+                return _decoder.raw_decode(text, start)[0]
+            except json.JSONDecodeError:
+                pass
+        end = _span_end(text, start)
+        if is_object:
+            spans.append(text[start:end])
+            if end is None:
+                break
+        elif end is None:
+            # an unclosed `[` is prose ("[7 days"), not the value
+            end = start + 1
+        start = _json_start(text, end)
+    error = ValueError("no json object found in model output.")
+    for span in spans:
+        try:
+            repaired = repair_json(span)
+        except ValueError as e:
+            error = e
+            continue
+        try:
+            value = json.loads(repaired)
+            logger.warning("Model output needed json repair")
+            return value
+        except json.JSONDecodeError:
+            pass
+        try:
+            # last resort for python style literals (single quotes, None/True/False)
+            value = literal_eval(repaired)
+        except (ValueError, SyntaxError) as e:
+            error = e
+            continue
+        if isinstance(value, dict):
+            logger.warning("Model output was a python literal, not json")
+            return value
+    raise error
+
+
+def validate(value, schema: type[BaseModel]) -> None:
+    """ Check `value` against `schema`. Raises pydantic.ValidationError. """
+    schema.model_validate(value)
+
+
+def parse_model_output(text: str, event: str = None) -> Response:
+    """
+    Full parsing stage. With `output_validation = warn` schema errors are logged and the plan is kept, with
+    `strict` they fail the response, `off` skips validation.
+    """
+    try:
+        value = loads(text)
+    except (ValueError, SyntaxError) as e:
+        err_msg = f"Bedrock response is not in json, got - {e}"
+        logger.error(err_msg)
+        return {"error": err_msg}
+
+    schema = SCHEMAS.get(event)
+    mode = settings.output_validation
+    if schema is not None and mode != "off":
+        try:
+            validate(value, schema)
+        except ValidationError as e:
+            err_msg = f"Bedrock {event} response does not match {schema.__name__} - {e.error_count()} errors"
+            if mode == "strict":
+                logger.error(f"{err_msg}: {e}")
+                return {"error": err_msg}
+            logger.warning(err_msg)
+
+    return {"success": value}
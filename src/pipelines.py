@@ -0,0 +1,121 @@
+"""
+Generation pipelines of the plan endpoints, shared by the single and the batch handlers, and the partial
+regeneration of one day or one meal of a stored plan.
+Author: vatsal1306
+"""
+from src import metrics
+from src.prompts import workout_summary
+from src.Utils.utils import Person, Response, adjust_format, adjust_workout, carry_markers
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+MEAL_SLOTS = ("breakfast", "lunch", "snacks", "dinner")
+
+
+class PlanPartNotFoundError(Exception):
+    """ The stored plan has no such day or meal, answered with 404. """
+
+
+async def water_plan(item: Person, model, executor) -> Response:
+    return await executor.text(model.get_text_response, item, "water")
+
+
+async def workout_plan(item: Person, model, executor) -> Response:
+    response: Response = await executor.text(model.get_text_response, item, "workout")
+    if "success" not in response:
+        return response
+    with metrics.stage_seconds.time(stage="reformat", event="workout", model=model.text_model):
+        response = adjust_workout(response)
+    days_resp = await executor.text(model.get_text_response, item, "days",
+                                    workout_details=response['success']['workoutplan'])
+    if "success" not in days_resp:
+        return days_resp
+    response['success']['days'] = days_resp['success']['days']
+    return carry_markers(days_resp, response)
+
+
+async def meal_plan(item: Person, model, executor) -> Response:
+    response: Response = await executor.text(model.get_text_response, item, "meal")
+    response = await executor.generate_image(model, response, item.id)
+    if "success" not in response:
+        return response
+    with metrics.stage_seconds.time(stage="reformat", event="meal", model=model.text_model):
+        return adjust_format(response)
+
+
+PIPELINES = {"water": water_plan, "workout": workout_plan, "meal": meal_plan}
+
+
+def _unwrap(value, key: str):
+    """ Scoped answers sometimes come wrapped in their day or slot, e.g. {"monday": {...}} for one day. """
+    if isinstance(value, dict) and len(value) == 1 and key in value:
+        return value[key]
+    return value
+
+
+def _meal_day(plan: list, day: str) -> dict:
+    """ Meals of `day` in a stored `adjust_format` plan. Raises PlanPartNotFoundError when the plan has no such day. """
+    for entry in plan:
+        if entry["data"].get("day") == day:
+            return entry["data"]
+    raise PlanPartNotFoundError(f"stored meal plan has no {day}.")
+
+
+def _meal_names(meals: dict, skip: str = None) -> str:
+    return ", ".join(meal["name"] for slot, meal in meals.items() if slot != skip and isinstance(meal, dict))
+
+
+async def meal_day_edit(item: Person, model, executor, plan: list, day: str) -> Response:
+    """
+    Regenerate the meals of one day of a stored meal plan: one scoped text call and images for that day only.
+    :return: the whole plan in the `adjust_format` shape, other days keep their meals and images
+    """
+    current = _meal_day(plan, day)
+    text = await executor.text(model.get_text_response, item, "meal_day", context=(day, _meal_names(current)))
+    if "success" not in text:
+        return text
+    response = await executor.generate_image(model, {"success": {day: _unwrap(text["success"], day)}}, item.id)
+    if "success" not in response:
+        return response
+    updated = adjust_format(response)["success"][0]
+    return carry_markers(text, carry_markers(response, {"success": [updated if entry["data"].get("day") == day
+                                                                     else entry for entry in plan]}))
+
+
+async def meal_slot_edit(item: Person, model, executor, plan: list, day: str, slot: str) -> Response:
+    """ Regenerate a single meal of a stored meal plan and its image, the rest of the plan is kept as is. """
+    current = _meal_day(plan, day)
+    if slot not in current:
+        raise PlanPartNotFoundError(f"stored meal plan has no {slot} on {day}.")
+    text = await executor.text(model.get_text_response, item, "meal_slot",
+                               context=(slot, current[slot]["name"], _meal_names(current, skip=slot)))
+    if "success" not in text:
+        return text
+    response = await executor.generate_image(model, {"success": {day: {slot: _unwrap(text["success"], slot)}}},
+                                             item.id)
+    if "success" not in response:
+        return response
+    current[slot] = response["success"][day][slot]
+    return carry_markers(text, carry_markers(response, {"success": plan}))
+
+
+async def workout_day_edit(item: Person, model, executor, plan: dict, day: str) -> Response:
+    """
+    Regenerate one day of a stored workout plan (after `adjust_workout`, days named by weekday). The `days`
+    estimate of the stored plan is kept, one changed day does not warrant another days call.
+    """
+    number = WEEKDAYS.index(day) + 1
+    current = [entry for entry in plan["workoutplan"] if entry["day"] == day]
+    if not current:
+        raise PlanPartNotFoundError(f"stored workout plan has no {day}.")
+    others = [entry for entry in plan["workoutplan"] if entry["day"] != day]
+    response = await executor.text(model.get_text_response, item, "workout_day",
+                                   context=(number, workout_summary(others), workout_summary(current)))
+    if "success" not in response:
+        return response
+    updated = _unwrap(response["success"], "workoutplan")
+    if isinstance(updated, list) and updated:
+        updated = updated[0]
+    updated["day"] = number
+    updated = adjust_workout({"success": {"workoutplan": [updated]}})["success"]["workoutplan"][0]
+    plan["workoutplan"] = [updated if entry["day"] == day else entry for entry in plan["workoutplan"]]
+    return carry_markers(response, {"success": plan})
@@ -0,0 +1,172 @@
+"""
+Persistent store of generated plans, so a user reopening the app reads the last plan instead of regenerating it.
+Plans are kept in their response shape (after `adjust_format` / `adjust_workout`, the workout with its `days`
+estimate) and indexed by person id, plan type and creation time.
+Author: vatsal1306
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from time import time
+from typing import NamedTuple, Optional
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.Utils import settings
+from src.Utils.utils import Path, is_complete
+
+PLAN_TYPES = ("workout", "meal", "water")
+
+
+class StoredPlan(NamedTuple):
+    plan_id: int
+    person_id: int
+    plan_type: str
+    created: float
+    # the plan as stored json text, read endpoints send it without decoding
+    plan: str
+
+    def decode(self):
+        return json.loads(self.plan)
+
+
+class PlanStore(ABC):
+    """ Storage interface of generated plans. """
+
+    @abstractmethod
+    def save(self, person_id: int, plan_type: str, plan) -> int:
+        """ Store `plan` (the `success` value of a response) as the newest plan of the person. :return: plan id """
+
+    def save_many(self, person_ids: list, plan_type: str, plan) -> list:
+        """ Store the same plan for several persons, e.g. a batch group. :return: plan ids """
+        return [self.save(person_id, plan_type, plan) for person_id in person_ids]
+
+    @abstractmethod
+    def latest(self, person_id: int, plan_type: str) -> Optional[StoredPlan]:
+        ...
+
+    @abstractmethod
+    def history(self, person_id: int, plan_type: str, limit: int = 10) -> list:
+        """ :return: [(plan_id, created)] newest first """
+
+    def purge(self) -> int:
+        """ Drop plans past the retention. :return: number of plans removed """
+        return 0
+
+    def close(self):
+        pass
+
+
+class SqlitePlanStore(PlanStore):
+    """
+    SQLite backend, shared by the workers of one host. Keeps the newest `history` plans per person and type and
+    drops plans older than `retention_days` (0 keeps them forever) at startup and every `purge_every` saves.
+    """
+
+    def __init__(self, path: str = None, retention_days: float = None, history: int = None, purge_every: int = 1000):
+        self.path = path or os.path.join(ROOT_DIR, settings.plan_store)
+        self.retention = (float(settings.plan_retention_days) if retention_days is None else retention_days) * 86400
+        self.keep = int(settings.plan_history) if history is None else history
+        self.purge_every = purge_every
+        self.saves = 0
+        Path.create_dir_if_not_exists(os.path.dirname(self.path))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS plans (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                          "person_id INTEGER NOT NULL, plan_type TEXT NOT NULL, created REAL NOT NULL, "
+                          "plan TEXT NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS plans_person_type_created "
+                          "ON plans (person_id, plan_type, created DESC)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS plans_created ON plans (created)")
+        removed = self.purge()
+        logger.info(f"Plan store {self.path} opened, {removed} expired plans removed")
+
+    def save(self, person_id: int, plan_type: str, plan) -> int:
+        return self.save_many([person_id], plan_type, plan)[0]
+
+    def save_many(self, person_ids: list, plan_type: str, plan) -> list:
+        """ One transaction and one json encoding for all persons. """
+        if plan_type not in PLAN_TYPES:
+            raise ValueError(f"got invalid plan type [{plan_type}]. Expected {list(PLAN_TYPES)}.")
+        body = json.dumps(plan)
+        plan_ids = []
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for person_id in person_ids:
+                    cursor = self.conn.execute("INSERT INTO plans (person_id, plan_type, created, plan) "
+                                               "VALUES (?, ?, ?, ?)", (person_id, plan_type, time(), body))
+                    plan_ids.append(cursor.lastrowid)
+                    if self.keep > 0:
+                        self.conn.execute("DELETE FROM plans WHERE id IN (SELECT id FROM plans WHERE person_id = ? "
+                                          "AND plan_type = ? ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                                          (person_id, plan_type, self.keep))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            purge = (self.saves + len(person_ids)) // self.purge_every > self.saves // self.purge_every
+            self.saves += len(person_ids)
+        if purge:
+            self.purge()
+        return plan_ids
+
+    def latest(self, person_id: int, plan_type: str) -> Optional[StoredPlan]:
+        with self.lock:
+            row = self.conn.execute("SELECT id, person_id, plan_type, created, plan FROM plans WHERE person_id = ? "
+                                    "AND plan_type = ? ORDER BY created DESC LIMIT 1",
+                                    (person_id, plan_type)).fetchone()
+        return StoredPlan(*row) if row else None
+
+    def history(self, person_id: int, plan_type: str, limit: int = 10) -> list:
+        with self.lock:
+            return self.conn.execute("SELECT id, created FROM plans WHERE person_id = ? AND plan_type = ? "
+                                     "ORDER BY created DESC LIMIT ?", (person_id, plan_type, limit)).fetchall()
+
+    def purge(self) -> int:
+        if self.retention <= 0:
+            return 0
+        with self.lock:
+            return self.conn.execute("DELETE FROM plans WHERE created < ?", (time() - self.retention,)).rowcount
+
+    def stats(self) -> dict:
+        with self.lock:
+            rows = self.conn.execute("SELECT plan_type, COUNT(*) FROM plans GROUP BY plan_type").fetchall()
+        return {"plans": dict(rows), "retention_days": self.retention / 86400, "history": self.keep}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def create_plan_store() -> Optional[PlanStore]:
+    """ Plan store configured in config.ini, None when disabled. """
+    if settings.plan_store_enabled.lower() != "true":
+        return None
+    return SqlitePlanStore()
+
+
+async def save_plan(store: Optional[PlanStore], person_id: int, plan_type: str, response: dict):
+    """
+    Store the `success` value of a response off the event loop. A failed write is logged, never raised.
+    Incomplete plans (see `INCOMPLETE_MARKERS`) are not stored, the previous plan stays the latest one.
+    """
+    await save_plans(store, [person_id], plan_type, response)
+
+
+async def save_plans(store: Optional[PlanStore], person_ids: list, plan_type: str, response: dict):
+    """ `save_plan` for every person of a batch group sharing one response. """
+    if store is None or "success" not in response or not person_ids:
+        return
+    persons = f"person {person_ids[0]}" if len(person_ids) == 1 else f"{len(person_ids)} persons"
+    if not is_complete(response):
+        logger.warning(f"Not storing incomplete {plan_type} plan of {persons}")
+        return
+    try:
+        await asyncio.to_thread(store.save_many, person_ids, plan_type, response["success"])
+    except Exception as e:
+        logger.exception(f"Could not store {plan_type} plan of {persons} - {e}")
@@ -0,0 +1,133 @@
+"""
+Prompt compilation. Templates in prompts/ are loaded and validated once, the sample plans are serialized as compact
+json into them, and every event gets a prompt token estimate and its own output token budget (`maxTokens`).
+Author: vatsal1306
+"""
+import json
+import math
+import os
+from string import Formatter
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.Utils import settings
+
+# event: (system prompt file, user prompt file, sample file bound to a field, field index of the sample,
+#         fields filled per request)
+EVENTS = {
+    "workout": ("workout_system_prompt.txt", "workout_usr_prompt.txt", "sample_workout_plan.json", 1, (0,)),
+    "meal": ("diet_system_prompt.txt", "diet_usr_prompt.txt", "sample_meal_plan.json", 1, (0,)),
+    "water": ("water_system_prompt.txt", "water_usr_prompt.txt", "sample_water_intake.json", 1, (0,)),
+    "days": ("days_system_prompt.txt", "days_usr_prompt.txt", "sample_days.json", 2, (0, 1)),
+    # partial regeneration of a stored plan, scoped to one day or one meal
+    "meal_day": ("diet_system_prompt.txt", "meal_day_usr_prompt.txt", "sample_meal_day.json", 3, (0, 1, 2)),
+    "meal_slot": ("diet_system_prompt.txt", "meal_slot_usr_prompt.txt", "sample_meal_slot.json", 4, (0, 1, 2, 3)),
+    "workout_day": ("workout_system_prompt.txt", "workout_day_usr_prompt.txt", "sample_workout_day.json", 4,
+                    (0, 1, 2, 3)),
+}
+
+
+def compact(value) -> str:
+    """ Serialize a prompt value, json without whitespace for anything that is not already text. """
+    return value if isinstance(value, str) else json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def workout_summary(workoutplan) -> list:
+    """
+    The workout plan as context of the days prompt. Descriptions and empty ("None") fields do not change the
+    estimate and are dropped, which roughly halves the largest part of that prompt.
+    """
+    if not isinstance(workoutplan, list):
+        return workoutplan
+    return [{"day": day.get("day"),
+             "workouts": [{k: v for k, v in workout.items() if k != "description" and v not in (None, "None")}
+                          for workout in day.get("workouts", [])]}
+            for day in workoutplan]
+
+
+def estimate_tokens(text: str) -> int:
+    """ Rough token count for Llama 3 style tokenizers, about 4 characters per token on english text and json. """
+    return math.ceil(len(text) / 4)
+
+
+class PromptTemplate:
+    """
+    Prompt template parsed once at startup. Fields bound in `static` (the sample plans) are rendered up front,
+    only the per-request fields are filled by `render`, so the shared template is never mutated.
+    """
+
+    def __init__(self, text: str, static: dict = None):
+        static = static or {}
+        self.segments = []
+        self.fields = set()
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                self._append(literal)
+            if field is None:
+                continue
+            index = int(field)
+            self.fields.add(index)
+            if index in static:
+                self._append(compact(static[index]))
+            else:
+                self.segments.append(index)
+
+    def _append(self, literal: str):
+        if self.segments and isinstance(self.segments[-1], str):
+            self.segments[-1] += literal
+        else:
+            self.segments.append(literal)
+
+    def static_text(self) -> str:
+        return "".join(seg for seg in self.segments if isinstance(seg, str))
+
+    def render(self, *args) -> str:
+        return "".join(seg if isinstance(seg, str) else compact(args[seg]) for seg in self.segments)
+
+
+class CompiledPrompt:
+    def __init__(self, event: str, system: str, template: PromptTemplate, max_tokens: int):
+        self.event = event
+        self.system = system
+        self.template = template
+        self.max_tokens = max_tokens
+        self.static_tokens = estimate_tokens(system) + estimate_tokens(template.static_text())
+
+
+class PromptCompiler:
+    """ Loads, validates and compiles the prompts of every event. Raises ValueError on a broken template. """
+
+    def __init__(self, prompts_dir: str = None):
+        self.prompts_dir = prompts_dir or os.path.join(ROOT_DIR, "prompts")
+        self.prompts = {}
+        for event, (system_file, user_file, sample_file, sample_field, request_fields) in EVENTS.items():
+            system = self._read(os.path.join(self.prompts_dir, system_file))
+            with open(os.path.join(ROOT_DIR, sample_file), "r", encoding="utf-8") as f:
+                sample = json.load(f)
+            template = PromptTemplate(self._read(os.path.join(self.prompts_dir, user_file)), {sample_field: sample})
+            expected = set(request_fields) | {sample_field}
+            if template.fields != expected:
+                raise ValueError(f"{user_file} has fields {sorted(template.fields)}, expected {sorted(expected)}.")
+            if any(field is not None for _, field, _, _ in Formatter().parse(system)):
+                raise ValueError(f"{system_file} must not contain format fields.")
+            max_tokens = int(getattr(settings, f"max_tokens_{event}", None) or settings.max_tokens)
+            self.prompts[event] = CompiledPrompt(event, system, template, max_tokens)
+            logger.info(f"Compiled {event} prompt, ~{self.prompts[event].static_tokens} static tokens, "
+                        f"maxTokens {max_tokens}")
+
+    @staticmethod
+    def _read(filepath: str) -> str:
+        if not os.path.exists(filepath):
+            raise ValueError(f"Prompt file {filepath} not found.")
+        with open(filepath, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def __contains__(self, event: str) -> bool:
+        return event in self.prompts
+
+    def __getitem__(self, event: str) -> CompiledPrompt:
+        return self.prompts[event]
+
+    def stats(self) -> dict:
+        return {event: {"static_prompt_tokens": prompt.static_tokens, "max_tokens": prompt.max_tokens}
+                for event, prompt in self.prompts.items()}
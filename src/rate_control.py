@@ -0,0 +1,169 @@
+"""
+Rate control for Bedrock calls. Retryable errors are retried with jittered exponential backoff, throttling shrinks
+an adaptive (AIMD) concurrency limit and an optional token bucket caps the call rate at the account quota.
+One `RateController` is shared by all text calls and one by all image calls of a worker process.
+Author: vatsal1306
+"""
+import random
+import threading
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+from src import metrics
+from src.Logging import logger
+from src.Utils import settings
+
+# Bedrock / S3 error codes signalling that the quota is exhausted, the limit is reduced on these
+THROTTLE_CODES = {"ThrottlingException", "TooManyRequestsException", "SlowDown", "RequestLimitExceeded"}
+# transient errors worth another attempt, validation or access errors are not
+RETRYABLE_CODES = THROTTLE_CODES | {"ServiceUnavailableException", "InternalServerException",
+                                    "ModelNotReadyException", "ModelTimeoutException", "ModelErrorException"}
+
+
+def error_code(error: Exception) -> str:
+    """ AWS error code of a botocore `ClientError`, empty for other exceptions. Avoids importing botocore. """
+    response = getattr(error, "response", None)
+    return response.get("Error", {}).get("Code", "") if isinstance(response, dict) else ""
+
+
+class TokenBucket:
+    """ Allows `rate` calls per second with bursts of up to `burst` calls. A rate of 0 disables the bucket. """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """ Take a token, sleeping until one is available. Returns the seconds waited. """
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            sleep(delay)
+            waited += delay
+
+
+class AIMDLimit:
+    """
+    Concurrency limit adjusted by additive increase / multiplicative decrease: every success adds
+    `increase / limit` (about `increase` per round of `limit` calls), a throttle multiplies the limit by `decrease`,
+    at most once per `cooldown` seconds so one burst of throttles counts as a single signal.
+    """
+
+    def __init__(self, initial: float, minimum: float, maximum: float, increase: float, decrease: float,
+                 cooldown: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = min(max(initial, minimum), maximum)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.decreased_at = 0.0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def on_success(self):
+        with self.condition:
+            if self.limit < self.maximum:
+                before = int(self.limit)
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+                if int(self.limit) > before:
+                    self.condition.notify()
+
+    def on_throttle(self):
+        with self.condition:
+            now = monotonic()
+            if now - self.decreased_at >= self.cooldown:
+                self.decreased_at = now
+                self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class RateController:
+    """ Runs blocking Bedrock calls under a token bucket and an AIMD limit, retrying retryable errors. """
+
+    def __init__(self, kind: str, maximum: int, initial: int = None, rate: float = None, burst: float = None):
+        self.kind = kind
+        self.limit = AIMDLimit(initial or maximum, float(settings.aimd_min_limit), maximum,
+                               float(settings.aimd_increase), float(settings.aimd_decrease),
+                               float(settings.aimd_cooldown))
+        rate = float(getattr(settings, f"{kind}_rate_limit")) if rate is None else rate
+        burst = float(getattr(settings, f"{kind}_rate_burst")) if burst is None else burst
+        self.bucket = TokenBucket(rate, burst)
+        self.max_attempts = int(settings.retry_max_attempts)
+        self.base_delay = float(settings.retry_base_delay)
+        self.max_delay = float(settings.retry_max_delay)
+        self.random = random.Random()
+        self.throttles = 0
+        self.retries = 0
+        metrics.concurrency_limit.set(int(self.limit.limit), kind=kind)
+        logger.info(f"{kind} rate control: concurrency {int(self.limit.limit)}/{maximum}, "
+                    f"rate {rate or 'unlimited'}/s, {self.max_attempts} attempts")
+
+    def backoff(self, attempt: int) -> float:
+        """ Full jitter, uniform over [0, base * 2^attempt] capped at max_delay. """
+        return self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @contextmanager
+    def slot(self):
+        """ Hold a token and a concurrency slot for one attempt. """
+        waited = self.bucket.acquire()
+        if waited:
+            metrics.rate_wait_seconds.inc(waited, kind=self.kind)
+        self.limit.acquire()
+        metrics.rate_in_flight.inc(kind=self.kind)
+        try:
+            yield
+        finally:
+            metrics.rate_in_flight.dec(kind=self.kind)
+            self.limit.release()
+
+    def call(self, func, *args, **kwargs):
+        """ `func(*args, **kwargs)` with retries. Raises the last error once attempts are exhausted. """
+        for attempt in range(self.max_attempts):
+            try:
+                with self.slot():
+                    result = func(*args, **kwargs)
+            except Exception as e:
+                code = error_code(e)
+                if code in THROTTLE_CODES:
+                    self.throttles += 1
+                    self.limit.on_throttle()
+                    metrics.throttles_total.inc(kind=self.kind, code=code)
+                    metrics.concurrency_limit.set(int(self.limit.limit), kind=self.kind)
+                if code not in RETRYABLE_CODES or attempt == self.max_attempts - 1:
+                    raise
+                delay = self.backoff(attempt)
+                self.retries += 1
+                metrics.retries_total.inc(kind=self.kind, code=code)
+                logger.warning(f"{self.kind} call failed with {code}, retry {attempt + 1} in {delay:.2f} s")
+                sleep(delay)
+            else:
+                self.limit.on_success()
+                metrics.concurrency_limit.set(int(self.limit.limit), kind=self.kind)
+                return result
+
+    def stats(self) -> dict:
+        return {"limit": int(self.limit.limit), "max_limit": self.limit.maximum, "in_flight": self.limit.in_flight,
+                "rate": self.bucket.rate or None, "throttles": self.throttles, "retries": self.retries}
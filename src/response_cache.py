@@ -0,0 +1,219 @@
+"""
+Cache for `LLM.get_text_response`. Identical profiles produce the same prompt, so the parsed Bedrock answer is reused
+instead of paying for another multi-second `converse` call.
+Author: vatsal1306
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from time import time
+from typing import Callable, Optional
+
+from src import ROOT_DIR
+from src.Logging import logger
+from src.Utils import settings
+from src.Utils.utils import Path, Person, Response, is_complete
+
+# Person fields that end up in the prompt. `id`, `sport` and `target_date` are not used by the prompts, so they must
+# not fragment the cache key.
+PROMPT_FIELDS = ("age", "gender", "height", "weight", "current_body_type", "target_body_type", "diet_preference",
+                 "allergens")
+
+
+def normalize_profile(data: Person) -> dict:
+    """ Prompt relevant fields of a person, lower cased with whitespace collapsed ("170 cm" == "170cm "). """
+    profile = {}
+    for field in PROMPT_FIELDS:
+        value = getattr(data, field)
+        if isinstance(value, str):
+            value = re.sub(r"\s+", " ", value.strip().lower())
+            value = re.sub(r"(\d) (?=[a-z])", r"\1", value)
+        profile[field] = value
+    return profile
+
+
+def cache_key(event: str, data: Person, model_id: str, inference_config: dict, extra=None) -> str:
+    payload = json.dumps({"event": event, "profile": normalize_profile(data), "model": model_id,
+                          "inference": inference_config, "extra": extra}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheBackend(ABC):
+    """ Storage interface of the response cache, values are serialized responses. """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: str):
+        ...
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """ In-process LRU with a TTL per entry. """
+
+    def __init__(self, capacity: int, ttl: float):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        with self.lock:
+            self.entries[key] = (value, time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+
+class SqliteBackend(CacheBackend):
+    """ Persistent backend, survives restarts and can be shared by the workers of one host. """
+
+    def __init__(self, path: str, ttl: float):
+        Path.create_dir_if_not_exists(os.path.dirname(path))
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        self.conn.execute("DELETE FROM responses WHERE expires < ?", (time(),))
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM responses WHERE key = ? AND expires >= ?",
+                                    (key, time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, value, expires) VALUES (?, ?, ?)",
+                              (key, value, time() + self.ttl))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+
+
+class ResponseCache:
+    """
+    Tiered cache over one or more backends, checked in order with hits promoted to the earlier tiers.
+    Concurrent misses on the same key are coalesced: one caller computes, the others wait for its result.
+    Only successful, complete responses are stored (see `is_complete`). Every caller gets its own deserialized copy,
+    since handlers mutate them.
+    """
+
+    def __init__(self, backends: list):
+        self.backends = backends
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @classmethod
+    def from_settings(cls) -> "ResponseCache":
+        ttl = float(settings.response_cache_ttl)
+        backends = [MemoryBackend(int(settings.response_cache_size), ttl)]
+        if settings.response_cache_sqlite:
+            backends.append(SqliteBackend(os.path.join(ROOT_DIR, settings.response_cache_sqlite), ttl))
+        return cls(backends)
+
+    def _lookup(self, key: str) -> Optional[str]:
+        for i, backend in enumerate(self.backends):
+            value = backend.get(key)
+            if value is not None:
+                for earlier in self.backends[:i]:
+                    earlier.set(key, value)
+                return value
+        return None
+
+    def get(self, key: str) -> Optional[Response]:
+        value = self._lookup(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(value)
+
+    def put(self, key: str, response: Response):
+        if is_complete(response):
+            value = json.dumps(response)
+            for backend in self.backends:
+                backend.set(key, value)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Response],
+                       cacheable: Callable[[Response], bool] = is_complete) -> Response:
+        """ Cached response of `key`, or the result of `compute`, stored when `cacheable(result)`. """
+        value = self._lookup(key)
+        if value is not None:
+            with self.lock:
+                self.hits += 1
+            return json.loads(value)
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            return json.loads(flight.value)
+
+        try:
+            response = compute()
+            flight.value = json.dumps(response)
+            if cacheable(response):
+                for backend in self.backends:
+                    backend.set(key, flight.value)
+        except Exception as e:
+            flight.value = json.dumps({"error": str(e)})
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return json.loads(flight.value)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                    "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+                    "in_flight": len(self.flights)}
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
+        logger.info("Response cache closed")
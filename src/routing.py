@@ -0,0 +1,247 @@
+"""
+Model routing in front of Bedrock `converse`. Events are routed to a configured text model, a call that is slower
+than the recent latency percentile of its event is hedged with a duplicate (optionally on the smaller model), a
+failed call is retried on the fallback model and a circuit breaker sheds traffic to the fallback model while the
+primary fails or is slow.
+Author: vatsal1306
+"""
+import contextvars
+import math
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic, perf_counter
+from typing import Optional
+
+from src import metrics
+from src.Logging import logger
+from src.prompts import EVENTS
+from src.Utils import settings
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+BREAKER_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class LatencyWindow:
+    """ The last `size` successful call durations of one (model, event), for the hedge delay. """
+
+    def __init__(self, size: int):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, p: float) -> float:
+        with self.lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return math.inf
+        return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class CircuitBreaker:
+    """
+    Opens when at least `error_rate` of the last `window` calls of a model failed or took longer than `slow_call`
+    seconds. After `cooldown` seconds a single probe call is let through (half open), its outcome closes the breaker
+    or opens it again.
+    """
+
+    def __init__(self, model_id: str, window: int, min_calls: int, error_rate: float, slow_call: float,
+                 cooldown: float):
+        self.model_id = model_id
+        self.outcomes = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        metrics.breaker_state.set(BREAKER_STATES[CLOSED], model=model_id)
+
+    def _set(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit breaker of {self.model_id} {self.state} -> {state}")
+            metrics.breaker_transitions_total.inc(model=self.model_id, state=state)
+        self.state = state
+        metrics.breaker_state.set(BREAKER_STATES[state], model=self.model_id)
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and monotonic() - self.opened_at >= self.cooldown:
+                self._set(HALF_OPEN)
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record(self, ok: bool, seconds: float):
+        failed = not ok or seconds > self.slow_call
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+                self.outcomes.clear()
+                self._set(OPEN if failed else CLOSED)
+                self.opened_at = monotonic()
+                return
+            self.outcomes.append(failed)
+            if self.state == CLOSED and len(self.outcomes) >= self.min_calls \
+                    and sum(self.outcomes) / len(self.outcomes) >= self.error_rate:
+                self._set(OPEN)
+                self.opened_at = monotonic()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"state": self.state, "recent_calls": len(self.outcomes), "recent_failures": sum(self.outcomes)}
+
+
+class ModelRouter:
+    """
+    Picks the text model of an event and runs `converse` with hedging, through the `RateController` `rate` if given.
+    Thread safe, shared by all requests.
+    The losing call of a hedge race is not cancelled (boto3 can not abort a request), its result is discarded.
+    """
+
+    def __init__(self, primary: str = None, fallback: str = None, routes: dict = None, rate=None):
+        self.primary = primary or settings.text_model
+        self.fallback = fallback or settings.fallback_model or self.primary
+        self.routes = routes if routes is not None else {
+            event: getattr(settings, f"route_{event}") for event in EVENTS if getattr(settings, f"route_{event}", None)}
+        self.hedge_enabled = settings.hedge_enabled.lower() == "true"
+        self.hedge_percentile = float(settings.hedge_percentile)
+        self.hedge_min_delay = float(settings.hedge_min_delay)
+        self.hedge_min_samples = int(settings.hedge_min_samples)
+        self.hedge_to_fallback = settings.hedge_to_fallback.lower() == "true"
+        self.latency_window = int(settings.hedge_window)
+        self.latencies = {}
+        self.breakers = {model_id: CircuitBreaker(model_id, int(settings.breaker_window),
+                                                  int(settings.breaker_min_calls), float(settings.breaker_error_rate),
+                                                  float(settings.breaker_slow_call), float(settings.breaker_cooldown))
+                         for model_id in {self.primary, self.fallback, *self.routes.values()}}
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=2 * int(settings.text_concurrency), thread_name_prefix="hedge")
+        logger.info(f"ModelRouter initialized, primary {self.primary}, fallback {self.fallback}, routes {self.routes}, "
+                    f"hedging {'on' if self.hedge_enabled else 'off'}")
+
+    def model_for(self, event: str) -> str:
+        """ Configured model of `event`, used for the response cache key. """
+        return self.routes.get(event, self.primary)
+
+    def choose(self, event: str) -> str:
+        """ Model to call for `event`, the fallback while the breaker of the routed model is open. """
+        model_id = self.model_for(event)
+        if self.breakers[model_id].allow():
+            reason = "route"
+        elif self.fallback != model_id and self.breakers[self.fallback].allow():
+            model_id, reason = self.fallback, "breaker_open"
+        else:
+            # nowhere to shed to, keep using the routed model
+            reason = "breaker_open"
+        metrics.routed_total.inc(event=event, model=model_id, reason=reason)
+        return model_id
+
+    def _window(self, model_id: str, event: str) -> LatencyWindow:
+        with self.lock:
+            window = self.latencies.get((model_id, event))
+            if window is None:
+                window = self.latencies[(model_id, event)] = LatencyWindow(self.latency_window)
+            return window
+
+    def hedge_delay(self, model_id: str, event: str) -> Optional[float]:
+        """ Seconds to wait for `model_id` before hedging, None until enough latencies were observed. """
+        window = self._window(model_id, event)
+        if not self.hedge_enabled or len(window) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, window.percentile(self.hedge_percentile))
+
+    def record(self, model_id: str, event: str, ok: bool, seconds: float):
+        """ Outcome of a call made outside `converse`, e.g. a stream. """
+        self.breakers[model_id].record(ok, seconds)
+        if ok:
+            self._window(model_id, event).add(seconds)
+
+    def _call(self, client, model_id: str, event: str, kwargs: dict):
+        start = perf_counter()
+        try:
+            if self.rate is None:
+                response = client.converse(modelId=model_id, **kwargs)
+            else:
+                response = self.rate.call(client.converse, modelId=model_id, **kwargs)
+        except Exception:
+            self.record(model_id, event, False, perf_counter() - start)
+            raise
+        seconds = perf_counter() - start
+        self.record(model_id, event, True, seconds)
+        metrics.stage_seconds.observe(seconds, stage="converse", event=event, model=model_id)
+        return response
+
+    def _submit(self, client, model_id: str, event: str, kwargs: dict):
+        # the calls run on the router pool, copy the context so their log records keep the request id
+        return self.pool.submit(contextvars.copy_context().run, self._call, client, model_id, event, kwargs)
+
+    def converse(self, client, event: str, **kwargs) -> tuple:
+        """
+        `client.converse` for `event` on the routed model, hedged once the call outlives the hedge delay. A failed
+        call (after the retries of the rate controller) is tried once more on the fallback model, if no call ran
+        there yet and its breaker allows it. Returns `(response, model_id)` of the first successful call, raises
+        the error of the primary call if every call failed.
+        """
+        model_id = self.choose(event)
+        delay = self.hedge_delay(model_id, event)
+        if delay is None:
+            try:
+                return self._call(client, model_id, event, kwargs), model_id
+            except Exception as e:
+                return self._fall_back(client, event, kwargs, (model_id,), e)
+        primary = self._submit(client, model_id, event, kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            if primary.exception() is None:
+                return primary.result(), model_id
+            return self._fall_back(client, event, kwargs, (model_id,), primary.exception())
+
+        hedge_model = self.fallback if self.hedge_to_fallback and self.breakers[self.fallback].allow() else model_id
+        logger.info(f"Hedging {event} call on {model_id} with {hedge_model}")
+        metrics.hedges_total.inc(event=event, outcome="launched")
+        hedge = self._submit(client, hedge_model, event, kwargs)
+        calls = {primary: model_id, hedge: hedge_model}
+        pending = set(calls)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    metrics.hedges_total.inc(event=event, outcome="hedge_won" if future is hedge else "primary_won")
+                    return future.result(), calls[future]
+        metrics.hedges_total.inc(event=event, outcome="both_failed")
+        return self._fall_back(client, event, kwargs, (model_id, hedge_model), primary.exception())
+
+    def _fall_back(self, client, event: str, kwargs: dict, tried: tuple, error: Exception) -> tuple:
+        """ Retry a failed call on the fallback model, raises `error` when it already ran there or is shed. """
+        if self.fallback in tried or not self.breakers[self.fallback].allow():
+            raise error
+        logger.warning(f"{event} call on {tried[0]} failed, retrying on {self.fallback} - {error}")
+        metrics.routed_total.inc(event=event, model=self.fallback, reason="primary_failed")
+        try:
+            return self._call(client, self.fallback, event, kwargs), self.fallback
+        except Exception:
+            raise error
+
+    def stats(self) -> dict:
+        with self.lock:
+            windows = dict(self.latencies)
+        return {"primary": self.primary, "fallback": self.fallback, "routes": self.routes,
+                "breakers": {model_id: breaker.stats() for model_id, breaker in self.breakers.items()},
+                "hedge_delay": {f"{model_id}/{event}": delay for model_id, event in windows
+                                if (delay := self.hedge_delay(model_id, event)) is not None}}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,91 @@
+"""
+Small dependency-aware scheduler for the model calls of one request. Every stage starts as soon as the stages it
+depends on have finished, so independent calls overlap and end-to-end latency follows the longest path.
+Author: vatsal1306
+"""
+import asyncio
+from time import perf_counter
+from typing import Awaitable, Callable, Optional
+
+from src.Logging import logger
+from src.Utils import settings
+
+
+class Stage:
+    """
+    One unit of work. `func` receives the results of `deps` as keyword arguments and returns a Response.
+    `timeout` defaults to `plan_timeout_<name>` from config.ini.
+    """
+
+    def __init__(self, name: str, func: Callable[..., Awaitable[dict]], deps: tuple = (),
+                 timeout: Optional[float] = None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        configured = getattr(settings, f"plan_timeout_{name}", None)
+        self.timeout = timeout if timeout is not None else (float(configured) if configured else None)
+
+
+class StageScheduler:
+    """
+    Runs stages concurrently in dependency order. Errors are isolated per stage: a stage that raises, times out or
+    returns an `error` response only skips the stages depending on it.
+    """
+
+    def __init__(self, stages: list):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}.")
+        self.results = {}
+        self.timings = {}
+
+    async def run(self) -> tuple:
+        """ :return: (results by stage name, timings by stage name) """
+        self.start = perf_counter()
+        tasks = {}
+        for name in self._order():
+            tasks[name] = asyncio.create_task(self._run_stage(self.stages[name], tasks))
+        await asyncio.gather(*tasks.values())
+        return self.results, self.timings
+
+    def _order(self) -> list:
+        order, visiting = [], set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage dependency cycle at {name}.")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    async def _run_stage(self, stage: Stage, tasks: dict):
+        await asyncio.gather(*[tasks[dep] for dep in stage.deps])
+        failed = [dep for dep in stage.deps if "success" not in self.results[dep]]
+        started = perf_counter()
+        if failed:
+            self.results[stage.name] = {"error": f"skipped, dependency {', '.join(failed)} failed."}
+            status = "skipped"
+        else:
+            try:
+                kwargs = {dep: self.results[dep] for dep in stage.deps}
+                self.results[stage.name] = await asyncio.wait_for(stage.func(**kwargs), stage.timeout)
+                status = "success" if "success" in self.results[stage.name] else "error"
+            except asyncio.TimeoutError:
+                self.results[stage.name] = {"error": f"stage {stage.name} timed out after {stage.timeout} seconds."}
+                status = "timeout"
+            except Exception as e:
+                logger.exception(f"Stage {stage.name} failed - {e}")
+                self.results[stage.name] = {"error": str(e)}
+                status = "error"
+        finished = perf_counter()
+        self.timings[stage.name] = {"status": status, "start": round(started - self.start, 4),
+                                    "duration": round(finished - started, 4)}
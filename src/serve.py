@@ -0,0 +1,36 @@
+"""
+Production launcher: runs the app under uvicorn with several worker processes. Each worker imports the app and runs
+its own startup phase (clients, templates, job runner), so one box uses all its cores.
+Run: python -m src.serve [--workers N] [--host HOST] [--port PORT]
+Author: vatsal1306
+"""
+import argparse
+import os
+
+from src.Utils import settings
+
+
+def worker_count(configured: int) -> int:
+    """ 0 means one worker per cpu. """
+    return configured if configured > 0 else os.cpu_count() or 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the fitness app with multiple uvicorn workers.")
+    parser.add_argument("--workers", type=int, default=int(settings.workers), help="worker processes, 0 = per cpu")
+    parser.add_argument("--host", default=settings.host)
+    parser.add_argument("--port", type=int, default=int(settings.port))
+    args = parser.parse_args()
+
+    import uvicorn
+
+    workers = worker_count(args.workers)
+    # read by src.Logging, workers write separate log files when there is more than one
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run("src.app:app", host=args.host, port=args.port, workers=workers,
+                timeout_keep_alive=int(settings.keep_alive), timeout_graceful_shutdown=int(settings.graceful_shutdown),
+                log_level=settings.level.lower())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Reuse of generated plans across near-identical profiles. Categorical profile fields are hard constraints (profiles
+are partitioned by them), age, height and weight are parsed into numbers and compared by a scaled euclidean
+distance, so a user 1 kg or one year away from a previous profile gets its cached plan instead of a new generation.
+Author: vatsal1306
+"""
+import json
+import re
+import threading
+from time import time
+from typing import Optional
+
+import numpy as np
+
+from src import metrics
+from src.Logging import logger
+from src.Utils import settings
+from src.Utils.utils import Person
+from src.response_cache import normalize_profile
+
+# profile fields that must match exactly, the numeric fields form the feature vector
+CATEGORICAL_FIELDS = ("gender", "current_body_type", "target_body_type", "diet_preference", "allergens")
+NUMERIC_FIELDS = ("age", "height", "weight")
+
+_NUMBER = r"(\d+(?:\.\d+)?)"
+
+
+def parse_height(text: str) -> Optional[float]:
+    """ Height in cm from "170 cm", "1.7m", "5'10\"", "5 ft 10 in" or "70 in". A bare number is cm, below 3 m. """
+    text = str(text).strip().lower()
+    feet = re.fullmatch(rf"{_NUMBER}\s*(?:'|ft|feet|foot)\s*(?:{_NUMBER}\s*(?:\"|''|in|inch|inches)?)?", text)
+    if feet:
+        return float(feet.group(1)) * 30.48 + float(feet.group(2) or 0) * 2.54
+    match = re.fullmatch(rf"{_NUMBER}\s*(cm|centimeters?|m|meters?|in|inch|inches|\"|)", text)
+    if not match:
+        return None
+    value, unit = float(match.group(1)), match.group(2)
+    if unit.startswith("c"):
+        return value
+    if unit.startswith("m") or (not unit and value < 3):
+        return value * 100
+    if unit:
+        return value * 2.54
+    return value
+
+
+def parse_weight(text: str) -> Optional[float]:
+    """ Weight in kg from "84 kg", "84kgs", "185 lbs" or "185 pounds". A bare number is kg. """
+    match = re.fullmatch(rf"{_NUMBER}\s*(kg|kgs|kilograms?|lb|lbs|pounds?|)", str(text).strip().lower())
+    if not match:
+        return None
+    value, unit = float(match.group(1)), match.group(2)
+    return value * 0.45359237 if unit.startswith(("l", "p")) else value
+
+
+def profile_features(data: Person) -> Optional[tuple]:
+    """ (age, height cm, weight kg), None when height or weight can not be parsed. """
+    height, weight = parse_height(data.height), parse_weight(data.weight)
+    if height is None or weight is None:
+        return None
+    return float(data.age), height, weight
+
+
+class _Partition:
+    """
+    Feature vectors, response cache keys and insertion times of one combination of categorical fields, grown by
+    doubling. Rows stay dense: a removed row is replaced by the last one.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.features = np.empty((capacity, len(NUMERIC_FIELDS)), dtype=np.float32)
+        self.added = np.empty(capacity, dtype=np.float64)
+        self.keys = []
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, vector: np.ndarray, key: str, now: float):
+        size = len(self.keys)
+        if size == len(self.features):
+            self.features = np.concatenate([self.features, np.empty_like(self.features)])
+            self.added = np.concatenate([self.added, np.empty_like(self.added)])
+        self.features[size] = vector
+        self.added[size] = now
+        self.keys.append(key)
+
+    def nearest(self, vector: np.ndarray, since: float) -> tuple:
+        """
+        :return: (index, squared distance) of the nearest vector added after `since`, the distance is infinite when
+            every vector is older. Vectors are stored already scaled.
+        """
+        size = len(self.keys)
+        diff = self.features[:size] - vector
+        distances = np.einsum("ij,ij->i", diff, diff)
+        distances[self.added[:size] < since] = np.inf
+        index = int(np.argmin(distances))
+        return index, float(distances[index])
+
+    def remove(self, index: int):
+        last = len(self.keys) - 1
+        if index != last:
+            self.features[index] = self.features[last]
+            self.added[index] = self.added[last]
+            self.keys[index] = self.keys[last]
+        self.keys.pop()
+
+    def drop_before(self, cutoff: float) -> int:
+        """ Remove the rows added before `cutoff`. :return: number of rows removed """
+        size = len(self.keys)
+        keep = self.added[:size] >= cutoff
+        kept = int(keep.sum())
+        if kept < size:
+            self.features[:kept] = self.features[:size][keep]
+            self.added[:kept] = self.added[:size][keep]
+            self.keys = [key for key, kept_row in zip(self.keys, keep) if kept_row]
+        return size - kept
+
+
+class SimilarityIndex:
+    """
+    In-memory nearest neighbour index from profiles to response cache keys, one per worker process. Numeric
+    features are divided by their scale (the difference counted as a distance of 1), a plan is reused when the
+    nearest profile of the same partition lies within `threshold`. Entries older than `ttl` (the response cache
+    ttl) are skipped by lookups and removed once the index is full, the oldest live entries are evicted after them.
+    Entries whose response is missing from the cache are dropped on lookup.
+    """
+
+    def __init__(self, events: tuple, threshold: float, scales: tuple, capacity: int, ttl: float):
+        self.events = set(events)
+        self.threshold = threshold
+        self.scales = np.asarray(scales, dtype=np.float32)
+        self.capacity = capacity
+        self.ttl = ttl
+        self.partitions = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.exact = 0
+        self.misses = 0
+        self.skipped = 0
+        self.expired = 0
+        self.evicted = 0
+        logger.info(f"Similarity index for {sorted(self.events)}, threshold {threshold}, scales {scales}")
+
+    @classmethod
+    def from_settings(cls) -> "SimilarityIndex":
+        events = tuple(event.strip() for event in settings.similarity_events.split(",") if event.strip())
+        scales = (float(settings.similarity_age_scale), float(settings.similarity_height_scale),
+                  float(settings.similarity_weight_scale))
+        return cls(events, float(settings.similarity_threshold), scales, int(settings.similarity_capacity),
+                   float(settings.response_cache_ttl))
+
+    def _locate(self, event: str, data: Person, model_id: str, inference_config: dict,
+                count: bool = False) -> Optional[tuple]:
+        """ (partition key, scaled feature vector), None for events or profiles the index does not cover. """
+        if event not in self.events:
+            return None
+        features = profile_features(data)
+        if features is None:
+            if count:
+                with self.lock:
+                    self.skipped += 1
+                metrics.similarity_lookups_total.inc(event=event, result="unparsed")
+            return None
+        profile = normalize_profile(data)
+        partition = (event, model_id, json.dumps(inference_config, sort_keys=True),
+                     *(profile[field] for field in CATEGORICAL_FIELDS))
+        return partition, np.asarray(features, dtype=np.float32) / self.scales
+
+    def lookup(self, event: str, data: Person, model_id: str, inference_config: dict) -> Optional[str]:
+        """ Response cache key of the nearest previous profile within the threshold, None on a miss. """
+        located = self._locate(event, data, model_id, inference_config, count=True)
+        if located is None:
+            return None
+        partition, vector = located
+        with self.lock:
+            entries = self.partitions.get(partition)
+            if entries:
+                index, distance = entries.nearest(vector, time() - self.ttl)
+                if distance <= self.threshold ** 2:
+                    if distance:
+                        self.hits += 1
+                    else:
+                        self.exact += 1
+                    metrics.similarity_lookups_total.inc(event=event, result="similar" if distance else "exact")
+                    return entries.keys[index]
+            self.misses += 1
+        metrics.similarity_lookups_total.inc(event=event, result="miss")
+        return None
+
+    def add(self, event: str, data: Person, model_id: str, inference_config: dict, key: str):
+        """ Index the profile of a freshly generated response stored under `key`. """
+        located = self._locate(event, data, model_id, inference_config)
+        if located is None:
+            return
+        partition, vector = located
+        now = time()
+        with self.lock:
+            if self.size >= self.capacity:
+                self._compact(now)
+            entries = self.partitions.get(partition)
+            if entries is None:
+                entries = self.partitions[partition] = _Partition()
+            elif entries and entries.nearest(vector, now - self.ttl)[1] == 0:
+                return
+            entries.add(vector, key, now)
+            self.size += 1
+
+    def _compact(self, now: float):
+        """ Drop expired entries, then the oldest ones down to 90% of the capacity. Called with the lock held. """
+        expired = sum(entries.drop_before(now - self.ttl) for entries in self.partitions.values())
+        self.size -= expired
+        self.expired += expired
+        target = int(self.capacity * 0.9)
+        evicted = 0
+        if self.size > target:
+            added = np.concatenate([entries.added[:len(entries)] for entries in self.partitions.values()])
+            excess = self.size - target
+            cutoff = np.partition(added, excess)[excess] if excess < len(added) else np.inf
+            evicted = sum(entries.drop_before(cutoff) for entries in self.partitions.values())
+            self.size -= evicted
+            self.evicted += evicted
+        self.partitions = {partition: entries for partition, entries in self.partitions.items() if entries}
+        logger.info(f"Similarity index full, {expired} expired and {evicted} oldest profiles removed, "
+                    f"{self.size} left")
+
+    def discard(self, event: str, data: Person, model_id: str, inference_config: dict, key: str):
+        """ Drop `key` from the partition of the profile, e.g. after its response expired from the cache. """
+        located = self._locate(event, data, model_id, inference_config)
+        if located is None:
+            return
+        with self.lock:
+            entries = self.partitions.get(located[0])
+            if entries is not None and key in entries.keys:
+                entries.remove(entries.keys.index(key))
+                self.size -= 1
+                if not entries:
+                    del self.partitions[located[0]]
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.exact + self.misses
+            return {"profiles": self.size, "partitions": len(self.partitions), "reused": self.hits,
+                    "exact": self.exact, "misses": self.misses, "unparsed": self.skipped, "expired": self.expired,
+                    "evicted": self.evicted,
+                    "reuse_rate": round(self.hits / lookups, 4) if lookups else 0.0}
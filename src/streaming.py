@@ -0,0 +1,228 @@
+"""
+Streaming variants of the meal and workout plans. Bedrock's `converse_stream` output is fed through an incremental
+json parser and every day is sent to the client as NDJSON as soon as its block is syntactically complete.
+Author: vatsal1306
+"""
+import asyncio
+import json
+
+from src.Logging import logger
+from src.plan_store import save_plan
+from src.Utils.utils import INCOMPLETE_MARKERS, Person, adjust_format, adjust_workout, carry_markers
+
+
+class IncrementalJSONParser:
+    """
+    Incremental parser that emits the object/array members of the container found at `path` as soon as they are
+    complete (scalar members are not emitted). `path=()` emits the values of the root object (meal days),
+    `path=("workoutplan",)` emits the elements of the root `workoutplan` array. The root is an object, any text
+    before it (code fences, preamble, "a plan for [7] days") is skipped. A root that turns out not to be json
+    ("{name}") is dropped and the scan resumes after its opening brace.
+    """
+
+    def __init__(self, path: tuple = ()):
+        self.path = tuple(path)
+        self.buffer = ""
+        self.pos = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.root_start = None
+        self.root_end = None
+        self.emitted = 0
+
+    def feed(self, chunk: str) -> list:
+        """ :return: [(key or index, value), ...] of the members completed by this chunk. """
+        self.buffer += chunk
+        completed = []
+        while self.pos < len(self.buffer) and self.root_end is None:
+            char = self.buffer[self.pos]
+            if self.in_string:
+                self._string_char(char)
+            elif self.root_start is None:
+                # every plan is an object, a `[` before it is prose
+                if char == "{":
+                    self.root_start = self.pos
+                    self._open(char)
+            elif char == '"':
+                self.in_string = True
+                self.string_start = self.pos
+            elif char in "{[":
+                self._open(char)
+            elif char in "}]":
+                completed.extend(self._close())
+            elif char == ":":
+                self.stack[-1]["expect_key"] = False
+            elif char == ",":
+                top = self.stack[-1]
+                if top["type"] == "{":
+                    top["expect_key"] = True
+                else:
+                    top["index"] += 1
+            self.pos += 1
+        return completed
+
+    @property
+    def complete(self) -> bool:
+        """ True once the root value closed, a stream cut off at maxTokens never gets there. """
+        return self.root_end is not None
+
+    def _string_char(self, char: str):
+        if self.escape:
+            self.escape = False
+        elif char == "\\":
+            self.escape = True
+        elif char == '"':
+            self.in_string = False
+            top = self.stack[-1]
+            if top["type"] == "{" and top["expect_key"]:
+                try:
+                    top["key"] = json.loads(self.buffer[self.string_start:self.pos + 1])
+                except json.JSONDecodeError:
+                    self._restart()
+
+    def _label(self, container: dict):
+        return container["key"] if container["type"] == "{" else container["index"]
+
+    def _open(self, char: str):
+        path = ()
+        if self.stack:
+            parent = self.stack[-1]
+            path = parent["path"] + (self._label(parent),)
+        self.stack.append({"type": char, "path": path, "start": self.pos, "key": None, "index": 0,
+                           "expect_key": char == "{"})
+
+    def _restart(self):
+        """ Drop the current root, it is not json, and scan again from the character after its opening brace. """
+        self.pos = self.root_start
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.root_start = None
+        self.emitted = 0
+
+    def _close(self) -> list:
+        closed = self.stack.pop()
+        if not self.stack:
+            if not self.emitted:
+                # a root without emitted members may be prose, e.g. "{name}", only json ends the scan
+                try:
+                    json.loads(self.buffer[self.root_start:self.pos + 1])
+                except json.JSONDecodeError:
+                    self._restart()
+                    return []
+            self.root_end = self.pos
+            return []
+        parent = self.stack[-1]
+        if parent["path"] != self.path:
+            return []
+        try:
+            value = json.loads(self.buffer[closed["start"]:self.pos + 1])
+        except json.JSONDecodeError:
+            self._restart()
+            return []
+        self.emitted += 1
+        return [(self._label(parent), value)]
+
+
+def _line(data) -> bytes:
+    return (json.dumps(data) + "\n").encode("utf-8")
+
+
+def _incomplete(parser: IncrementalJSONParser, markers: dict) -> dict:
+    """ Last line of a stream that is not the whole plan: `{"truncated": true}` and/or `{"degraded": true}`. """
+    if not parser.complete:
+        # the answer stopped before its root closed, e.g. cut off at maxTokens
+        markers = {**markers, "truncated": True}
+    return {marker: True for marker in INCOMPLETE_MARKERS if markers.get(marker)}
+
+
+async def stream_meal_plan(item: Person, model, executor, plans=None):
+    """
+    Yield NDJSON lines in the `adjust_format` shape, one per day, in the order of the plan. Image generation of a
+    day starts as soon as the day is parsed, a day is sent once its images and those of the days before it are done.
+    A failed day is sent as `{"day", "error"}`. A plan that was cut off or sent without images ends with a marker
+    line (see `_incomplete`), a complete plan is stored in `plans` like /meal stores it.
+    """
+    out = asyncio.Queue()
+    parser = IncrementalJSONParser()
+    days = []
+
+    async def day_images(day: str, meals: dict):
+        await out.put((day, await executor.generate_image(model, {"success": {day: meals}}, item.id)))
+
+    async def produce():
+        tasks = []
+        try:
+            async for chunk in executor.text_stream(model.stream_text_response, item, "meal"):
+                for day, meals in parser.feed(chunk):
+                    days.append(day)
+                    tasks.append(asyncio.create_task(day_images(day, meals)))
+            if not tasks:
+                await out.put((None, {"error": "Bedrock response did not contain a meal plan."}))
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            logger.exception(e)
+            await out.put((None, {"error": str(e)}))
+        finally:
+            await out.put(None)
+
+    producer = asyncio.create_task(produce())
+    # finished days by name, None for a failed one, sent in the order of `days`
+    finished = {}
+    entries = []
+    markers = {}
+    failed = False
+    try:
+        while (done := await out.get()) is not None:
+            day, data = done
+            if "success" not in data:
+                failed = True
+                if day is None:
+                    yield _line(data)
+                    continue
+                finished[day] = {"day": day, **data}
+            else:
+                carry_markers(data, markers)
+                finished[day] = adjust_format(data)["success"][0]
+            while len(entries) < len(days) and days[len(entries)] in finished:
+                entry = finished.pop(days[len(entries)])
+                entries.append(entry)
+                yield _line(entry)
+    finally:
+        producer.cancel()
+    incomplete = _incomplete(parser, markers)
+    if incomplete and entries:
+        yield _line(incomplete)
+    if not failed and entries:
+        await save_plan(plans, item.id, "meal", {"success": entries, **incomplete})
+
+
+async def stream_workout_plan(item: Person, model, executor, plans=None):
+    """
+    Yield NDJSON lines with one `workoutplan` day each, followed by the `days` estimate. A complete plan is stored
+    in `plans` in the /workout shape.
+    """
+    parser = IncrementalJSONParser(("workoutplan",))
+    workoutplan = []
+    try:
+        async for chunk in executor.text_stream(model.stream_text_response, item, "workout"):
+            for _, day in parser.feed(chunk):
+                day = adjust_workout({"success": {"workoutplan": [day]}})["success"]["workoutplan"][0]
+                workoutplan.append(day)
+                yield _line({"data": day})
+        if not workoutplan:
+            yield _line({"error": "Bedrock response did not contain a workout plan."})
+            return
+        days_resp = await executor.text(model.get_text_response, item, "days", workout_details=workoutplan)
+        yield _line({"days": days_resp["success"]["days"]} if "success" in days_resp else days_resp)
+        incomplete = _incomplete(parser, days_resp)
+        if incomplete:
+            yield _line(incomplete)
+        if "success" in days_resp:
+            plan = {"success": {"workoutplan": workoutplan, "days": days_resp["success"]["days"]}}
+            await save_plan(plans, item.id, "workout", {**plan, **incomplete})
+    except Exception as e:
+        logger.exception(e)
+        yield _line({"error": str(e)})